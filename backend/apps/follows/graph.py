@@ -0,0 +1,198 @@
+"""
+Follow graph cache.
+
+The ids of the users a user follows and of their followers are kept in two
+Redis sets per user, loaded from the Follow table on a miss and expired after
+GRAPH_CACHE_TTL. A set always holds the SENTINEL member, so that an empty set
+(no follows) is cached too.
+
+The sets are written through on follow and unfollow (signals.py, and the
+bulk follow view since bulk_create sends no signal). The write only updates
+the sets that are loaded: a missing set is left to the next load, so it is
+never partially built. A load writes a set only if it is still missing: a set
+created meanwhile was loaded later, or written through since.
+
+The read functions have async twins for the async views.
+"""
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django_redis import get_redis_connection
+
+from config.async_views import get_redis
+from .models import Follow
+
+SENTINEL = 0
+
+# Apply ARGV[1] (SADD or SREM) to the follow edges of the user ARGV[2]: the
+# ids ARGV[3...] in their following set KEYS[1], the user in the follower
+# sets KEYS[2...]. Sets that are not loaded are skipped.
+UPDATE_SCRIPT = """
+local op = ARGV[1]
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    for i = 3, #ARGV do
+        redis.call(op, KEYS[1], ARGV[i])
+    end
+end
+for i = 2, #KEYS do
+    if redis.call('EXISTS', KEYS[i]) == 1 then
+        redis.call(op, KEYS[i], ARGV[2])
+    end
+end
+"""
+
+# Write the set KEYS[1] with the members ARGV[2...] and the TTL ARGV[1], unless
+# it exists. Members are added in chunks to stay below the Lua stack limit.
+LOAD_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return 0
+end
+for i = 2, #ARGV, 1000 do
+    redis.call('SADD', KEYS[1], unpack(ARGV, i, math.min(i + 999, #ARGV)))
+end
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+return 1
+"""
+
+
+def following_key(user_id):
+    """Redis key of the ids of the users a user follows."""
+    return f'graph:following:{user_id}'
+
+
+def followers_key(user_id):
+    """Redis key of the ids of the followers of a user."""
+    return f'graph:followers:{user_id}'
+
+
+# Key function and (key column, value column) of the Follow rows of each kind of set
+KINDS = {
+    'following': (following_key, 'user_id', 'following_id'),
+    'followers': (followers_key, 'following_id', 'user_id'),
+}
+
+
+def _load(kind, user_ids):
+    """Load the sets of the users from the database, with one query."""
+    key, by, value = KINDS[kind]
+    members = {user_id: [SENTINEL] for user_id in user_ids}
+    for user_id, member in Follow.objects.filter(**{f'{by}__in': user_ids}).values_list(by, value):
+        members[user_id].append(member)
+    conn = get_redis_connection('default')
+    load = conn.register_script(LOAD_SCRIPT)
+    pipe = conn.pipeline()
+    for user_id, ids in members.items():
+        load(keys=[key(user_id)], args=[settings.GRAPH_CACHE_TTL, *ids], client=pipe)
+    pipe.execute()
+
+
+def ensure_loaded(kind, user_ids):
+    """Load the ``kind`` ('following' or 'followers') sets of the users that are not in Redis."""
+    user_ids = list(user_ids)
+    pipe = get_redis_connection('default').pipeline(transaction=False)
+    for user_id in user_ids:
+        pipe.exists(KINDS[kind][0](user_id))
+    missing = [user_id for user_id, exists in zip(user_ids, pipe.execute()) if not exists]
+    if missing:
+        _load(kind, missing)
+
+
+async def aensure_loaded(kind, user_ids):
+    user_ids = list(user_ids)
+    pipe = get_redis().pipeline(transaction=False)
+    for user_id in user_ids:
+        pipe.exists(KINDS[kind][0](user_id))
+    missing = [user_id for user_id, exists in zip(user_ids, await pipe.execute()) if not exists]
+    if missing:
+        await sync_to_async(_load)(kind, missing)
+
+
+def _ids(members):
+    return {int(member) for member in members} - {SENTINEL}
+
+
+def following_ids(user_id):
+    """Ids of the users a user follows."""
+    ensure_loaded('following', [user_id])
+    return _ids(get_redis_connection('default').smembers(following_key(user_id)))
+
+
+def follower_ids(user_id):
+    """Ids of the followers of a user."""
+    ensure_loaded('followers', [user_id])
+    return _ids(get_redis_connection('default').smembers(followers_key(user_id)))
+
+
+def is_following(user_id, other_id):
+    """Tell if a user follows another one."""
+    ensure_loaded('following', [user_id])
+    return bool(get_redis_connection('default').sismember(following_key(user_id), other_id))
+
+
+def followed_among(user_id, candidate_ids):
+    """Ids, among candidate_ids, of the users a user follows."""
+    candidate_ids = list(candidate_ids)
+    if not candidate_ids:
+        return set()
+    ensure_loaded('following', [user_id])
+    flags = get_redis_connection('default').smismember(following_key(user_id), candidate_ids)
+    return {candidate_id for candidate_id, flag in zip(candidate_ids, flags) if flag}
+
+
+async def afollowed_among(user_id, candidate_ids):
+    candidate_ids = list(candidate_ids)
+    if not candidate_ids:
+        return set()
+    await aensure_loaded('following', [user_id])
+    flags = await get_redis().smismember(following_key(user_id), candidate_ids)
+    return {candidate_id for candidate_id, flag in zip(candidate_ids, flags) if flag}
+
+
+def mutual_ids(user_id):
+    """Ids of the users who follow a user and are followed back."""
+    ensure_loaded('following', [user_id])
+    ensure_loaded('followers', [user_id])
+    return _ids(get_redis_connection('default').sinter(following_key(user_id), followers_key(user_id)))
+
+
+def follower_counts(user_ids):
+    """
+    Number of followers of each user, as a dict. Loaded sets are counted,
+    the others come from the denormalized User.follower_count column.
+    """
+    user_ids = list(user_ids)
+    pipe = get_redis_connection('default').pipeline(transaction=False)
+    for user_id in user_ids:
+        pipe.scard(followers_key(user_id))
+    counts, missing = {}, []
+    for user_id, size in zip(user_ids, pipe.execute()):
+        if size:
+            counts[user_id] = size - 1 # Do not count the sentinel
+        else:
+            missing.append(user_id)
+    if missing:
+        counts.update(
+            get_user_model().objects.filter(id__in=missing).values_list('id', 'follower_count')
+        )
+    return counts
+
+
+def _update(op, user_id, following_ids):
+    following_ids = list(following_ids)
+    if not following_ids:
+        return
+    update = get_redis_connection('default').register_script(UPDATE_SCRIPT)
+    update(
+        keys=[following_key(user_id), *(followers_key(following_id) for following_id in following_ids)],
+        args=[op, user_id, *following_ids],
+    )
+
+
+def add(user_id, following_ids):
+    """Write through new follows of a user."""
+    _update('SADD', user_id, following_ids)
+
+
+def remove(user_id, following_ids):
+    """Write through unfollows of a user."""
+    _update('SREM', user_id, following_ids)
@@ -5,17 +5,24 @@ class Follow(models.Model):
     user      = models.ForeignKey(
         settings.AUTH_USER_MODEL,
         related_name='following',
-        on_delete=models.CASCADE
+        on_delete=models.CASCADE,
+        db_index=False, # Covered by the unique constraint and follow_user_created_idx
     ) # The user who is following
     following = models.ForeignKey(
         settings.AUTH_USER_MODEL,
         related_name='followers',
-        on_delete=models.CASCADE
+        on_delete=models.CASCADE,
+        db_index=False, # Covered by follow_following_created_idx
     ) # The user being followed
     created_at = models.DateTimeField(auto_now_add=True) # Automatically set the field to now when the object is first created
 
     class Meta:
         unique_together = ('user', 'following') # A user can only follow another user once
+        indexes = [
+            # Following/followers lists, newest follows first, with id as tie breaker for keyset pagination
+            models.Index(fields=['user', '-created_at', '-id'], name='follow_user_created_idx'),
+            models.Index(fields=['following', '-created_at', '-id'], name='follow_following_created_idx'),
+        ]
 
     def __str__(self):
         return f'{self.user.username} follows {self.following.username}'
\ No newline at end of file
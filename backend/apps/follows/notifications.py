@@ -0,0 +1,180 @@
+"""
+Follow notifications.
+
+A new follow is not mailed right away: the follower is queued in a Redis
+sorted set per followed user, scored by the time of the follow, and the
+``flush_follow_notifications`` beat task mails every user a single digest
+("X, Y and 12 others followed you") once their oldest pending follow is
+FOLLOW_DIGEST_WINDOW old. An unfollow within the window cancels the
+notification. The digests of a flush are sent over one SMTP connection,
+opened once a digest is due. Each digest is sent on its own: the follows of
+the digests that failed are queued again, the ones sent are not.
+
+The users with pending follows are indexed by the ``notifications:due``
+sorted set, scored by their oldest pending follow.
+"""
+import time
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.mail import EmailMessage, get_connection
+from django_redis import get_redis_connection
+
+from .models import Follow
+
+DUE_KEY = 'notifications:due'
+NAMES_SHOWN = 2 # Followers named in a digest, the others are counted
+
+# Atomically pop the follows of KEYS[1] queued before ARGV[1] and reschedule
+# the user ARGV[2] in the due set KEYS[2] on its oldest remaining follow
+POP_DUE_SCRIPT = """
+local entries = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'WITHSCORES')
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+local oldest = redis.call('ZRANGE', KEYS[1], 0, 0, 'WITHSCORES')
+if #oldest > 0 then
+    redis.call('ZADD', KEYS[2], oldest[2], ARGV[2])
+else
+    redis.call('ZREM', KEYS[2], ARGV[2])
+end
+return entries
+"""
+
+
+def pending_key(user_id):
+    """Redis key of the followers of a user not notified yet."""
+    return f'notifications:follows:{user_id}'
+
+
+def queue(follower_id, followed_ids, timestamp=None):
+    """Queue the notification of new follows."""
+    if not followed_ids:
+        return
+    timestamp = time.time() if timestamp is None else timestamp
+    pipe = get_redis_connection('default').pipeline(transaction=False)
+    for followed_id in followed_ids:
+        pipe.zadd(pending_key(followed_id), {follower_id: timestamp}, nx=True)
+        pipe.zadd(DUE_KEY, {followed_id: timestamp}, nx=True)
+    pipe.execute()
+
+
+def cancel(follower_id, followed_ids):
+    """Cancel the notification of follows undone before being notified."""
+    if not followed_ids:
+        return
+    pipe = get_redis_connection('default').pipeline(transaction=False)
+    for followed_id in followed_ids:
+        # An emptied set is removed from the due set by the next flush
+        pipe.zrem(pending_key(followed_id), follower_id)
+    pipe.execute()
+
+
+def digest(user, followers):
+    """Subject and body of the digest of the new ``followers`` of a user, newest first."""
+    # "and 1 others" would be odd, name the last follower instead
+    shown = followers if len(followers) <= NAMES_SHOWN + 1 else followers[:NAMES_SHOWN]
+    names = [follower.username for follower in shown]
+    others = len(followers) - len(names)
+    if others:
+        summary = f"{', '.join(names)} and {others} others"
+    elif len(names) > 1:
+        summary = f"{', '.join(names[:-1])} and {names[-1]}"
+    else:
+        summary = names[0]
+    subject = f'New followers: {summary}' if len(followers) > 1 else f'New follower: {summary}'
+    message = (
+        f'Hello {user.username},\n\n'
+        f'{summary} followed you on MiniTwitter.\n\n'
+        'Enjoy the app,\nMiniTwitter Team'
+    )
+    return subject, message
+
+
+def _pop_due(conn, user_ids, cutoff):
+    """Pop the follows of the users queued before ``cutoff``, as {user_id: [(follower_id, timestamp)]}."""
+    pop_due = conn.register_script(POP_DUE_SCRIPT)
+    pipe = conn.pipeline(transaction=False)
+    for user_id in user_ids:
+        pop_due(keys=[pending_key(user_id), DUE_KEY], args=[cutoff, user_id], client=pipe)
+    return {
+        user_id: [(int(entries[i]), float(entries[i + 1])) for i in range(0, len(entries), 2)]
+        for user_id, entries in zip(user_ids, pipe.execute())
+    }
+
+
+def _requeue(conn, popped):
+    """Put back follows popped by a flush that failed to send them."""
+    pipe = conn.pipeline(transaction=False)
+    for user_id, entries in popped.items():
+        if entries:
+            pipe.zadd(pending_key(user_id), dict(entries))
+            # The popped follows are older than the ones left, so this is the oldest one
+            pipe.zadd(DUE_KEY, {user_id: min(timestamp for _, timestamp in entries)})
+    pipe.execute()
+
+
+def _messages(popped):
+    """
+    Digests of popped follows by user id, skipping the follows deleted since
+    (admin, shell...).
+    """
+    user_ids = set(popped)
+    follower_ids = {follower_id for entries in popped.values() for follower_id, _ in entries}
+    follows = set(
+        Follow.objects.filter(following_id__in=user_ids, user_id__in=follower_ids)
+        .values_list('following_id', 'user_id')
+    )
+    users = get_user_model().objects.only('id', 'username', 'email').in_bulk(user_ids | follower_ids)
+    messages = {}
+    for user_id, entries in popped.items():
+        followers = [
+            users[follower_id] for follower_id, _ in sorted(entries, key=lambda entry: -entry[1])
+            if (user_id, follower_id) in follows and follower_id in users
+        ]
+        if followers and user_id in users:
+            user = users[user_id]
+            messages[user_id] = EmailMessage(*digest(user, followers), settings.DEFAULT_FROM_EMAIL, [user.email])
+    return messages
+
+
+def flush(now=None):
+    """
+    Send the digests that are due, return the number of emails sent. The
+    error of the first digest that failed is raised once the others are sent.
+    """
+    now = time.time() if now is None else now
+    cutoff = now - settings.FOLLOW_DIGEST_WINDOW
+    conn = get_redis_connection('default')
+    sent, failed, error = 0, {}, None
+    connection = None
+    try:
+        while True:
+            user_ids = [
+                int(user_id) for user_id in
+                conn.zrangebyscore(DUE_KEY, '-inf', cutoff, start=0, num=settings.FOLLOW_DIGEST_BATCH_SIZE)
+            ]
+            if not user_ids:
+                break
+            popped = _pop_due(conn, user_ids, cutoff)
+            try:
+                messages = _messages(popped)
+                if messages and connection is None:
+                    connection = get_connection()
+                    connection.open()
+            except Exception:
+                _requeue(conn, popped)
+                raise
+            for user_id, message in messages.items():
+                try:
+                    sent += connection.send_messages([message])
+                except Exception as e:
+                    # Queued again once the loop is over, not to be popped again by it
+                    failed[user_id] = popped[user_id]
+                    error = error or e
+    finally:
+        if failed:
+            _requeue(conn, failed)
+        if connection is not None:
+            connection.close()
+    if error is not None:
+        raise error
+    return sent
@@ -0,0 +1,135 @@
+"""
+"Who to follow" recommendations.
+
+The suggestions are precomputed by the ``compute_recommendations`` beat task
+and served as is. For every user who follows someone, the candidates are the
+users followed by the users they follow (friends of friends), minus the users
+they already follow. A candidate's score is its number of mutual connections
+weighted by its recent activity:
+
+    score = mutual_count * (1 + log(1 + posts in the last RECOMMENDATIONS_ACTIVITY_DAYS))
+
+Users are processed in batches of RECOMMENDATIONS_BATCH_SIZE, with one query
+for their follows and one for the follows of the users they follow; the
+2-hop counts are plain set operations over these edge lists. Users who follow
+nobody get the most followed users.
+
+The suggestions of a user are stored in the cache with the username and the
+mutual count of every candidate, so serving them runs no query: only the
+users followed since the last run are filtered out, with the graph cache.
+"""
+import math
+from collections import Counter, defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db.models import Count, Max
+from django.utils import timezone
+
+from apps.posts.models import Post
+from . import graph
+from .models import Follow
+
+POPULAR_KEY = 'recommendations:popular'
+
+
+def cache_key(user_id):
+    """Cache key of the suggestions of a user."""
+    return f'recommendations:{user_id}'
+
+
+def _following(user_ids):
+    """Ids of the users followed by each user, as a dict of sets."""
+    following = defaultdict(set)
+    for user_id, following_id in Follow.objects.filter(user_id__in=user_ids).values_list('user_id', 'following_id'):
+        following[user_id].add(following_id)
+    return following
+
+
+def recent_activity():
+    """Number of posts of every author active in the last RECOMMENDATIONS_ACTIVITY_DAYS."""
+    since = timezone.now() - timedelta(days=settings.RECOMMENDATIONS_ACTIVITY_DAYS)
+    return dict(
+        Post.objects.filter(created_at__gte=since).order_by()
+        .values('author_id').annotate(count=Count('id')).values_list('author_id', 'count')
+    )
+
+
+def rank(user_id, following, second_hop, activity):
+    """
+    Top candidates of a user as (candidate_id, mutual_count, score) tuples.
+    ``following`` are the ids the user follows, ``second_hop`` the ids
+    followed by each of them.
+    """
+    mutuals = Counter()
+    for followed_id in following:
+        mutuals.update(second_hop.get(followed_id, ()))
+    for excluded_id in following | {user_id}:
+        mutuals.pop(excluded_id, None)
+    scored = [
+        (candidate_id, count, count * (1 + math.log1p(activity.get(candidate_id, 0))))
+        for candidate_id, count in mutuals.items()
+    ]
+    scored.sort(key=lambda item: (-item[2], item[0]))
+    return scored[:settings.RECOMMENDATIONS_COUNT]
+
+
+def compute_batch(user_ids, activity):
+    """Compute and store the suggestions of a batch of users, return the number stored."""
+    following = _following(user_ids)
+    second_hop = _following(set().union(*following.values()))
+    ranked = {
+        user_id: rank(user_id, following[user_id], second_hop, activity)
+        for user_id in user_ids if following[user_id]
+    }
+    usernames = dict(
+        get_user_model().objects.filter(
+            id__in={candidate_id for top in ranked.values() for candidate_id, _, _ in top}
+        ).values_list('id', 'username')
+    )
+    cache.set_many({
+        cache_key(user_id): [
+            {'id': candidate_id, 'username': usernames[candidate_id], 'mutual_count': count, 'score': round(score, 3)}
+            for candidate_id, count, score in top if candidate_id in usernames
+        ]
+        for user_id, top in ranked.items()
+    }, timeout=settings.RECOMMENDATIONS_TTL)
+    return len(ranked)
+
+
+def compute_popular():
+    """Store the most followed users, suggested to the users who follow nobody."""
+    popular = [
+        {'id': user_id, 'username': username, 'mutual_count': 0, 'score': 0.0}
+        for user_id, username in get_user_model().objects.filter(follower_count__gt=0)
+        .order_by('-follower_count', 'id').values_list('id', 'username')[:settings.RECOMMENDATIONS_COUNT]
+    ]
+    cache.set(POPULAR_KEY, popular, timeout=settings.RECOMMENDATIONS_TTL)
+
+
+def compute():
+    """Compute the suggestions of every user, return the number of users with suggestions."""
+    compute_popular()
+    activity = recent_activity()
+    last_id = Follow.objects.aggregate(last_id=Max('user_id'))['last_id'] or 0
+    batch_size = settings.RECOMMENDATIONS_BATCH_SIZE
+    stored = 0
+    for start in range(0, last_id + 1, batch_size):
+        user_ids = list(
+            Follow.objects.filter(user_id__gte=start, user_id__lt=start + batch_size)
+            .order_by().values_list('user_id', flat=True).distinct()
+        )
+        if user_ids:
+            stored += compute_batch(user_ids, activity)
+    return stored
+
+
+def suggestions(user_id):
+    """The stored suggestions of a user, without the users they followed since."""
+    stored = cache.get(cache_key(user_id))
+    if stored is None:
+        stored = [item for item in cache.get(POPULAR_KEY, []) if item['id'] != user_id]
+    followed = graph.followed_among(user_id, [item['id'] for item in stored])
+    return [item for item in stored if item['id'] not in followed]
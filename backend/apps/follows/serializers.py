@@ -1,34 +1,37 @@
 from rest_framework import serializers
+from django.conf import settings
 from django.contrib.auth import get_user_model
+from config.metrics import TimedSerializerMixin
 from .models import Follow
 
 User = get_user_model()
 
-class FollowSerializer(serializers.ModelSerializer):
+class FollowSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     """Serializer for the Follow model"""
     class Meta:
         model = Follow
         fields = ('id', 'following', 'created_at')
         read_only_fields = ('id', 'created_at')
 
-class UserSerializer(serializers.ModelSerializer):
+class UserSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     """Serializer for listing users are followed or following the user """
-    follower_count = serializers.SerializerMethodField() # Custom field to count followers
-    following_count = serializers.SerializerMethodField() # Custom field to count following
-
     class Meta:
         model = User
         fields = ('id', 'username', 'email', 'follower_count', 'following_count')
+        # Denormalized counters, kept in sync by the follow views
+        read_only_fields = ('follower_count', 'following_count')
+
+class FollowedUserSerializer(UserSerializer):
+    """User of a followers/following list, with the date of the follow"""
+    followed_at = serializers.DateTimeField(read_only=True)
+
+    class Meta(UserSerializer.Meta):
+        fields = UserSerializer.Meta.fields + ('followed_at',)
 
-    def get_follower_count(self, obj):
-        """
-        Custom method to count the number of followers for a user.
-        This method is used to calculate the number of followers for a user.
-        """
-        return obj.followers.count()
-    def get_following_count(self, obj):
-        """
-        Custom method to count the number of users a user is following.
-        This method is used to calculate the number of users a user is following.
-        """
-        return obj.following.count()
\ No newline at end of file
+class BulkFollowSerializer(serializers.Serializer):
+    """Ids of the users to follow or unfollow at once"""
+    user_ids = serializers.ListField(
+        child=serializers.IntegerField(min_value=1),
+        allow_empty=False,
+        max_length=settings.BULK_MAX_ITEMS,
+    )
@@ -0,0 +1,21 @@
+"""
+Keep the follow graph cache in sync with the Follow table, whatever code
+path (API, admin, shell) writes it. bulk_create sends no signal, its callers
+update the graph themselves.
+"""
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from . import graph
+from .models import Follow
+
+
+@receiver(post_save, sender=Follow)
+def follow_saved(sender, instance, created, **kwargs):
+    if created:
+        graph.add(instance.user_id, [instance.following_id])
+
+
+@receiver(post_delete, sender=Follow)
+def follow_deleted(sender, instance, **kwargs):
+    graph.remove(instance.user_id, [instance.following_id])
@@ -1,24 +1,67 @@
 from celery import shared_task
-from django.core.mail import send_mail
-from django.conf import settings
+
+RECONCILE_CHUNK_SIZE = 10000 # Users checked per UPDATE when reconciling counters
+
+@shared_task
+def flush_follow_notifications():
+    """Mail the digests of the follows queued for FOLLOW_DIGEST_WINDOW (see notifications.py)."""
+    from . import notifications
+    return notifications.flush()
+
+@shared_task
+def compute_recommendations():
+    """Precompute the follow suggestions of every user (see recommendations.py)."""
+    from . import recommendations
+    return recommendations.compute()
+
+@shared_task
+def backfill_timeline(user_id, author_id):
+    """Add the posts of a newly followed user to the follower's timeline."""
+    from apps.posts import feed_cache, timeline
+    timeline.backfill(user_id, author_id)
+    feed_cache.expire(user_id)
 
 @shared_task
-def send_follow_notification(follower_id, followed_id):
+def rebuild_timeline(user_id):
+    """Rebuild the timeline of a user who followed several users at once."""
+    from apps.posts import feed_cache, timeline
+    timeline.rebuild(user_id)
+    feed_cache.expire(user_id)
+
+@shared_task
+def prune_timeline(user_id, author_id):
+    """Remove the posts of an unfollowed user from the follower's timeline."""
+    from apps.posts import feed_cache, timeline
+    timeline.prune(user_id, author_id)
+    feed_cache.expire(user_id)
+
+@shared_task
+def reconcile_follow_counts():
+    """
+    Fix the drift between the follower/following counters of the users
+    and the Follow table. Users are checked in id ranges so that no UPDATE
+    locks the whole table.
+    """
     from django.contrib.auth import get_user_model
+    from django.db.models import Count, Max, OuterRef, Q, Subquery
+    from django.db.models.functions import Coalesce
+    from .models import Follow
     User = get_user_model()
-    follower = User.objects.get(pk=follower_id)
-    followed = User.objects.get(pk=followed_id)
-
-    subject = f'New follower: {follower.username}'
-    message = (
-        f'Hello {followed.username},\n\n'
-        f'{follower.username} start follow you on MiniTwitter .\n\n'
-        'Enjoy the app,\nMiniTwitter Team'
-    )
-    send_mail(
-        subject,
-        message,
-        settings.DEFAULT_FROM_EMAIL,
-        [followed.email],
-        fail_silently=False,
-    )
+
+    def actual(field):
+        return Coalesce(Subquery(
+            Follow.objects.filter(**{field: OuterRef('pk')})
+            .order_by().values(field)
+            .annotate(count=Count('id')).values('count')
+        ), 0)
+
+    follower_count, following_count = actual('following'), actual('user')
+    last_id = User.objects.aggregate(last_id=Max('id'))['last_id'] or 0
+    fixed = 0
+    for start in range(0, last_id + 1, RECONCILE_CHUNK_SIZE):
+        fixed += (
+            User.objects.filter(id__gte=start, id__lt=start + RECONCILE_CHUNK_SIZE)
+            .filter(~Q(follower_count=follower_count) | ~Q(following_count=following_count))
+            .update(follower_count=follower_count, following_count=following_count)
+        )
+    return fixed
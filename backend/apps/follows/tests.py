@@ -1,14 +1,29 @@
+import base64
+import json
+import time
+from unittest import mock
+
+from django.conf import settings
 from django.urls import reverse
 from rest_framework import status
 from rest_framework.test import APITestCase
 from django.contrib.auth import get_user_model
+from django.core import mail
+from django.core.cache import cache
+from django_redis import get_redis_connection
 
 from apps.follows.models import Follow
+from apps.follows import graph, notifications
+from apps.follows.tasks import compute_recommendations, reconcile_follow_counts
+from apps.posts.models import Post
 
 User = get_user_model()
 
 class FollowTests(APITestCase):
     def setUp(self):
+        # Start with an empty Redis
+        cache.clear()
+
         # Craete two users
         self.u1 = User.objects.create_user(email='u1@ex.com', username='u1', password='pass1234')
         self.u2 = User.objects.create_user(email='u2@ex.com', username='u2', password='pass1234')
@@ -69,11 +84,277 @@ class FollowTests(APITestCase):
         # How many followers does u1 have?
         r_folls = self.client.get(self.list_folls, **self.auth(self.token1))
         self.assertEqual(r_folls.status_code, status.HTTP_200_OK)
-        self.assertEqual(len(r_folls.data), 1)
-        self.assertEqual(r_folls.data[0]['id'], self.u2.id)
+        self.assertEqual(len(r_folls.json()['results']), 1)
+        self.assertEqual(r_folls.json()['results'][0]['id'], self.u2.id)
 
         # How many users does u1 follow?
         r_following = self.client.get(self.list_following, **self.auth(self.token1))
         self.assertEqual(r_following.status_code, status.HTTP_200_OK)
-        self.assertEqual(len(r_following.data), 1)
-        self.assertEqual(r_following.data[0]['id'], self.u2.id)
+        self.assertEqual(len(r_following.json()['results']), 1)
+        self.assertEqual(r_following.json()['results'][0]['id'], self.u2.id)
+
+    def test_follow_counters(self):
+        """Follow and unfollow keep the follower/following counters in sync."""
+        self.client.post(self.follow_url(self.u2.id), **self.auth(self.token1))
+        self.u1.refresh_from_db()
+        self.u2.refresh_from_db()
+        self.assertEqual((self.u1.following_count, self.u2.follower_count), (1, 1))
+
+        self.client.delete(self.unfollow_url(self.u2.id), **self.auth(self.token1))
+        self.u1.refresh_from_db()
+        self.u2.refresh_from_db()
+        self.assertEqual((self.u1.following_count, self.u2.follower_count), (0, 0))
+
+    def test_reconcile_follow_counts(self):
+        """The reconciliation task fixes counters that drifted."""
+        # Follows created without the view do not update the counters
+        Follow.objects.create(user=self.u2, following=self.u1)
+        self.assertEqual(reconcile_follow_counts(), 2)
+        r_folls = self.client.get(self.list_folls, **self.auth(self.token1))
+        self.assertEqual(r_folls.json()['results'][0]['following_count'], 1)
+        self.u1.refresh_from_db()
+        self.assertEqual(self.u1.follower_count, 1)
+
+    def test_bulk_follow_and_unfollow(self):
+        """Follow and unfollow a list of users in one request, with a result per user."""
+        u3 = User.objects.create_user(email='u3@ex.com', username='u3', password='pass1234')
+        Follow.objects.create(user=self.u1, following=self.u2)
+        bulk_url = reverse('follow-bulk')
+
+        resp = self.client.post(
+            bulk_url, {'user_ids': [self.u2.id, u3.id, self.u1.id, 9999, u3.id]},
+            format='json', **self.auth(self.token1)
+        )
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.data['results'], [
+            {'id': self.u2.id, 'status': 'already_following'},
+            {'id': u3.id, 'status': 'followed'},
+            {'id': self.u1.id, 'status': 'self'},
+            {'id': 9999, 'status': 'not_found'},
+        ])
+        self.assertTrue(Follow.objects.filter(user=self.u1, following=u3).exists())
+        # Only the new follow is notified
+        notifications.flush(now=time.time() + settings.FOLLOW_DIGEST_WINDOW)
+        self.assertEqual([m.to for m in mail.outbox], [[u3.email]])
+        u3.refresh_from_db()
+        self.assertEqual(u3.follower_count, 1)
+
+        resp = self.client.delete(
+            bulk_url, {'user_ids': [self.u2.id, u3.id, 9999]}, format='json', **self.auth(self.token1)
+        )
+        self.assertEqual([r['status'] for r in resp.data['results']], ['unfollowed', 'unfollowed', 'not_following'])
+        self.assertFalse(Follow.objects.filter(user=self.u1).exists())
+        self.u1.refresh_from_db()
+        u3.refresh_from_db()
+        self.assertEqual((self.u1.following_count, u3.follower_count), (0, 0))
+
+    def test_bulk_follow_concurrent_follow_not_counted(self):
+        """A follow inserted by a concurrent request is reported and not counted twice."""
+        Follow.objects.create(user=self.u1, following=self.u2) # Not seen by the request below
+        with mock.patch.object(Follow.objects, 'filter', return_value=Follow.objects.none()):
+            resp = self.client.post(
+                reverse('follow-bulk'), {'user_ids': [self.u2.id]}, format='json', **self.auth(self.token1)
+            )
+        self.assertEqual(resp.data['results'], [{'id': self.u2.id, 'status': 'already_following'}])
+        self.u2.refresh_from_db()
+        self.assertEqual(self.u2.follower_count, 0)
+
+    def test_bulk_follow_validation(self):
+        """A bulk request needs a non empty list of ids."""
+        resp = self.client.post(reverse('follow-bulk'), {'user_ids': []}, format='json', **self.auth(self.token1))
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('user_ids', resp.data)
+
+    def test_follow_notification_digest(self):
+        """Follows are mailed as one digest per user once the window is over."""
+        others = [
+            User.objects.create_user(email=f'f{i}@ex.com', username=f'f{i}', password='pass1234')
+            for i in range(3)
+        ]
+        start = time.time()
+        self.client.post(self.follow_url(self.u2.id), **self.auth(self.token1))
+        for i, follower in enumerate(others):
+            notifications.queue(follower.id, [self.u2.id], timestamp=start + i + 1)
+            Follow.objects.create(user=follower, following=self.u2)
+
+        # Nothing is sent within the window
+        self.assertEqual(notifications.flush(now=start), 0)
+        self.assertEqual(len(mail.outbox), 0)
+
+        self.assertEqual(notifications.flush(now=start + settings.FOLLOW_DIGEST_WINDOW + 10), 1)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, [self.u2.email])
+        self.assertIn('f2, f1 and 2 others followed you', mail.outbox[0].body)
+        # The follows are notified once
+        self.assertEqual(notifications.flush(now=start + settings.FOLLOW_DIGEST_WINDOW + 10), 0)
+
+    def test_follow_notification_partial_failure(self):
+        """Only the digests that failed are sent again, no connection is opened when nothing is due."""
+        with mock.patch('apps.follows.notifications.get_connection') as get_connection:
+            self.assertEqual(notifications.flush(), 0)
+        get_connection.assert_not_called()
+
+        self.client.post(self.follow_url(self.u2.id), **self.auth(self.token1))
+        self.client.post(self.follow_url(self.u1.id), **self.auth(self.token2))
+        now = time.time() + settings.FOLLOW_DIGEST_WINDOW
+
+        def send_messages(messages):
+            if messages[0].to == [self.u1.email]:
+                raise OSError('Connection reset')
+            mail.outbox.extend(messages)
+            return len(messages)
+
+        with mock.patch('apps.follows.notifications.get_connection') as get_connection:
+            get_connection.return_value.send_messages.side_effect = send_messages
+            with self.assertRaises(OSError):
+                notifications.flush(now=now)
+        get_connection.return_value.close.assert_called_once()
+        self.assertEqual([message.to for message in mail.outbox], [[self.u2.email]])
+
+        # The digest of u2 is not sent twice
+        self.assertEqual(notifications.flush(now=now), 1)
+        self.assertEqual([message.to for message in mail.outbox], [[self.u2.email], [self.u1.email]])
+
+    def test_unfollow_cancels_notification(self):
+        """An unfollow within the window cancels the notification."""
+        self.client.post(self.follow_url(self.u2.id), **self.auth(self.token1))
+        self.client.delete(self.unfollow_url(self.u2.id), **self.auth(self.token1))
+        self.assertEqual(notifications.flush(now=time.time() + settings.FOLLOW_DIGEST_WINDOW), 0)
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertFalse(get_redis_connection('default').exists(notifications.DUE_KEY))
+
+    def test_graph_cache(self):
+        """The graph sets are loaded on a miss and written through on follow and unfollow."""
+        u3 = User.objects.create_user(email='u3@ex.com', username='u3', password='pass1234')
+        Follow.objects.create(user=self.u1, following=self.u2)
+        Follow.objects.create(user=self.u2, following=self.u1)
+
+        # Loaded from the database with one query, then served from Redis
+        with self.assertNumQueries(1):
+            self.assertEqual(graph.following_ids(self.u1.id), {self.u2.id})
+        with self.assertNumQueries(0):
+            self.assertTrue(graph.is_following(self.u1.id, self.u2.id))
+            self.assertEqual(graph.followed_among(self.u1.id, [self.u2.id, u3.id]), {self.u2.id})
+
+        self.client.post(reverse('follow-bulk'), {'user_ids': [u3.id]}, format='json', **self.auth(self.token1))
+        self.client.delete(self.unfollow_url(self.u2.id), **self.auth(self.token1))
+        with self.assertNumQueries(0):
+            self.assertEqual(graph.following_ids(self.u1.id), {u3.id})
+        self.assertEqual(graph.follower_ids(u3.id), {self.u1.id})
+        # The follower set of u1 is not loaded, its count is the column, not updated by Follow.objects.create
+        self.assertEqual(graph.follower_counts([u3.id, self.u1.id]), {u3.id: 1, self.u1.id: 0})
+
+    def test_graph_mutuals(self):
+        """Mutual follows are the followers that are followed back."""
+        u3 = User.objects.create_user(email='u3@ex.com', username='u3', password='pass1234')
+        Follow.objects.create(user=self.u1, following=self.u2)
+        Follow.objects.create(user=self.u2, following=self.u1)
+        Follow.objects.create(user=u3, following=self.u1)
+        self.assertEqual(graph.mutual_ids(self.u1.id), {self.u2.id})
+        self.assertEqual(graph.mutual_ids(u3.id), set())
+
+    def test_graph_load_skips_set_created_meanwhile(self):
+        """Follows loaded from the database do not overwrite a set created since the load started."""
+        Follow.objects.create(user=self.u1, following=self.u2)
+        filter_follows = Follow.objects.filter
+
+        def unfollow_meanwhile(*args, **kwargs):
+            # Between the EXISTS check and the write of the loaded set, another
+            # request loads the set and u1 unfollows u2
+            get_redis_connection('default').sadd(graph.following_key(self.u1.id), graph.SENTINEL)
+            return filter_follows(*args, **kwargs)
+
+        with mock.patch.object(Follow.objects, 'filter', side_effect=unfollow_meanwhile):
+            self.assertEqual(graph.following_ids(self.u1.id), set())
+        ttl = get_redis_connection('default').ttl(graph.following_key(self.u1.id))
+        self.assertEqual(ttl, -1) # Left as the other request wrote it
+
+    def test_follow_with_stale_graph_cache(self):
+        """A stale graph set does not refuse a follow, the table decides."""
+        self.client.post(self.follow_url(self.u2.id), **self.auth(self.token1))
+        graph.following_ids(self.u1.id)
+        with mock.patch.object(Follow.objects, 'get_or_create') as get_or_create:
+            resp = self.client.post(self.follow_url(self.u2.id), **self.auth(self.token1))
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        get_or_create.assert_not_called() # Refused without a write
+
+        # The unfollow is not in the set, e.g. written through before a rollback
+        Follow.objects.filter(user=self.u1, following=self.u2).delete()
+        get_redis_connection('default').sadd(graph.following_key(self.u1.id), self.u2.id)
+        resp = self.client.post(self.follow_url(self.u2.id), **self.auth(self.token1))
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+
+    def test_suggestions(self):
+        """Friends of friends are suggested by number of mutuals and recent activity."""
+        u3, u4, u5, u6 = [
+            User.objects.create_user(email=f'u{i}@ex.com', username=f'u{i}', password='pass1234')
+            for i in range(3, 7)
+        ]
+        for user, following in [(self.u1, self.u2), (self.u1, u3), (self.u2, u4), (u3, u4),
+                                (self.u2, u5), (u3, u6), (u3, self.u1)]:
+            Follow.objects.create(user=user, following=following)
+        Post.objects.create(text='Recent post', author=u6)
+        self.assertEqual(compute_recommendations(), 3)
+
+        resp = self.client.get(reverse('follow-suggestions'), **self.auth(self.token1))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        # u4 has two mutuals, u6 is active, u1 itself is never suggested
+        self.assertEqual([(s['username'], s['mutual_count']) for s in resp.data], [('u4', 2), ('u6', 1), ('u5', 1)])
+
+        # Users followed since the computation are filtered out
+        self.client.post(self.follow_url(u4.id), **self.auth(self.token1))
+        resp = self.client.get(reverse('follow-suggestions'), **self.auth(self.token1))
+        self.assertEqual([s['username'] for s in resp.data], ['u6', 'u5'])
+
+    def test_suggestions_without_follows(self):
+        """Users who follow nobody are suggested the most followed users."""
+        u3 = User.objects.create_user(email='u3@ex.com', username='u3', password='pass1234')
+        User.objects.filter(pk=self.u2.id).update(follower_count=5)
+        User.objects.filter(pk=u3.id).update(follower_count=10)
+        compute_recommendations()
+        resp = self.client.get(reverse('follow-suggestions'), **self.auth(self.token1))
+        self.assertEqual([s['username'] for s in resp.data], ['u3', 'u2'])
+        # A user is not suggested to themselves
+        resp = self.client.get(reverse('follow-suggestions'), **self.auth(self.token2))
+        self.assertEqual([s['username'] for s in resp.data], ['u3'])
+
+    def test_follow_lists_pagination(self):
+        """The lists are paginated with a cursor, newest follows first, with the async and DRF views."""
+        followers = [
+            User.objects.create_user(email=f'f{i}@ex.com', username=f'f{i}', password='pass1234')
+            for i in range(5)
+        ]
+        for follower in followers:
+            Follow.objects.create(user=follower, following=self.u1)
+
+        for async_views in (True, False):
+            with self.settings(ASYNC_READ_VIEWS=async_views):
+                usernames, url = [], f'{self.list_folls}?limit=2'
+                while url:
+                    data = self.client.get(url, **self.auth(self.token1)).json()
+                    usernames += [user['username'] for user in data['results']]
+                    url = data['next']
+                self.assertEqual(usernames, ['f4', 'f3', 'f2', 'f1', 'f0'])
+
+                # A cursor with values of the wrong type is rejected
+                cursor = base64.urlsafe_b64encode(json.dumps(['abc', 1]).encode()).decode()
+                resp = self.client.get(self.list_folls, {'cursor': cursor}, **self.auth(self.token1))
+                self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_follow_list_export(self):
+        """The export streams the whole list as a JSON array."""
+        u3 = User.objects.create_user(email='u3@ex.com', username='u3', password='pass1234')
+        Follow.objects.create(user=self.u2, following=self.u1)
+        Follow.objects.create(user=u3, following=self.u1)
+        Follow.objects.create(user=self.u1, following=self.u2)
+        # Several chunks
+        with mock.patch('apps.follows.views.EXPORT_CHUNK_SIZE', 1):
+            resp = self.client.get(reverse('followers-export'), **self.auth(self.token1))
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            self.assertTrue(resp.streaming)
+            users = json.loads(b''.join(resp.streaming_content))
+        self.assertEqual([(user['id'], user['username']) for user in users], [(u3.id, 'u3'), (self.u2.id, 'u2')])
+        self.assertIn('followed_at', users[0])
+
+        resp = self.client.get(reverse('following-export'), **self.auth(self.token2))
+        self.assertEqual(json.loads(b''.join(resp.streaming_content))[0]['id'], self.u1.id)
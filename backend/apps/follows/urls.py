@@ -1,13 +1,23 @@
 from django.urls import path
+from config.async_views import async_read_view
 from .views import (
+    BulkFollowView,
+    FollowExportView,
     FollowUnfollowView,
     FollowersListView,
     FollowingListView,
+    SuggestionsView,
+    followers,
+    following,
 )
 
 urlpatterns = [
     path('follow/<int:user_id>/', FollowUnfollowView.as_view(), name='follow'), # Follow a user
     path('unfollow/<int:user_id>/', FollowUnfollowView.as_view(), name='unfollow'), # Unfollow a user
-    path('followers/', FollowersListView.as_view(), name='followers-list'), # List of users following the authenticated user
-    path('following/', FollowingListView.as_view(), name='following-list'), # List of users the authenticated user is following
+    path('bulk/', BulkFollowView.as_view(), name='follow-bulk'), # Follow or unfollow a list of users
+    path('suggestions/', SuggestionsView.as_view(), name='follow-suggestions'), # Users to follow
+    path('followers/', async_read_view(followers, FollowersListView.as_view()), name='followers-list'), # List of users following the authenticated user
+    path('following/', async_read_view(following, FollowingListView.as_view()), name='following-list'), # List of users the authenticated user is following
+    path('followers/export/', FollowExportView.as_view(follow_list='followers'), name='followers-export'), # Every follower, streamed
+    path('following/export/', FollowExportView.as_view(follow_list='following'), name='following-export'), # Every followed user, streamed
 ]
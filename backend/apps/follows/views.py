@@ -1,17 +1,33 @@
+import json
+
 from rest_framework import generics, permissions, status
+from rest_framework.request import Request
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from django.contrib.auth import get_user_model
-from .tasks import send_follow_notification
+from django.core.handlers.asgi import ASGIRequest
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models import F
+from django.db.models.functions import Greatest
+from django.http import JsonResponse, StreamingHttpResponse
+from apps.users import profiles
+from config.async_views import authenticate
+from config.db_router import ReplicaReadMixin, ause_replica
+from config.models import insert_ignore_conflicts
+from config.pagination import KeysetPagination
+from . import graph, notifications, recommendations
+from .tasks import rebuild_timeline
 
 from .models import Follow
-from .serializers import FollowSerializer, UserSerializer
+from .serializers import BulkFollowSerializer, FollowedUserSerializer, FollowSerializer, UserSerializer
 
 User = get_user_model()
 
 class FollowUnfollowView(APIView):
     """Follow or unfollow a user."""
     permission_classes = [permissions.IsAuthenticated]
+    query_budget = {'post': 11, 'delete': 8}
 
     def post(self, request, user_id):
         if request.user.id == user_id:
@@ -19,59 +35,245 @@ class FollowUnfollowView(APIView):
                 {'detail': 'You cannot follow yourself.'},
                 status=status.HTTP_400_BAD_REQUEST
             )
+        # The graph cache is only a hint (a set may be stale until it expires):
+        # an already followed user is refused without a write once the table agrees
+        if (graph.is_following(request.user.id, user_id)
+                and Follow.objects.filter(user=request.user, following_id=user_id).exists()):
+            return self.already_following()
         # Check if the user exists
         target = generics.get_object_or_404(User, pk=user_id)
 
-        # Check if the user is already followed
-        follow, created = Follow.objects.get_or_create(
-            user=request.user,
-            following=target
-        )
-        
+        # The cache may not have seen a concurrent follow yet
+        with transaction.atomic():
+            follow, created = Follow.objects.get_or_create(
+                user=request.user,
+                following=target
+            )
+            if created:
+                # Keep the denormalized counters in sync
+                User.objects.filter(pk=request.user.id).update(following_count=F('following_count') + 1)
+                User.objects.filter(pk=target.id).update(follower_count=F('follower_count') + 1)
+
         if created:
-            # Send notification to the target user
-            send_follow_notification.delay(request.user.id, target.id)
+            # Notify the target user in the next digest
+            notifications.queue(request.user.id, [target.id])
             # Return the follow object
             return Response(FollowSerializer(follow).data,
                             status=status.HTTP_201_CREATED)
 
-        # if the follow already exists, return a 400 error with a message
+        return self.already_following()
+
+    @staticmethod
+    def already_following():
         return Response(
             {'detail': 'You are already following this user.'},
             status=status.HTTP_400_BAD_REQUEST
         )
 
     def delete(self, request, user_id):
-        follow = Follow.objects.filter(
-            user=request.user,
-            following__id=user_id
-        ).first()
-        if not follow:
+        with transaction.atomic():
+            # Only the request that deletes the row updates the counters
+            deleted, _ = Follow.objects.filter(user=request.user, following__id=user_id).delete()
+            if deleted:
+                User.objects.filter(pk=request.user.id, following_count__gt=0).update(following_count=F('following_count') - 1)
+                User.objects.filter(pk=user_id, follower_count__gt=0).update(follower_count=F('follower_count') - 1)
+        if not deleted:
             return Response(
                 {'detail': 'You are not following this user.'},
                 status=status.HTTP_400_BAD_REQUEST
             )
-        follow.delete()
+        notifications.cancel(request.user.id, [user_id])
         return Response(status=status.HTTP_204_NO_CONTENT)
 
-class FollowersListView(generics.ListAPIView):
-    """List of users following the authenticated user."""
+class BulkFollowView(APIView):
+    """Follow (POST) or unfollow (DELETE) a list of users at once.
+    The body is {"user_ids": [...]}, the response gives the result of every id.
+    """
     permission_classes = [permissions.IsAuthenticated]
-    serializer_class  = UserSerializer
-    pagination_class  = None
+    query_budget = {'post': 9, 'delete': 9} # The timeline prune tasks run eagerly in the tests
+
+    def get_user_ids(self, request):
+        serializer = BulkFollowSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        return list(dict.fromkeys(serializer.validated_data['user_ids'])) # Unique, in order
+
+    def post(self, request):
+        user_ids = self.get_user_ids(request)
+        existing = set(User.objects.filter(pk__in=user_ids).values_list('id', flat=True))
+        with transaction.atomic():
+            already = set(
+                Follow.objects.filter(user=request.user, following_id__in=user_ids)
+                .values_list('following_id', flat=True)
+            )
+            candidates = [
+                user_id for user_id in user_ids
+                if user_id in existing and user_id not in already and user_id != request.user.id
+            ]
+            # A follow created concurrently is skipped and not counted
+            inserted = set(insert_ignore_conflicts(
+                Follow, [Follow(user=request.user, following_id=user_id) for user_id in candidates], 'following',
+            ))
+            new_ids = [user_id for user_id in candidates if user_id in inserted]
+            if new_ids:
+                User.objects.filter(pk=request.user.id).update(following_count=F('following_count') + len(new_ids))
+                User.objects.filter(pk__in=new_ids).update(follower_count=F('follower_count') + 1)
+
+        if new_ids:
+            # bulk_create does not send the post_save signals that update the graph, the profiles and backfill the timeline
+            graph.add(request.user.id, new_ids)
+            profiles.increment([
+                (request.user.id, 'following_count', len(new_ids)),
+                *((user_id, 'follower_count', 1) for user_id in new_ids),
+            ])
+            rebuild_timeline.delay(request.user.id)
+            notifications.queue(request.user.id, new_ids)
+
+        def result(user_id):
+            if user_id == request.user.id:
+                return 'self'
+            if user_id not in existing:
+                return 'not_found'
+            return 'followed' if user_id in inserted else 'already_following'
+        return Response({'results': [{'id': user_id, 'status': result(user_id)} for user_id in user_ids]})
+
+    def delete(self, request):
+        user_ids = self.get_user_ids(request)
+        with transaction.atomic():
+            follows = Follow.objects.filter(user=request.user, following_id__in=user_ids)
+            # Locked, so that a concurrent unfollow of the same users waits and
+            # then finds them gone, instead of decrementing the counters twice
+            followed = set(follows.select_for_update().values_list('following_id', flat=True))
+            if followed:
+                follows.delete()
+                User.objects.filter(pk=request.user.id).update(
+                    following_count=Greatest(F('following_count') - len(followed), 0)
+                )
+                User.objects.filter(pk__in=followed, follower_count__gt=0).update(follower_count=F('follower_count') - 1)
+        notifications.cancel(request.user.id, followed)
+        return Response({'results': [
+            {'id': user_id, 'status': 'unfollowed' if user_id in followed else 'not_following'}
+            for user_id in user_ids
+        ]})
+
+class SuggestionsView(APIView):
+    """Users suggested to the authenticated user, precomputed by the compute_recommendations task."""
+    permission_classes = [permissions.IsAuthenticated]
+    query_budget = 2
+
+    def get(self, request):
+        return Response(recommendations.suggestions(request.user.id))
+
+# Lookup of the users of each list, and relation to the Follow row of each user
+FOLLOW_LISTS = {
+    'followers': ('following__following', 'following'),
+    'following': ('followers__user', 'followers'),
+}
+FOLLOW_LIST_ASYNC_PARAMS = {'cursor', 'limit'} # The offset fallback needs the DRF view
+EXPORT_CHUNK_SIZE = 2000 # Users fetched and sent per chunk of an export
+
+def follow_list(kind, user):
+    """
+    Users of the followers or following list of a user, annotated with the
+    date and the id of the follow, with a single joined query.
+    """
+    lookup, relation = FOLLOW_LISTS[kind]
+    return (
+        User.objects.filter(**{lookup: user.pk}) # The user may be a stateless TokenUser
+        .annotate(followed_at=F(f'{relation}__created_at'), follow_id=F(f'{relation}__id'))
+        .only(*UserSerializer.Meta.fields)
+    )
+
+class FollowPagination(KeysetPagination):
+    """Cursor pagination of the followers/following lists, newest follows first."""
+    ordering = ('-followed_at', '-follow_id')
+
+class FollowersListView(ReplicaReadMixin, generics.ListAPIView):
+    """List of users following the authenticated user, newest follows first."""
+    permission_classes = [permissions.IsAuthenticated]
+    serializer_class  = FollowedUserSerializer
+    pagination_class  = FollowPagination
+    query_budget = 2
 
     def get_queryset(self):
-        return User.objects.filter(
-            following__following=self.request.user
-        )
+        return follow_list('followers', self.request.user)
 
-class FollowingListView(generics.ListAPIView):
-    """List of users the authenticated user is following."""
+class FollowingListView(ReplicaReadMixin, generics.ListAPIView):
+    """List of users the authenticated user is following, newest follows first."""
     permission_classes = [permissions.IsAuthenticated]
-    serializer_class  = UserSerializer
-    pagination_class  = None
+    serializer_class  = FollowedUserSerializer
+    pagination_class  = FollowPagination
+    query_budget = 2
 
     def get_queryset(self):
-        return User.objects.filter(
-            followers__user=self.request.user
+        return follow_list('following', self.request.user)
+
+def _json_chunk(rows, first):
+    data = ','.join(json.dumps(row, cls=DjangoJSONEncoder) for row in rows)
+    return data if first else ',' + data
+
+def _json_array(rows):
+    """Rows of a queryset as a JSON array, fetched and sent in chunks."""
+    yield '['
+    chunk, first = [], True
+    for row in rows.iterator(chunk_size=EXPORT_CHUNK_SIZE):
+        chunk.append(row)
+        if len(chunk) == EXPORT_CHUNK_SIZE:
+            yield _json_chunk(chunk, first)
+            chunk, first = [], False
+    if chunk:
+        yield _json_chunk(chunk, first)
+    yield ']'
+
+async def _ajson_array(rows):
+    yield '['
+    chunk, first = [], True
+    async for row in rows.aiterator(chunk_size=EXPORT_CHUNK_SIZE):
+        chunk.append(row)
+        if len(chunk) == EXPORT_CHUNK_SIZE:
+            yield _json_chunk(chunk, first)
+            chunk, first = [], False
+    if chunk:
+        yield _json_chunk(chunk, first)
+    yield ']'
+
+class FollowExportView(APIView):
+    """
+    Whole followers or following list of the authenticated user, as a JSON
+    array streamed in chunks, so that memory stays flat whatever its size.
+    """
+    permission_classes = [permissions.IsAuthenticated]
+    query_budget = 1 # The rows are fetched while the response is streamed
+    follow_list = None # 'followers' or 'following', set by as_view()
+
+    def get(self, request):
+        rows = (
+            follow_list(self.follow_list, request.user)
+            .order_by(*FollowPagination.ordering)
+            .values(*FollowedUserSerializer.Meta.fields)
         )
+        # Django consumes a sync iterator whole under ASGI, and an async one under WSGI
+        if isinstance(request._request, ASGIRequest):
+            content = _ajson_array(rows)
+        else:
+            content = _json_array(rows)
+        return StreamingHttpResponse(content, content_type='application/json')
+
+async def _user_list(request, kind):
+    if not set(request.GET) <= FOLLOW_LIST_ASYNC_PARAMS:
+        return None
+    user = await authenticate(request)
+    if user is None:
+        return None # The DRF view answers 401
+    await ause_replica(user)
+    request = Request(request) # query_params and build_absolute_uri for the pagination
+    paginator = FollowPagination()
+    page = await paginator.apaginate_queryset(follow_list(kind, user), request)
+    return JsonResponse(paginator.get_paginated_data(FollowedUserSerializer(page, many=True).data))
+
+async def followers(request):
+    """Async version of FollowersListView, see config/async_views.py."""
+    return await _user_list(request, 'followers')
+
+async def following(request):
+    """Async version of FollowingListView, see config/async_views.py."""
+    return await _user_list(request, 'following')
@@ -0,0 +1,389 @@
+"""
+Like engines.
+
+The engine records likes and answers "how many likes" for the views and
+serializers. It is selected with settings.LIKES_ENGINE:
+
+- ``database``: likes are rows of the Like table, counts are the
+  denormalized Post.like_count column.
+- ``redis``: likes are recorded in a Redis set per post and the Like table is
+  written behind by the ``flush_likes`` task. This avoids the contention on the
+  unique index of the Like table when a post goes viral.
+
+The read methods have async twins (``alike_counts``, ``aliked_post_ids``) for
+the async views.
+"""
+from functools import reduce
+from operator import or_
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from django_redis import get_redis_connection
+
+from apps.posts.models import Post
+from apps.users import profiles
+from config.async_views import get_redis
+from config.models import insert_ignore_conflicts
+from . import likers
+from .models import Like
+
+
+class DatabaseLikeEngine:
+    """Likes stored directly in the Like table."""
+    live_counts = False # Post.like_count is always up to date
+
+    def like(self, user_id, post_id):
+        """
+        Like a post, return (like, created) like get_or_create.
+        Raise Post.DoesNotExist if the post does not exist.
+        """
+        with transaction.atomic():
+            # The foreign key is only checked at commit, after the signals of
+            # the like: lock the post so that it exists until then
+            if not Post.objects.select_for_update().filter(pk=post_id).exists():
+                raise Post.DoesNotExist
+            like, created = Like.objects.get_or_create(user_id=user_id, post_id=post_id)
+            if created:
+                # Keep the denormalized counter in sync
+                Post.objects.filter(pk=post_id).update(like_count=F('like_count') + 1)
+        return like, created
+
+    def unlike(self, user_id, post_id):
+        """
+        Unlike a post, return False if it was not liked.
+        Raise Post.DoesNotExist if the post does not exist.
+        """
+        with transaction.atomic():
+            # Only the request that deletes the row updates the counter
+            deleted, _ = Like.objects.filter(user_id=user_id, post_id=post_id).delete()
+            if deleted:
+                Post.objects.filter(pk=post_id, like_count__gt=0).update(like_count=F('like_count') - 1)
+        if not deleted and not Post.objects.filter(pk=post_id).exists():
+            raise Post.DoesNotExist
+        return bool(deleted)
+
+    def like_many(self, user_id, post_ids):
+        """
+        Like several posts in one transaction. Return the ids of the posts
+        liked by this call and the ids of the posts that do not exist.
+        """
+        from apps.posts import feed_cache
+
+        existing = set(Post.objects.filter(id__in=post_ids).values_list('id', flat=True))
+        with transaction.atomic():
+            liked = set(self.liked_post_ids(user_id, existing))
+            # A like created concurrently is skipped and not counted
+            created = insert_ignore_conflicts(
+                Like, [Like(user_id=user_id, post_id=post_id) for post_id in existing if post_id not in liked], 'post',
+            )
+            Post.objects.filter(id__in=created).update(like_count=F('like_count') + 1)
+        if created:
+            # bulk_create does not send the post_save signals of like_changed, like_saved and the profiles
+            feed_cache.expire(user_id)
+            likers.expire((post_id, user_id, True) for post_id in created)
+            profiles.increment([(user_id, 'like_count', len(created))])
+        return set(created), set(post_ids) - existing
+
+    def unlike_many(self, user_id, post_ids):
+        """Unlike several posts in one transaction, return the ids of the posts unliked."""
+        with transaction.atomic():
+            # Locked, so that a concurrent unlike of the same posts waits and
+            # then finds them gone, instead of decrementing the counters twice
+            unliked = set(
+                Like.objects.select_for_update().filter(user_id=user_id, post_id__in=post_ids)
+                .values_list('post_id', flat=True)
+            )
+            if unliked:
+                Like.objects.filter(user_id=user_id, post_id__in=unliked).delete()
+                Post.objects.filter(id__in=unliked, like_count__gt=0).update(like_count=F('like_count') - 1)
+        return unliked
+
+    def like_counts(self, post_ids):
+        """Number of likes of each post, as a dict."""
+        return dict(Post.objects.filter(id__in=post_ids).values_list('id', 'like_count'))
+
+    async def alike_counts(self, post_ids):
+        return {
+            post_id: count
+            async for post_id, count in Post.objects.filter(id__in=post_ids).values_list('id', 'like_count')
+        }
+
+    def liked_post_ids(self, user_id, post_ids):
+        """Ids of the posts, among post_ids, liked by a user."""
+        return set(
+            Like.objects.filter(user_id=user_id, post_id__in=post_ids)
+            .values_list('post_id', flat=True)
+        )
+
+    async def aliked_post_ids(self, user_id, post_ids):
+        return {
+            post_id
+            async for post_id in Like.objects.filter(user_id=user_id, post_id__in=post_ids)
+            .values_list('post_id', flat=True)
+        }
+
+
+class RedisLikeEngine:
+    """
+    Likes stored in Redis and written behind to the Like table.
+
+    Every post has a set with the ids of the users who liked it, plus a
+    sentinel member ``0`` so that a post without likes still has a set. The
+    sets are loaded from the Like table on first use. Every change adds the
+    ``post_id:user_id`` pair to a dirty set, that the flush applies to the Like
+    table according to the state of the Redis set at flush time.
+    """
+    live_counts = True # Post.like_count lags until the next flush
+    SENTINEL = 0
+    DIRTY_KEY = 'likes:dirty'
+    PROCESSING_KEY = 'likes:processing'
+
+    # Atomically move up to ARGV[1] members from the dirty set to the processing set
+    MOVE_BATCH_SCRIPT = """
+    local members = redis.call('SPOP', KEYS[1], ARGV[1])
+    if #members > 0 then
+        redis.call('SADD', KEYS[2], unpack(members))
+    end
+    return members
+    """
+
+    # Create the likers set KEYS[1] with the members ARGV[2...] and the TTL
+    # ARGV[1], unless it was created since the caller saw it missing: a like or
+    # unlike recorded meanwhile is newer than the rows loaded from the database.
+    LOAD_SCRIPT = """
+    if redis.call('EXISTS', KEYS[1]) == 1 then
+        return 0
+    end
+    for i = 2, #ARGV, 1000 do
+        redis.call('SADD', KEYS[1], unpack(ARGV, i, math.min(i + 999, #ARGV)))
+    end
+    redis.call('EXPIRE', KEYS[1], ARGV[1])
+    return 1
+    """
+
+    def __init__(self):
+        self.conn = get_redis_connection('default')
+
+    @staticmethod
+    def likers_key(post_id):
+        """Redis key of the set of users who liked a post."""
+        return f'likes:post:{post_id}'
+
+    def ensure_loaded(self, post_id):
+        """
+        Load the likers of a post from the database if they are not in Redis.
+        Raise Post.DoesNotExist if the post does not exist.
+        """
+        if self.ensure_loaded_many([post_id]):
+            raise Post.DoesNotExist
+
+    def ensure_loaded_many(self, post_ids):
+        """
+        Load the likers of the posts that are not in Redis, with one query.
+        Return the ids of the posts that do not exist.
+        """
+        post_ids = list(post_ids)
+        pipe = self.conn.pipeline(transaction=False)
+        for post_id in post_ids:
+            pipe.exists(self.likers_key(post_id))
+        not_loaded = [post_id for post_id, exists in zip(post_ids, pipe.execute()) if not exists]
+        if not not_loaded:
+            return set()
+        existing = set(Post.objects.filter(id__in=not_loaded).values_list('id', flat=True))
+        liker_ids = {post_id: [] for post_id in existing}
+        for post_id, user_id in Like.objects.filter(post_id__in=existing).values_list('post_id', 'user_id'):
+            liker_ids[post_id].append(user_id)
+        load = self.conn.register_script(self.LOAD_SCRIPT)
+        pipe = self.conn.pipeline()
+        for post_id, user_ids in liker_ids.items():
+            load(keys=[self.likers_key(post_id)], args=[settings.LIKES_REDIS_TTL, self.SENTINEL, *user_ids], client=pipe)
+        pipe.execute()
+        return set(not_loaded) - existing
+
+    def _record(self, user_id, post_ids, liked):
+        """
+        Record likes or unlikes of a user. Return the ids of the posts whose
+        state changed and the ids of the posts that do not exist.
+        """
+        from apps.posts import feed_cache
+
+        missing = self.ensure_loaded_many(post_ids)
+        post_ids = [post_id for post_id in post_ids if post_id not in missing]
+        if not post_ids:
+            return set(), missing
+        pipe = self.conn.pipeline()
+        for post_id in post_ids:
+            key = self.likers_key(post_id)
+            if liked:
+                pipe.sadd(key, user_id)
+            else:
+                pipe.srem(key, user_id)
+            # The TTL is renewed on every change, so a set never expires before it is flushed
+            pipe.expire(key, settings.LIKES_REDIS_TTL)
+        pipe.sadd(self.DIRTY_KEY, *(f'{post_id}:{user_id}' for post_id in post_ids))
+        results = pipe.execute()
+        changed = {post_id for post_id, result in zip(post_ids, results[::2]) if result}
+        if changed:
+            # No Like row is written yet, so the like_changed signal does not fire
+            feed_cache.expire(user_id)
+        return changed, missing
+
+    def like(self, user_id, post_id):
+        changed, missing = self._record(user_id, [post_id], liked=True)
+        if missing:
+            raise Post.DoesNotExist
+        return Like(user_id=user_id, post_id=post_id, created_at=timezone.now()), bool(changed)
+
+    def unlike(self, user_id, post_id):
+        changed, missing = self._record(user_id, [post_id], liked=False)
+        if missing:
+            raise Post.DoesNotExist
+        return bool(changed)
+
+    def like_many(self, user_id, post_ids):
+        return self._record(user_id, list(post_ids), liked=True)
+
+    def unlike_many(self, user_id, post_ids):
+        return self._record(user_id, list(post_ids), liked=False)[0]
+
+    def _queue_like_counts(self, pipe, post_ids):
+        for post_id in post_ids:
+            pipe.scard(self.likers_key(post_id))
+
+    def _parse_like_counts(self, post_ids, sizes):
+        """Counts of the posts in Redis, and the posts not in Redis."""
+        counts, missing = {}, []
+        for post_id, size in zip(post_ids, sizes):
+            if size:
+                counts[post_id] = size - 1 # Do not count the sentinel
+            else:
+                missing.append(post_id)
+        return counts, missing
+
+    def like_counts(self, post_ids):
+        post_ids = list(post_ids)
+        pipe = self.conn.pipeline(transaction=False)
+        self._queue_like_counts(pipe, post_ids)
+        counts, missing = self._parse_like_counts(post_ids, pipe.execute())
+        if missing:
+            # Posts not in Redis have no pending change, the column is exact
+            counts.update(DatabaseLikeEngine().like_counts(missing))
+        return counts
+
+    async def alike_counts(self, post_ids):
+        post_ids = list(post_ids)
+        pipe = get_redis().pipeline(transaction=False)
+        self._queue_like_counts(pipe, post_ids)
+        counts, missing = self._parse_like_counts(post_ids, await pipe.execute())
+        if missing:
+            counts.update(await DatabaseLikeEngine().alike_counts(missing))
+        return counts
+
+    def _queue_liked(self, pipe, user_id, post_ids):
+        for post_id in post_ids:
+            pipe.exists(self.likers_key(post_id))
+            pipe.sismember(self.likers_key(post_id), user_id)
+
+    def _parse_liked(self, post_ids, states):
+        """Posts liked according to Redis, and the posts not in Redis."""
+        liked, missing = set(), []
+        for index, post_id in enumerate(post_ids):
+            exists, is_member = states[2 * index], states[2 * index + 1]
+            if not exists:
+                missing.append(post_id)
+            elif is_member:
+                liked.add(post_id)
+        return liked, missing
+
+    def liked_post_ids(self, user_id, post_ids):
+        post_ids = list(post_ids)
+        pipe = self.conn.pipeline(transaction=False)
+        self._queue_liked(pipe, user_id, post_ids)
+        liked, missing = self._parse_liked(post_ids, pipe.execute())
+        if missing:
+            # Posts not in Redis have no pending change, the table is exact
+            liked |= DatabaseLikeEngine().liked_post_ids(user_id, missing)
+        return liked
+
+    async def aliked_post_ids(self, user_id, post_ids):
+        post_ids = list(post_ids)
+        pipe = get_redis().pipeline(transaction=False)
+        self._queue_liked(pipe, user_id, post_ids)
+        liked, missing = self._parse_liked(post_ids, await pipe.execute())
+        if missing:
+            liked |= await DatabaseLikeEngine().aliked_post_ids(user_id, missing)
+        return liked
+
+    def flush(self, batch_size):
+        """
+        Write a batch of changes to the Like table, return the number of
+        changes written.
+
+        The batch is moved to a processing set and only removed from it once
+        the database transaction is committed, so a crashed flush is resumed
+        by the next one. Applying a batch twice is harmless: the state written
+        is the one of the Redis sets. Only the members read by this flush are
+        removed, an overlapping flush may have moved the next batch in.
+        """
+        members = self.conn.smembers(self.PROCESSING_KEY)
+        if not members:
+            move_batch = self.conn.register_script(self.MOVE_BATCH_SCRIPT)
+            members = move_batch(keys=[self.DIRTY_KEY, self.PROCESSING_KEY], args=[batch_size])
+        if not members:
+            return 0
+
+        pairs = [tuple(int(part) for part in member.decode().split(':')) for member in members]
+        pipe = self.conn.pipeline(transaction=False)
+        for post_id, user_id in pairs:
+            pipe.exists(self.likers_key(post_id))
+            pipe.sismember(self.likers_key(post_id), user_id)
+        states = pipe.execute()
+
+        liked, unliked = [], []
+        for index, pair in enumerate(pairs):
+            exists, is_member = states[2 * index], states[2 * index + 1]
+            if exists:
+                (liked if is_member else unliked).append(pair)
+
+        post_ids = {post_id for post_id, _ in pairs}
+        user_ids = {user_id for _, user_id in liked}
+        with transaction.atomic():
+            # Posts and users deleted since the like was recorded are skipped
+            existing = set(Post.objects.filter(id__in=post_ids).values_list('id', flat=True))
+            users = set(get_user_model().objects.filter(id__in=user_ids).values_list('id', flat=True))
+            Like.objects.bulk_create(
+                [
+                    Like(post_id=post_id, user_id=user_id) for post_id, user_id in liked
+                    if post_id in existing and user_id in users
+                ],
+                ignore_conflicts=True,
+            )
+            if unliked:
+                Like.objects.filter(reduce(or_, (
+                    Q(post_id=post_id, user_id=user_id) for post_id, user_id in unliked
+                ))).delete()
+            counts = self.like_counts(existing)
+            Post.objects.bulk_update(
+                [Post(id=post_id, like_count=count) for post_id, count in counts.items()],
+                ['like_count'],
+            )
+        self.conn.srem(self.PROCESSING_KEY, *members)
+        # The deleted likes sent post_delete, the created ones did not
+        likers.expire((post_id, user_id, True) for post_id, user_id in liked)
+        # A like of the batch may already be in the table, the counts are reloaded
+        profiles.expire({user_id for _, user_id in liked})
+        return len(pairs)
+
+
+ENGINES = {
+    'database': DatabaseLikeEngine,
+    'redis': RedisLikeEngine,
+}
+
+
+def get_like_engine():
+    """Return the like engine selected by settings.LIKES_ENGINE."""
+    return ENGINES[settings.LIKES_ENGINE]()
@@ -0,0 +1,90 @@
+"""
+Likers preview.
+
+Posts embed the first LIKERS_PREVIEW_SIZE users who liked them ("liked by
+alice, bob..."), read from the Like table and cached per post. The first
+likers of a post rarely change: a preview is only expired when a like is
+added to a post whose preview is not full yet, or when one of its likers
+unlikes the post.
+
+With the redis like engine the previews follow the Like table, so they are
+updated when the likes are flushed.
+"""
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import F
+from django.db.models.functions import RowNumber
+from django.db.models.expressions import Window
+
+from .models import Like
+
+
+def preview_key(post_id):
+    """Cache key of the likers preview of a post."""
+    return f'likes:preview:{post_id}'
+
+
+def _load(post_ids):
+    """Load the previews of posts from the database, with one query."""
+    first_likes = (
+        Like.objects.filter(post_id__in=post_ids)
+        .annotate(rank=Window(
+            RowNumber(), partition_by=[F('post_id')], order_by=[F('created_at').asc(), F('id').asc()],
+        ))
+        .filter(rank__lte=settings.LIKERS_PREVIEW_SIZE)
+        .order_by('post_id', 'rank')
+        .values_list('post_id', 'user_id', 'user__username')
+    )
+    previews = {post_id: [] for post_id in post_ids}
+    for post_id, user_id, username in first_likes:
+        previews[post_id].append({'id': user_id, 'username': username})
+    cache.set_many(
+        {preview_key(post_id): preview for post_id, preview in previews.items()},
+        settings.LIKERS_PREVIEW_TTL,
+    )
+    return previews
+
+
+def previews(post_ids):
+    """Likers preview of each post, as a dict."""
+    post_ids = list(post_ids)
+    if not post_ids:
+        return {}
+    cached = cache.get_many([preview_key(post_id) for post_id in post_ids])
+    result = {post_id: cached[preview_key(post_id)] for post_id in post_ids if preview_key(post_id) in cached}
+    missing = [post_id for post_id in post_ids if post_id not in result]
+    if missing:
+        result.update(_load(missing))
+    return result
+
+
+async def apreviews(post_ids):
+    post_ids = list(post_ids)
+    if not post_ids:
+        return {}
+    cached = await cache.aget_many([preview_key(post_id) for post_id in post_ids])
+    result = {post_id: cached[preview_key(post_id)] for post_id in post_ids if preview_key(post_id) in cached}
+    missing = [post_id for post_id in post_ids if post_id not in result]
+    if missing:
+        result.update(await sync_to_async(_load)(missing))
+    return result
+
+
+def expire(changes):
+    """Expire the previews changed by likes, given as (post_id, user_id, liked) tuples."""
+    changes = list(changes)
+    if not changes:
+        return
+    cached = cache.get_many({preview_key(post_id) for post_id, _, _ in changes})
+    stale = set()
+    for post_id, user_id, liked in changes:
+        preview = cached.get(preview_key(post_id))
+        if preview is None:
+            continue
+        if liked and len(preview) < settings.LIKERS_PREVIEW_SIZE:
+            stale.add(preview_key(post_id))
+        elif not liked and any(liker['id'] == user_id for liker in preview):
+            stale.add(preview_key(post_id))
+    if stale:
+        cache.delete_many(stale)
@@ -0,0 +1,20 @@
+# Generated by Django 5.2 on 2026-10-18 19:34
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('likes', '0001_initial'),
+        ('posts', '0003_post_author_created_idx'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='like',
+            index=models.Index(fields=['post', '-created_at', '-id'], name='like_post_created_idx'),
+        ),
+    ]
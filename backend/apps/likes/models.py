@@ -18,6 +18,10 @@ class Like(models.Model):
     class Meta:
         unique_together = ('user', 'post')
         ordering = ['-created_at']
+        indexes = [
+            # Newest likes of a post, with id as tie breaker for keyset pagination
+            models.Index(fields=['post', '-created_at', '-id'], name='like_post_created_idx'),
+        ]
 
     def __str__(self):
         return f'{self.user} likes {self.post.id}'
@@ -1,9 +1,29 @@
+from django.conf import settings
 from rest_framework import serializers
+from config.metrics import TimedSerializerMixin
 from .models import Like
 
-class LikeSerializer(serializers.ModelSerializer):
+class LikeSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     """Serializer for the Like model"""
     class Meta:
         model  = Like
         fields = ('id', 'post', 'created_at')
         read_only_fields = ('id', 'created_at')
+
+class LikerSerializer(TimedSerializerMixin, serializers.ModelSerializer):
+    """Compact summary of a user who liked a post"""
+    id       = serializers.IntegerField(source='user_id', read_only=True)
+    username = serializers.CharField(source='user.username', read_only=True)
+    liked_at = serializers.DateTimeField(source='created_at', read_only=True)
+
+    class Meta:
+        model  = Like
+        fields = ('id', 'username', 'liked_at')
+
+class BulkLikeSerializer(serializers.Serializer):
+    """Ids of the posts to like or unlike at once"""
+    post_ids = serializers.ListField(
+        child=serializers.IntegerField(min_value=1),
+        allow_empty=False,
+        max_length=settings.BULK_MAX_ITEMS,
+    )
@@ -0,0 +1,21 @@
+"""
+Keep the likers previews in sync with the Like table, whatever code path
+(API, admin, shell) writes it. bulk_create sends no signal, its callers
+expire the previews themselves.
+"""
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from . import likers
+from .models import Like
+
+
+@receiver(post_save, sender=Like)
+def like_saved(sender, instance, created, **kwargs):
+    if created:
+        likers.expire([(instance.post_id, instance.user_id, True)])
+
+
+@receiver(post_delete, sender=Like)
+def like_deleted(sender, instance, **kwargs):
+    likers.expire([(instance.post_id, instance.user_id, False)])
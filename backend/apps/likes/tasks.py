@@ -0,0 +1,20 @@
+from celery import shared_task
+from django.conf import settings
+
+FLUSH_MAX_BATCHES = 100 # Batches written per run, the next run picks up the rest
+
+@shared_task
+def flush_likes():
+    """Write the likes recorded in Redis to the Like table (redis like engine only)."""
+    from .engine import RedisLikeEngine, get_like_engine
+
+    engine = get_like_engine()
+    if not isinstance(engine, RedisLikeEngine):
+        return 0
+    written = 0
+    for _ in range(FLUSH_MAX_BATCHES):
+        count = engine.flush(settings.LIKES_FLUSH_BATCH_SIZE)
+        if not count:
+            break
+        written += count
+    return written
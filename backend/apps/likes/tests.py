@@ -1,15 +1,26 @@
+from unittest import mock
 from django.urls import reverse
 from rest_framework import status
 from rest_framework.test import APITestCase
 from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import DatabaseError
+from django.test import override_settings
 
 from apps.posts.models import Post
+from apps.posts.tasks import reconcile_like_counts
 from apps.likes.models import Like
+from apps.likes import likers
+from apps.likes.engine import DatabaseLikeEngine, RedisLikeEngine
+from apps.likes.tasks import flush_likes
 
 User = get_user_model()
 
 class LikeTests(APITestCase):
     def setUp(self):
+        # Start with an empty Redis
+        cache.clear()
+
         # Create two users and a post
         self.u1 = User.objects.create_user(email='u1@ex.com', username='u1', password='pass1234')
         self.u2 = User.objects.create_user(email='u2@ex.com', username='u2', password='pass1234')
@@ -55,12 +66,243 @@ class LikeTests(APITestCase):
         self.assertFalse(Like.objects.filter(user=self.u2, post=self.post).exists())
 
     def test_list_likes(self):
-        """Anyone can list the likes of a post"""
+        """Anyone can list the likes of a post, newest first, paginated with a cursor"""
         # Create multiple likes
-        Like.objects.create(user=self.u1, post=self.post)
-        Like.objects.create(user=self.u2, post=self.post)
+        likes = [Like.objects.create(user=user, post=self.post) for user in (self.u1, self.u2)]
 
         r = self.client.get(self.list_likes)
         self.assertEqual(r.status_code, status.HTTP_200_OK)
         # Should return two like objects
-        self.assertEqual(len(r.data), 2)
+        self.assertEqual(len(r.json()['results']), 2)
+
+        for async_views in (True, False):
+            with self.settings(ASYNC_READ_VIEWS=async_views):
+                ids, url = [], f'{self.list_likes}?limit=1'
+                while url:
+                    data = self.client.get(url).json()
+                    ids += [like['id'] for like in data['results']]
+                    url = data['next']
+                self.assertEqual(ids, [likes[1].id, likes[0].id])
+        self.assertEqual(set(data['results'][0]), {'id', 'post', 'created_at'})
+
+    def test_like_count_counter(self):
+        """Like and unlike keep the like_count column of the post in sync"""
+        self.client.post(self.like_url, **self.auth(self.token2))
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.like_count, 1)
+
+        self.client.delete(self.unlike_url, **self.auth(self.token2))
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.like_count, 0)
+
+    def test_full_save_keeps_like_count(self):
+        """Saving a post loaded before a like does not write back its old like_count"""
+        stale = Post.objects.get(pk=self.post.pk)
+        self.client.post(self.like_url, **self.auth(self.token2))
+        stale.text = 'Edited'
+        stale.save()
+        self.post.refresh_from_db()
+        self.assertEqual((self.post.text, self.post.like_count), ('Edited', 1))
+
+    def test_reconcile_like_counts(self):
+        """The reconciliation task fixes counters that drifted"""
+        # Likes created without the view do not update the counter
+        Like.objects.create(user=self.u1, post=self.post)
+        Like.objects.create(user=self.u2, post=self.post)
+        self.assertEqual(reconcile_like_counts(), 1)
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.like_count, 2)
+        # Nothing left to fix
+        self.assertEqual(reconcile_like_counts(), 0)
+
+    @override_settings(LIKES_ENGINE='redis')
+    def test_redis_engine_writes_behind(self):
+        """With the redis engine likes are served from Redis and flushed to the database"""
+        Like.objects.create(user=self.u1, post=self.post)
+        r1 = self.client.post(self.like_url, **self.auth(self.token2))
+        self.assertEqual(r1.status_code, status.HTTP_201_CREATED)
+        # Duplicates are detected before the flush
+        r2 = self.client.post(self.like_url, **self.auth(self.token2))
+        self.assertEqual(r2.status_code, status.HTTP_400_BAD_REQUEST)
+        # u1's like was loaded from the database
+        r3 = self.client.delete(self.unlike_url, **self.auth(self.token1))
+        self.assertEqual(r3.status_code, status.HTTP_204_NO_CONTENT)
+
+        # Counts come from Redis, the database is behind
+        self.assertEqual(RedisLikeEngine().like_counts([self.post.id]), {self.post.id: 1})
+        self.assertTrue(Like.objects.filter(user=self.u1).exists())
+        self.assertFalse(Like.objects.filter(user=self.u2).exists())
+
+        self.assertEqual(flush_likes(), 2)
+        self.assertEqual(list(Like.objects.values_list('user_id', flat=True)), [self.u2.id])
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.like_count, 1)
+
+    @override_settings(LIKES_ENGINE='redis')
+    def test_redis_engine_flush_recovers_from_crash(self):
+        """A flush that crashes is resumed by the next one, without losing likes"""
+        self.client.post(self.like_url, **self.auth(self.token1))
+        self.client.post(self.like_url, **self.auth(self.token2))
+
+        # The worker crashes while writing the batch
+        with mock.patch.object(Like.objects, 'bulk_create', side_effect=DatabaseError('crash')):
+            with self.assertRaises(DatabaseError):
+                flush_likes()
+        self.assertEqual(Like.objects.count(), 0)
+
+        # Meanwhile u1 unlikes the post
+        self.client.delete(self.unlike_url, **self.auth(self.token1))
+
+        # The next flushes converge to the state recorded in Redis
+        flush_likes()
+        flush_likes()
+        self.assertEqual(list(Like.objects.values_list('user_id', flat=True)), [self.u2.id])
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.like_count, 1)
+        self.assertEqual(flush_likes(), 0)
+
+    @override_settings(LIKES_ENGINE='redis')
+    def test_redis_engine_overlapping_flushes(self):
+        """A flush only removes its own batch from the processing set, not one moved in by another flush"""
+        self.client.post(self.like_url, **self.auth(self.token1))
+        first, second = RedisLikeEngine(), RedisLikeEngine()
+        like_counts = first.like_counts
+
+        def overlap(post_ids):
+            # While the first flush writes u1's like, u2 likes the post and a
+            # second flush moves that change in, then is still writing it
+            self.client.post(self.like_url, **self.auth(self.token2))
+            second.flush(100) # The batch of the first flush, applied twice
+            with mock.patch.object(Like.objects, 'bulk_create', side_effect=DatabaseError('in progress')):
+                with self.assertRaises(DatabaseError):
+                    second.flush(100)
+            return like_counts(post_ids)
+
+        with mock.patch.object(first, 'like_counts', side_effect=overlap):
+            self.assertEqual(first.flush(100), 1)
+        self.assertEqual(flush_likes(), 1) # u2's like was not dropped
+        self.assertEqual(set(Like.objects.values_list('user_id', flat=True)), {self.u1.id, self.u2.id})
+
+    @override_settings(LIKES_ENGINE='redis')
+    def test_redis_engine_load_skips_set_created_meanwhile(self):
+        """Likers loaded from the database do not overwrite a set created since the load started"""
+        Like.objects.create(user=self.u1, post=self.post)
+        engine = RedisLikeEngine()
+        filter_likes = Like.objects.filter
+
+        def unlike_meanwhile(*args, **kwargs):
+            # Between the EXISTS check and the write of the loaded set, another
+            # request loads the set and u1 unlikes the post
+            engine.conn.sadd(engine.likers_key(self.post.id), engine.SENTINEL)
+            return filter_likes(*args, **kwargs)
+
+        with mock.patch.object(Like.objects, 'filter', side_effect=unlike_meanwhile):
+            engine.ensure_loaded(self.post.id)
+        self.assertEqual(engine.liked_post_ids(self.u1.id, [self.post.id]), set())
+
+    def test_unknown_post(self):
+        """Liking or unliking a post that does not exist returns 404"""
+        url = reverse('post-like', args=[self.post.id + 1000])
+        with self.captureOnCommitCallbacks(execute=True):
+            r = self.client.post(url, **self.auth(self.token2))
+        self.assertEqual(r.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertFalse(Like.objects.exists())
+        r = self.client.delete(reverse('post-unlike', args=[self.post.id + 1000]), **self.auth(self.token2))
+        self.assertEqual(r.status_code, status.HTTP_404_NOT_FOUND)
+
+    @override_settings(LIKES_ENGINE='redis')
+    def test_redis_engine_unknown_post(self):
+        """Liking a post that does not exist returns 404"""
+        r = self.client.post(reverse('post-like', args=[self.post.id + 1000]), **self.auth(self.token2))
+        self.assertEqual(r.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_bulk_like_and_unlike(self):
+        """Like and unlike a list of posts in one request, with a result per post"""
+        other = Post.objects.create(text='Other Post', author=self.u1)
+        Like.objects.create(user=self.u2, post=self.post)
+        bulk_url = reverse('post-like-bulk')
+
+        r1 = self.client.post(
+            bulk_url, {'post_ids': [self.post.id, other.id, 9999]}, format='json', **self.auth(self.token2)
+        )
+        self.assertEqual(r1.status_code, status.HTTP_200_OK)
+        self.assertEqual([r['status'] for r in r1.data['results']], ['already_liked', 'liked', 'not_found'])
+        other.refresh_from_db()
+        self.assertEqual(other.like_count, 1)
+
+        r2 = self.client.delete(bulk_url, {'post_ids': [other.id, 9999]}, format='json', **self.auth(self.token2))
+        self.assertEqual([r['status'] for r in r2.data['results']], ['unliked', 'not_liked'])
+        self.assertFalse(Like.objects.filter(post=other).exists())
+        other.refresh_from_db()
+        self.assertEqual(other.like_count, 0)
+
+    def test_bulk_like_concurrent_like_not_counted(self):
+        """A like inserted by a concurrent request is reported and not counted twice"""
+        Like.objects.create(user=self.u2, post=self.post) # Not seen by the request below
+        with mock.patch.object(DatabaseLikeEngine, 'liked_post_ids', return_value=set()):
+            r = self.client.post(
+                reverse('post-like-bulk'), {'post_ids': [self.post.id]}, format='json', **self.auth(self.token2)
+            )
+        self.assertEqual([r['status'] for r in r.data['results']], ['already_liked'])
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.like_count, 0)
+
+    @override_settings(LIKES_ENGINE='redis')
+    def test_redis_engine_bulk_like(self):
+        """With the redis engine bulk likes are recorded in Redis and flushed"""
+        other = Post.objects.create(text='Other Post', author=self.u1)
+        Like.objects.create(user=self.u2, post=self.post)
+        r = self.client.post(
+            reverse('post-like-bulk'), {'post_ids': [self.post.id, other.id, 9999]},
+            format='json', **self.auth(self.token2)
+        )
+        self.assertEqual([r['status'] for r in r.data['results']], ['already_liked', 'liked', 'not_found'])
+        self.assertEqual(RedisLikeEngine().like_counts([self.post.id, other.id]), {self.post.id: 1, other.id: 1})
+        # The likers previews follow the Like table
+        self.assertEqual(likers.previews([other.id]), {other.id: []})
+
+        self.assertEqual(flush_likes(), 2)
+        self.assertTrue(Like.objects.filter(user=self.u2, post=other).exists())
+        self.assertEqual(likers.previews([other.id]), {other.id: [{'id': self.u2.id, 'username': 'u2'}]})
+
+    def test_likers_pagination(self):
+        """The likers of a post are paginated with a cursor, newest first, with the async and DRF views"""
+        users = [
+            User.objects.create_user(email=f'l{i}@ex.com', username=f'l{i}', password='pass1234')
+            for i in range(5)
+        ]
+        for user in users:
+            Like.objects.create(user=user, post=self.post)
+
+        for async_views in (True, False):
+            with self.settings(ASYNC_READ_VIEWS=async_views):
+                usernames, url = [], f"{reverse('post-likers', args=[self.post.id])}?limit=2"
+                while url:
+                    data = self.client.get(url).json()
+                    usernames += [liker['username'] for liker in data['results']]
+                    url = data['next']
+                self.assertEqual(usernames, ['l4', 'l3', 'l2', 'l1', 'l0'])
+        self.assertEqual(set(data['results'][0]), {'id', 'username', 'liked_at'})
+
+    @override_settings(LIKERS_PREVIEW_SIZE=2)
+    def test_likers_preview(self):
+        """Posts embed their first likers, cached until they change"""
+        other = Post.objects.create(text='Other Post', author=self.u1)
+        self.client.post(self.like_url, **self.auth(self.token2))
+        self.assertEqual(likers.previews([self.post.id, other.id]), {
+            self.post.id: [{'id': self.u2.id, 'username': 'u2'}], other.id: [],
+        })
+        with self.assertNumQueries(0):
+            likers.previews([self.post.id, other.id])
+
+        # A like fills the preview, the next ones do not change it
+        self.client.post(self.like_url, **self.auth(self.token1))
+        u3 = User.objects.create_user(email='u3@ex.com', username='u3', password='pass1234')
+        Like.objects.create(user=u3, post=self.post)
+        self.assertEqual([liker['username'] for liker in likers.previews([self.post.id])[self.post.id]], ['u2', 'u1'])
+
+        # Unliking removes the liker from the preview
+        self.client.delete(self.unlike_url, **self.auth(self.token2))
+        self.assertEqual([liker['username'] for liker in likers.previews([self.post.id])[self.post.id]], ['u1', 'u3'])
+        resp = self.client.get(reverse('post-detail', args=[self.post.id]))
+        self.assertEqual([liker['username'] for liker in resp.data['likers_preview']], ['u1', 'u3'])
@@ -1,8 +1,11 @@
 from django.urls import path
-from .views import LikeUnikeView, PostLikesListView
+from config.async_views import async_read_view
+from .views import BulkLikeView, LikeUnikeView, PostLikersView, PostLikesListView, post_likers, post_likes
 
 urlpatterns = [
     path('like/<int:post_id>/', LikeUnikeView.as_view(),     name='post-like'), # Like or unlike a post
     path('unlike/<int:post_id>/', LikeUnikeView.as_view(),     name='post-unlike'), # Like or unlike a post
-    path('post/<int:post_id>/', PostLikesListView.as_view(), name='post-likes-list'), # List of users who liked a specific post
+    path('bulk/', BulkLikeView.as_view(), name='post-like-bulk'), # Like or unlike a list of posts
+    path('post/<int:post_id>/', async_read_view(post_likes, PostLikesListView.as_view()), name='post-likes-list'), # List of users who liked a specific post
+    path('post/<int:post_id>/users/', async_read_view(post_likers, PostLikersView.as_view()), name='post-likers'), # Users who liked a post, paginated
 ]
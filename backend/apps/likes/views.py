@@ -1,8 +1,15 @@
 from rest_framework import status, permissions, generics
 from rest_framework.views import APIView
 from rest_framework.response import Response
+from django.http import JsonResponse
+from rest_framework.request import Request
+from apps.posts.models import Post
+from config.async_views import authenticate
+from config.db_router import ReplicaReadMixin, ause_replica
+from config.pagination import KeysetPagination
+from .engine import get_like_engine
 from .models import Like
-from .serializers import LikeSerializer
+from .serializers import BulkLikeSerializer, LikerSerializer, LikeSerializer
 
 class LikeUnikeView(APIView):
     """like e unlike posts.
@@ -10,11 +17,13 @@ class LikeUnikeView(APIView):
     If the user has not liked the post yet, it will be liked.
     """
     permission_classes = [permissions.IsAuthenticated]
+    query_budget = {'post': 9, 'delete': 6}
 
     def post(self, request, post_id):
-        like, created = Like.objects.get_or_create(
-            user=request.user, post_id=post_id
-        )
+        try:
+            like, created = get_like_engine().like(request.user.id, post_id)
+        except Post.DoesNotExist:
+            return Response({'detail': 'Post not found.'}, status=status.HTTP_404_NOT_FOUND)
         if not created:
             return Response(
                 {'detail': 'You have already liked this post.'},
@@ -23,25 +32,102 @@ class LikeUnikeView(APIView):
         return Response(LikeSerializer(like).data, status=status.HTTP_201_CREATED)
 
     def delete(self, request, post_id):
-        like = Like.objects.filter(
-            user=request.user, post_id=post_id
-        ).first()
-        if not like:
+        try:
+            unliked = get_like_engine().unlike(request.user.id, post_id)
+        except Post.DoesNotExist:
+            return Response({'detail': 'Post not found.'}, status=status.HTTP_404_NOT_FOUND)
+        if not unliked:
             return Response(
                 {'detail': 'You have not liked this post yet.'},
                 status=status.HTTP_400_BAD_REQUEST
             )
-        like.delete()
         return Response(status=status.HTTP_204_NO_CONTENT)
 
-class PostLikesListView(generics.ListAPIView):
+class BulkLikeView(APIView):
+    """Like (POST) or unlike (DELETE) a list of posts at once.
+    The body is {"post_ids": [...]}, the response gives the result of every id.
+    """
+    permission_classes = [permissions.IsAuthenticated]
+    query_budget = {'post': 7, 'delete': 7}
+
+    def get_post_ids(self, request):
+        serializer = BulkLikeSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        return list(dict.fromkeys(serializer.validated_data['post_ids'])) # Unique, in order
+
+    def post(self, request):
+        post_ids = self.get_post_ids(request)
+        liked, missing = get_like_engine().like_many(request.user.id, post_ids)
+
+        def result(post_id):
+            if post_id in missing:
+                return 'not_found'
+            return 'liked' if post_id in liked else 'already_liked'
+        return Response({'results': [{'id': post_id, 'status': result(post_id)} for post_id in post_ids]})
+
+    def delete(self, request):
+        post_ids = self.get_post_ids(request)
+        unliked = get_like_engine().unlike_many(request.user.id, post_ids)
+        return Response({'results': [
+            {'id': post_id, 'status': 'unliked' if post_id in unliked else 'not_liked'}
+            for post_id in post_ids
+        ]})
+
+LIKERS_ASYNC_PARAMS = {'cursor', 'limit'} # The offset fallback needs the DRF view
+
+class PostLikesListView(ReplicaReadMixin, generics.ListAPIView):
     """List of likes for a specific post.
-    This view returns a list of likes for a specific post.
+    This view returns the likes of a post, newest first, paginated with a cursor.
     It uses the LikeSerializer to serialize the like data.
     """
     permission_classes = [permissions.AllowAny] # Permission for all users
     serializer_class = LikeSerializer 
-    pagination_class = None
+    pagination_class = KeysetPagination
+    query_budget = 2 # The page, and its count with the offset fallback
 
     def get_queryset(self):
-        return Like.objects.filter(post_id=self.kwargs['post_id']) # Get likes for the specific post
+        return likes_queryset(self.kwargs['post_id']) # Get likes for the specific post
+
+def likes_queryset(post_id):
+    # The pages are read from the (post, -created_at, -id) index
+    return Like.objects.filter(post_id=post_id).only('id', 'post_id', 'created_at')
+
+async def post_likes(request, post_id):
+    """Async version of PostLikesListView, see config/async_views.py."""
+    if not set(request.GET) <= LIKERS_ASYNC_PARAMS:
+        return None
+    # Anonymous requests are allowed, but an invalid token is still rejected
+    await ause_replica(await authenticate(request))
+    request = Request(request) # query_params and build_absolute_uri for the pagination
+    paginator = KeysetPagination()
+    page = await paginator.apaginate_queryset(likes_queryset(post_id), request)
+    return JsonResponse(paginator.get_paginated_data(LikeSerializer(page, many=True).data))
+
+class PostLikersView(ReplicaReadMixin, generics.ListAPIView):
+    """Users who liked a post, newest likes first, paginated with a cursor."""
+    permission_classes = [permissions.AllowAny]
+    serializer_class = LikerSerializer
+    pagination_class = KeysetPagination
+    query_budget = 2
+
+    def get_queryset(self):
+        return likers_queryset(self.kwargs['post_id'])
+
+def likers_queryset(post_id):
+    # The pages are read from the (post, -created_at, -id) index
+    return (
+        Like.objects.filter(post_id=post_id)
+        .select_related('user')
+        .only('id', 'created_at', 'user_id', 'user__username')
+    )
+
+
+async def post_likers(request, post_id):
+    """Async version of PostLikersView, see config/async_views.py."""
+    if not set(request.GET) <= LIKERS_ASYNC_PARAMS:
+        return None
+    await ause_replica(await authenticate(request))
+    request = Request(request) # query_params and build_absolute_uri for the pagination
+    paginator = KeysetPagination()
+    page = await paginator.apaginate_queryset(likers_queryset(post_id), request)
+    return JsonResponse(paginator.get_paginated_data(LikerSerializer(page, many=True).data))
@@ -0,0 +1,149 @@
+"""
+Per-user feed cache with versioned keys.
+
+A cached feed page is stored under a key made of the user id, the user's
+feed version, and a hash of the query string (cursor, limit, filters...) and
+of the versions of the celebrities (pulled authors) the user follows. Instead
+of deleting pages, the versions are bumped when the feed changes, so that
+every page of the old version is skipped at once:
+
+- the user's version when a post lands in, or is edited/removed from, the
+  timeline, and when the user follows, unfollows, likes or unlikes;
+- the version of a celebrity when they write, edit or delete a post: only the
+  feeds of their followers are affected, without writing to each of them.
+
+Like counts and likers previews change too often to invalidate every page
+that shows a post, they are refreshed from the like engine and the likers
+previews cache on every cache hit instead.
+"""
+import hashlib
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.core.cache import cache
+from django_redis import get_redis_connection
+
+from apps.likes import likers
+from apps.likes.engine import get_like_engine
+from config import metrics
+from config.async_views import get_redis
+from . import timeline
+
+HITS_KEY   = 'feed:cache:hits'
+MISSES_KEY = 'feed:cache:misses'
+
+
+def version_key(user_id):
+    """Redis key of the feed version of a user."""
+    return f'feed:version:{user_id}'
+
+
+def celebrity_version_key(author_id):
+    """Redis key of the version of the posts of a celebrity."""
+    return f'feed:version:celebrity:{author_id}'
+
+
+def _version_keys(user_id, celebrity_ids):
+    return [version_key(user_id), *(celebrity_version_key(author_id) for author_id in celebrity_ids)]
+
+
+def cache_key(user_id, query_params):
+    """Cache key of a feed page for the current versions."""
+    celebrity_ids = sorted(timeline.followed_celebrities(user_id))
+    versions = get_redis_connection('default').mget(_version_keys(user_id, celebrity_ids))
+    return _key(user_id, celebrity_ids, versions, query_params)
+
+
+async def acache_key(user_id, query_params):
+    """cache_key() with the async Redis client."""
+    celebrity_ids = sorted(await timeline.afollowed_celebrities(user_id))
+    versions = await get_redis().mget(_version_keys(user_id, celebrity_ids))
+    return _key(user_id, celebrity_ids, versions, query_params)
+
+
+def _key(user_id, celebrity_ids, versions, query_params):
+    user_version, *celebrity_versions = (int(version or 0) for version in versions)
+    query = urlencode(sorted(query_params.lists()), doseq=True)
+    celebrities = ','.join(f'{author_id}:{version}' for author_id, version in zip(celebrity_ids, celebrity_versions))
+    digest = hashlib.md5(f'{query}|{celebrities}'.encode()).hexdigest()
+    return f'feed:{user_id}:{user_version}:{digest}'
+
+
+async def aget_page(key):
+    """cache.get() of a page with the async Redis client, in the django-redis format."""
+    value = await get_redis().get(cache.client.make_key(key))
+    return None if value is None else cache.client.decode(value)
+
+
+async def aset_page(key, data):
+    """cache.set() of a page with the async Redis client, in the django-redis format."""
+    await get_redis().set(cache.client.make_key(key), cache.client.encode(data), ex=settings.FEED_CACHE_TTL)
+
+
+def expire(user_id):
+    """Invalidate the cached feed of a user."""
+    expire_many([user_id])
+
+
+def expire_many(user_ids):
+    """Invalidate the cached feeds of several users."""
+    if not user_ids:
+        return
+    pipe = get_redis_connection('default').pipeline(transaction=False)
+    for user_id in user_ids:
+        pipe.incr(version_key(user_id))
+    pipe.execute()
+
+
+def expire_celebrity_feeds(author_id):
+    """Invalidate the cached feeds of the followers of a celebrity (pulled author)."""
+    get_redis_connection('default').incr(celebrity_version_key(author_id))
+
+
+def refresh_likes(results):
+    """Update the like counts and the likers previews of a cached page in place."""
+    post_ids = [item['id'] for item in results]
+    counts = get_like_engine().like_counts(post_ids)
+    previews = likers.previews(post_ids)
+    for item in results:
+        item['like_count'] = counts.get(item['id'], item['like_count'])
+        item['likers_preview'] = previews.get(item['id'], [])
+
+
+async def arefresh_likes(results):
+    """refresh_likes() with the async like engine methods."""
+    post_ids = [item['id'] for item in results]
+    counts = await get_like_engine().alike_counts(post_ids)
+    previews = await likers.apreviews(post_ids)
+    for item in results:
+        item['like_count'] = counts.get(item['id'], item['like_count'])
+        item['likers_preview'] = previews.get(item['id'], [])
+
+
+def record(hit):
+    """Count a cache hit or miss."""
+    metrics.record_cache(hit)
+    get_redis_connection('default').incr(HITS_KEY if hit else MISSES_KEY)
+
+
+async def arecord(hit):
+    """record() with the async Redis client."""
+    metrics.record_cache(hit)
+    await get_redis().incr(HITS_KEY if hit else MISSES_KEY)
+
+
+def stats():
+    """Hits, misses and hit ratio of the feed cache."""
+    hits, misses = get_redis_connection('default').mget(HITS_KEY, MISSES_KEY)
+    hits, misses = int(hits or 0), int(misses or 0)
+    total = hits + misses
+    return {
+        'hits': hits,
+        'misses': misses,
+        'hit_ratio': hits / total if total else 0.0,
+    }
+
+
+def reset_stats():
+    """Reset the hit and miss counters."""
+    get_redis_connection('default').delete(HITS_KEY, MISSES_KEY)
@@ -0,0 +1,115 @@
+"""
+Post images.
+
+An uploaded image is stored as is, then processed by the process_post_image
+task, off the upload request:
+
+- the image is rotated according to its EXIF orientation and re-encoded, so
+  that the variants carry no metadata (EXIF, GPS position, ICC profile...);
+- a WebP and a JPEG variant is written for every width of POST_IMAGE_SIZES
+  smaller than the image (the image's own width if it is smaller than all);
+- the dimensions of the image and a tiny blurred JPEG, as a data URI, are
+  recorded on the post, so that clients can reserve the space and show a
+  placeholder while a variant loads.
+
+The variants are stored under ``posts/variants/<post id>/<image name>/``, a
+directory per uploaded image, and listed in Post.image_variants by size name.
+The task only records them if the post still has the image it processed: a
+task of a replaced image never overwrites the variants of the new one.
+"""
+import base64
+import io
+import os
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from PIL import Image, ImageFilter, ImageOps
+
+PLACEHOLDER_WIDTH = 16 # Pixels, the browser scales the placeholder up
+FORMATS = {
+    # Variant key: (Pillow format, file extension, save options)
+    'webp': ('WEBP', 'webp', {'quality': 80, 'method': 4}),
+    'jpeg': ('JPEG', 'jpg', {'quality': 82, 'optimize': True, 'progressive': True}),
+}
+
+
+def variant_path(post_id, image_name, name, extension):
+    # The storage never reuses the name of an existing file: a directory per upload
+    return f'posts/variants/{post_id}/{os.path.basename(image_name)}/{name}.{extension}'
+
+
+def _rgb(image):
+    """The image without transparency (JPEG has no alpha channel), on a white background."""
+    if image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info):
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, 'white')
+        background.paste(image, mask=image.getchannel('A'))
+        return background
+    return image.convert('RGB')
+
+
+def _encode(image, key):
+    pillow_format, _, options = FORMATS[key]
+    buffer = io.BytesIO()
+    # Only the pixels are written, no exif/icc_profile option is passed
+    image.save(buffer, pillow_format, **options)
+    return buffer.getvalue()
+
+
+def _resized(image, width):
+    if width >= image.width:
+        return image
+    height = max(1, round(image.height * width / image.width))
+    return image.resize((width, height), Image.Resampling.LANCZOS)
+
+
+def placeholder(image):
+    """A tiny blurred JPEG of the image, as a data URI."""
+    small = _resized(image, PLACEHOLDER_WIDTH).filter(ImageFilter.GaussianBlur(1))
+    buffer = io.BytesIO()
+    small.save(buffer, 'JPEG', quality=40)
+    return 'data:image/jpeg;base64,' + base64.b64encode(buffer.getvalue()).decode()
+
+
+def _paths(variants):
+    return {variant[key] for variant in variants.values() for key in FORMATS if variant.get(key)}
+
+
+def delete_variants(variants, keep=None):
+    """
+    Delete the files of the variants listed in Post.image_variants, except the
+    ones also listed in ``keep``.
+    """
+    for path in _paths(variants) - _paths(keep or {}):
+        default_storage.delete(path)
+
+
+def process(post):
+    """
+    Write the variants of the image of a post and record them on the post (not
+    saved). The files of the previous variants are left to the caller.
+    """
+    post.image_variants = {}
+    post.image_width = post.image_height = None
+    post.image_placeholder = ''
+    if not post.image:
+        return
+
+    with post.image.open('rb') as f, Image.open(f) as original:
+        image = _rgb(ImageOps.exif_transpose(original))
+
+    post.image_width, post.image_height = image.size
+    post.image_placeholder = placeholder(image)
+    sizes = sorted(settings.POST_IMAGE_SIZES.items(), key=lambda size: size[1])
+    for name, width in sizes:
+        resized = _resized(image, width) # Never upscaled
+        variant = {'width': resized.width, 'height': resized.height}
+        for key, (_, extension, _) in FORMATS.items():
+            path = variant_path(post.id, post.image.name, name, extension)
+            if default_storage.exists(path):
+                default_storage.delete(path)
+            variant[key] = default_storage.save(path, ContentFile(_encode(resized, key)))
+        post.image_variants[name] = variant
+        if resized is image:
+            break # The larger sizes would be the same file
@@ -0,0 +1,30 @@
+import time
+
+from django.conf import settings
+from django.contrib.postgres.search import SearchVector
+from django.core.management.base import BaseCommand
+from django.db.models import Max
+
+from apps.posts.models import Post
+
+class Command(BaseCommand):
+    help = (
+        'Fill the search vector of the posts created before the search trigger. '
+        'Rows are updated by id ranges, one short transaction per range.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=5000, help='Number of ids updated per transaction.')
+        parser.add_argument('--sleep', type=float, default=0.0, help='Seconds to wait between chunks.')
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        last_id = Post.objects.aggregate(last_id=Max('id'))['last_id'] or 0
+        updated = 0
+        for start in range(0, last_id + 1, chunk_size):
+            updated += Post.objects.filter(
+                id__gte=start, id__lt=start + chunk_size, search_vector__isnull=True
+            ).update(search_vector=SearchVector('text', config=settings.POST_SEARCH_CONFIG))
+            if options['sleep']:
+                time.sleep(options['sleep'])
+        self.stdout.write(self.style.SUCCESS(f'Updated {updated} posts.'))
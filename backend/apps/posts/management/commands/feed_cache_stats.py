@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from apps.posts import feed_cache
+
+class Command(BaseCommand):
+    help = 'Report the hit/miss ratio of the feed cache.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true', help='Reset the counters after reporting.')
+
+    def handle(self, *args, **options):
+        stats = feed_cache.stats()
+        self.stdout.write(
+            f"hits={stats['hits']} misses={stats['misses']} hit_ratio={stats['hit_ratio']:.2%}"
+        )
+        if options['reset']:
+            feed_cache.reset_stats()
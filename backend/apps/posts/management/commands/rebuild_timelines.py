@@ -0,0 +1,36 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+
+from apps.posts import timeline
+
+User = get_user_model()
+
+class Command(BaseCommand):
+    help = 'Rebuild the Redis home timelines from the database (e.g. after a cold start).'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'user_ids', nargs='*', type=int,
+            help='Rebuild only these users (default: every user that follows someone).'
+        )
+        parser.add_argument(
+            '--chunk-size', type=int, default=1000,
+            help='Number of users loaded from the database at a time.'
+        )
+
+    def handle(self, *args, **options):
+        user_ids = options['user_ids']
+        if not user_ids:
+            # Users that follow nobody have an empty timeline, nothing to store
+            user_ids = (
+                User.objects.filter(following__isnull=False)
+                .distinct()
+                .order_by('id')
+                .values_list('id', flat=True)
+                .iterator(chunk_size=options['chunk_size'])
+            )
+        rebuilt = 0
+        for user_id in user_ids:
+            timeline.rebuild(user_id)
+            rebuilt += 1
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt {rebuilt} timelines.'))
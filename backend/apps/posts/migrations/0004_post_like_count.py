@@ -0,0 +1,33 @@
+# Generated by Django 5.2 on 2026-10-18 19:34
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def backfill_like_counts(apps, schema_editor):
+    Post = apps.get_model('posts', 'Post')
+    Like = apps.get_model('likes', 'Like')
+    counts = (
+        Like.objects.filter(post=OuterRef('pk'))
+        .order_by().values('post')
+        .annotate(count=Count('id')).values('count')
+    )
+    Post.objects.update(like_count=Coalesce(Subquery(counts), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posts', '0003_post_author_created_idx'),
+        ('likes', '0002_like_post_created_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='post',
+            name='like_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_like_counts, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 5.2 on 2026-10-18 19:44
+
+import django.contrib.postgres.search
+from django.db import migrations
+
+# Keep the search vector of a post in sync with its text. The text search
+# configuration must match settings.POST_SEARCH_CONFIG.
+CREATE_TRIGGER = """
+CREATE FUNCTION posts_post_search_vector_update() RETURNS trigger AS $$
+BEGIN
+    NEW.search_vector := to_tsvector('pg_catalog.english', coalesce(NEW.text, ''));
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER posts_post_search_vector_trigger
+    BEFORE INSERT OR UPDATE OF text ON posts_post
+    FOR EACH ROW EXECUTE FUNCTION posts_post_search_vector_update();
+"""
+
+DROP_TRIGGER = """
+DROP TRIGGER IF EXISTS posts_post_search_vector_trigger ON posts_post;
+DROP FUNCTION IF EXISTS posts_post_search_vector_update();
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posts', '0004_post_like_count'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='post',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        # Existing rows are filled by the backfill_search_vectors command
+        migrations.RunSQL(CREATE_TRIGGER, DROP_TRIGGER),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.2 on 2026-10-18 19:44
+
+import django.contrib.postgres.indexes
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    # CREATE INDEX CONCURRENTLY does not block writes, but cannot run in a transaction
+    atomic = False
+
+    dependencies = [
+        ('posts', '0005_post_search_vector'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='post',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='post_search_vector_idx'),
+        ),
+    ]
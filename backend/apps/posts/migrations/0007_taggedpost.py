@@ -0,0 +1,78 @@
+# Generated by Django 5.2 on 2026-10-18 19:47
+
+import django.db.models.deletion
+import taggit.managers
+from django.db import migrations, models
+
+
+def copy_generic_tags(apps, schema_editor):
+    """Move the post tags from taggit's generic table to TaggedPost."""
+    ContentType = apps.get_model('contenttypes', 'ContentType')
+    TaggedItem = apps.get_model('taggit', 'TaggedItem')
+    TaggedPost = apps.get_model('posts', 'TaggedPost')
+    Post = apps.get_model('posts', 'Post')
+    content_type = ContentType.objects.filter(app_label='posts', model='post').first()
+    if content_type is None:
+        return # Fresh database, no tags yet
+    generic = TaggedItem.objects.filter(content_type=content_type)
+    TaggedPost.objects.bulk_create(
+        (
+            TaggedPost(content_object_id=object_id, tag_id=tag_id)
+            # The generic relation has no foreign key, skip the rows of deleted posts
+            for object_id, tag_id in generic.filter(object_id__in=Post.objects.values('id'))
+            .values_list('object_id', 'tag_id').iterator()
+        ),
+        batch_size=5000,
+        ignore_conflicts=True,
+    )
+    generic.delete()
+
+
+def copy_typed_tags(apps, schema_editor):
+    """Move the post tags back to taggit's generic table."""
+    ContentType = apps.get_model('contenttypes', 'ContentType')
+    TaggedItem = apps.get_model('taggit', 'TaggedItem')
+    TaggedPost = apps.get_model('posts', 'TaggedPost')
+    content_type, _ = ContentType.objects.get_or_create(app_label='posts', model='post')
+    TaggedItem.objects.bulk_create(
+        (
+            TaggedItem(content_type=content_type, object_id=object_id, tag_id=tag_id)
+            for object_id, tag_id in TaggedPost.objects.values_list('content_object_id', 'tag_id').iterator()
+        ),
+        batch_size=5000,
+        ignore_conflicts=True,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posts', '0006_post_search_vector_idx'),
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('taggit', '0006_rename_taggeditem_content_type_object_id_taggit_tagg_content_8fc721_idx'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TaggedPost',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('content_object', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='tagged_items', to='posts.post')),
+                ('tag', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='%(app_label)s_%(class)s_items', to='taggit.tag')),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='post',
+            name='tags',
+            field=taggit.managers.TaggableManager(blank=True, help_text='A comma-separated list of tags.', through='posts.TaggedPost', to='taggit.Tag', verbose_name='Tags'),
+        ),
+        migrations.AddIndex(
+            model_name='taggedpost',
+            index=models.Index(fields=['tag', 'content_object'], name='taggedpost_tag_post_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='taggedpost',
+            constraint=models.UniqueConstraint(fields=('content_object', 'tag'), name='taggedpost_post_tag_unique'),
+        ),
+        migrations.RunPython(copy_generic_tags, copy_typed_tags),
+    ]
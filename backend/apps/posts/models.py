@@ -1,16 +1,53 @@
 from django.db import models
 from django.conf import settings
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVectorField
 from taggit.managers import TaggableManager
+from taggit.models import TaggedItemBase
 
-class Post(models.Model):
+from config.models import CounterFieldsMixin
+
+class Post(CounterFieldsMixin, models.Model):
     author = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='posts') # The user who created the post
     text = models.TextField(max_length=280) # Max length of a tweet
     image = models.ImageField(upload_to='posts/', blank=True, null=True) # Optional
+    # Set by the process_post_image task (see apps/posts/images.py)
+    image_width = models.PositiveIntegerField(null=True, blank=True, editable=False)
+    image_height = models.PositiveIntegerField(null=True, blank=True, editable=False)
+    image_placeholder = models.TextField(blank=True, editable=False) # Tiny blurred JPEG, as a data URI
+    image_variants = models.JSONField(default=dict, blank=True, editable=False) # Resized WebP/JPEG files, by size
     created_at = models.DateTimeField(auto_now_add=True) # Automatically set the field to now when the object is first created
-    tags = TaggableManager(blank=True) # Optional, for tagging posts
+    tags = TaggableManager(through='TaggedPost', blank=True) # Optional, for tagging posts
+    like_count = models.PositiveIntegerField(default=0, editable=False) # Denormalized number of likes
+    search_vector = SearchVectorField(null=True, editable=False) # Full-text index of the text, kept by a trigger
+
+    counter_fields = ('like_count',)
 
     class Meta:
         ordering = ['-created_at'] # Newest posts first
+        indexes = [
+            # Newest posts of an author, with id as tie breaker for keyset pagination
+            models.Index(fields=['author', '-created_at', '-id'], name='post_author_created_idx'),
+            GinIndex(fields=['search_vector'], name='post_search_vector_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.author.username}: {self.text[:20]}' # Limit to 20 characters
+
+
+class TaggedPost(TaggedItemBase):
+    """Tag of a post, with a real foreign key instead of taggit's generic relation."""
+    # Not indexed on its own, the unique constraint starts with the post
+    content_object = models.ForeignKey(Post, on_delete=models.CASCADE, related_name='tagged_items', db_index=False)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['content_object', 'tag'], name='taggedpost_post_tag_unique'),
+        ]
+        indexes = [
+            # Posts with a tag (filter by tag), the unique constraint covers the tags of a post
+            models.Index(fields=['tag', 'content_object'], name='taggedpost_tag_post_idx'),
+        ]
 
     def __str__(self):
-        return f'{self.author.username}: {self.text[:20]}' # Limit to 20 characters
\ No newline at end of file
+        return f'{self.content_object_id}: {self.tag_id}'
@@ -1,30 +1,148 @@
+import re
+from functools import reduce
+from operator import or_
+
+from django.core.files.storage import default_storage
+from django.db.models import Q
 from rest_framework import serializers
-from .models import Post
+from taggit.models import Tag
+from apps.follows import graph
+from apps.likes import likers
+from apps.likes.engine import get_like_engine
+from config.metrics import TimedSerializerMixin
+from . import trending
+from .models import Post, TaggedPost
+
+def viewer_state(request, posts):
+    """
+    State of a list of posts for the user of the request, with at most one
+    query per kind of state whatever the number of posts:
+
+    - ``liked``: ids of the posts liked by the user
+    - ``followed``: ids of the authors followed by the user (follow graph cache)
+    """
+    state = {'post_ids': {post.id for post in posts}, 'liked': set(), 'followed': set()}
+    user = getattr(request, 'user', None)
+    if not posts or user is None or not user.is_authenticated:
+        return state
+    state['liked'] = get_like_engine().liked_post_ids(user.id, state['post_ids'])
+    state['followed'] = graph.followed_among(user.id, {post.author_id for post in posts})
+    return state
 
-class PostSerializer(serializers.ModelSerializer):
+async def aviewer_state(user, posts):
+    """viewer_state() with the async ORM, for an authenticated user."""
+    state = {'post_ids': {post.id for post in posts}, 'liked': set(), 'followed': set()}
+    if not posts:
+        return state
+    state['liked'] = await get_like_engine().aliked_post_ids(user.id, state['post_ids'])
+    state['followed'] = await graph.afollowed_among(user.id, {post.author_id for post in posts})
+    return state
+
+class PostListSerializer(TimedSerializerMixin, serializers.ListSerializer):
+    """
+    Serializer for pages of posts.
+    The per-post data that does not come from the Post row is computed for the
+    whole page at once and injected in the context, unless the caller already
+    did (the async feed).
+    """
+    def to_representation(self, data):
+        posts = list(data.all() if hasattr(data, 'all') else data)
+        if 'viewer_state' not in self._context:
+            self._context['viewer_state'] = viewer_state(self._context.get('request'), posts)
+        engine = get_like_engine()
+        if engine.live_counts and 'like_counts' not in self._context:
+            # The like_count column lags behind the like engine
+            self._context['like_counts'] = engine.like_counts([post.id for post in posts])
+        if 'likers_previews' not in self._context:
+            self._context['likers_previews'] = likers.previews([post.id for post in posts])
+        return super().to_representation(posts)
+
+class PostSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     author = serializers.StringRelatedField(read_only=True)
-    like_count = serializers.SerializerMethodField() # Custom field to count likes
+    like_count = serializers.SerializerMethodField() # Number of likes, from the like engine
+    liked_by_me = serializers.SerializerMethodField() # The user of the request liked the post
+    author_followed_by_me = serializers.SerializerMethodField() # The user of the request follows the author
+    likers_preview = serializers.SerializerMethodField() # First users who liked the post
+    image_variants = serializers.SerializerMethodField() # Resized WebP/JPEG URLs, by size
     tags = serializers.ListField(
         child=serializers.CharField(),
         write_only=True,
         required=False
     )
-    tag_list   = serializers.ListField(
-        source='tags.names',
-        read_only=True
-    )
+    tag_list   = serializers.SerializerMethodField()
 
     class Meta:
         model  = Post
-        fields = ('id', 'author', 'text', 'image', 'created_at', 'like_count', 'tags', 'tag_list')
-        read_only_fields = ('id', 'author', 'created_at', 'like_count', 'tag_list')
+        fields = (
+            'id', 'author', 'text', 'image', 'image_width', 'image_height', 'image_placeholder',
+            'image_variants', 'created_at', 'like_count',
+            'liked_by_me', 'author_followed_by_me', 'likers_preview', 'tags', 'tag_list',
+        )
+        read_only_fields = (
+            'id', 'author', 'image_width', 'image_height', 'image_placeholder', 'image_variants',
+            'created_at', 'like_count',
+            'liked_by_me', 'author_followed_by_me', 'likers_preview', 'tag_list',
+        )
+        list_serializer_class = PostListSerializer
 
     def get_like_count(self, obj):
         """
-        Custom method to count the number of likes for a post.
-        This method is used to calculate the number of likes for a post.
+        Number of likes of the post.
+        Pages get the counts in bulk from the context (see PostListSerializer).
+        """
+        like_counts = self.context.get('like_counts')
+        if like_counts is not None and obj.id in like_counts:
+            return like_counts[obj.id]
+        engine = get_like_engine()
+        if engine.live_counts:
+            return engine.like_counts([obj.id]).get(obj.id, obj.like_count)
+        return obj.like_count
+
+    def _get_viewer_state(self, obj):
+        """
+        Viewer state of the post.
+        Pages get it in bulk from the context (see PostListSerializer), a single
+        post computes its own.
+        """
+        state = self.context.get('viewer_state')
+        if state is None or obj.id not in state['post_ids']:
+            state = viewer_state(self.context.get('request'), [obj])
+            self.context['viewer_state'] = state
+        return state
+
+    def get_liked_by_me(self, obj):
+        return obj.id in self._get_viewer_state(obj)['liked']
+
+    def get_author_followed_by_me(self, obj):
+        return obj.author_id in self._get_viewer_state(obj)['followed']
+
+    def get_likers_preview(self, obj):
+        """
+        First likers of the post, see apps/likes/likers.py.
+        Pages get the previews in bulk from the context (see PostListSerializer).
+        """
+        previews = self.context.get('likers_previews')
+        if previews is not None and obj.id in previews:
+            return previews[obj.id]
+        return likers.previews([obj.id])[obj.id]
+
+    def get_image_variants(self, obj):
+        """
+        URLs of the resized variants of the image, see apps/posts/images.py.
+        Empty until the process_post_image task has run.
         """
-        return obj.likes.count()
+        request = self.context.get('request')
+        variants = {}
+        for name, variant in obj.image_variants.items():
+            variants[name] = dict(variant)
+            for key in ('webp', 'jpeg'):
+                url = default_storage.url(variant[key])
+                variants[name][key] = request.build_absolute_uri(url) if request is not None else url
+        return variants
+
+    def get_tag_list(self, obj):
+        # tags.names() runs a query even when the tags are prefetched
+        return [tag.name for tag in obj.tags.all()]
 
     def create(self, validated_data):
         # exctract the tags and author from the validated data
@@ -32,5 +150,46 @@ class PostSerializer(serializers.ModelSerializer):
         author = validated_data.pop('author')
         post = Post.objects.create(author=author, **validated_data)
         if tags:
-            post.tags.set(tags)
-        return post
\ No newline at end of file
+            self._add_tags(post, tags)
+            trending.record_tags(tags)
+        return post
+
+    def _add_tags(self, post, names):
+        """
+        Tag a new post with a constant number of queries, tags.set() runs a few
+        queries per tag.
+        """
+        names = list(dict.fromkeys(name for name in names if name.strip()))
+        tags = {tag.name: tag for tag in Tag.objects.filter(name__in=names)}
+        missing = [name for name in names if name not in tags]
+        if missing:
+            Tag.objects.bulk_create(
+                [Tag(name=name, slug=Tag().slugify(name)) for name in missing],
+                ignore_conflicts=True,
+            )
+            tags.update((tag.name, tag) for tag in Tag.objects.filter(name__in=missing))
+        taken = [name for name in names if name not in tags]
+        if taken:
+            # Their slug is used by another name ('Django' and 'django'): number
+            # them like taggit does, with one query for the slugs in use. The
+            # regex only matches these slugs, even the empty slug of '!!' or an emoji
+            slugs = set(
+                Tag.objects.filter(reduce(or_, (self._numbered_slugs(Tag().slugify(name)) for name in taken)))
+                .values_list('slug', flat=True)
+            )
+            new_tags = []
+            for name in taken:
+                i = 1
+                while Tag().slugify(name, i) in slugs:
+                    i += 1
+                slugs.add(Tag().slugify(name, i))
+                new_tags.append(Tag(name=name, slug=Tag().slugify(name, i)))
+            Tag.objects.bulk_create(new_tags, ignore_conflicts=True)
+            tags.update((tag.name, tag) for tag in Tag.objects.filter(name__in=taken))
+        TaggedPost.objects.bulk_create([TaggedPost(content_object=post, tag=tags[name]) for name in names])
+
+    @staticmethod
+    def _numbered_slugs(slug):
+        """Filter of a slug and its numbered variants, the prefix lets the index narrow them."""
+        numbered = Q(slug__regex=rf'^{re.escape(slug)}(_\d+)?$')
+        return numbered & Q(slug__startswith=slug) if slug else numbered
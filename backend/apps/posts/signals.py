@@ -0,0 +1,55 @@
+"""
+Keep the home timelines and the feed cache in sync with the posts, follows
+and likes, whatever code path (API, admin, shell) writes them.
+"""
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from apps.follows.models import Follow
+from apps.follows.tasks import backfill_timeline, prune_timeline
+from apps.likes.models import Like
+from . import feed_cache
+from .models import Post
+from .tasks import delete_post_variants, expire_feeds, fan_out_post
+
+
+@receiver(post_save, sender=Post)
+def post_saved(sender, instance, created, **kwargs):
+    if created:
+        # Push the new post into the followers' timelines, once a worker can read it
+        transaction.on_commit(lambda: fan_out_post.delay(instance.id))
+    else:
+        expire_feeds.delay(instance.author_id)
+
+
+@receiver(post_delete, sender=Post)
+def post_deleted(sender, instance, **kwargs):
+    expire_feeds.delay(instance.author_id)
+    if instance.image_variants:
+        # Once the deletion is committed, a rollback keeps the post and its files
+        variants = instance.image_variants
+        transaction.on_commit(lambda: delete_post_variants.delay(variants))
+
+
+@receiver(post_save, sender=Follow)
+def follow_saved(sender, instance, created, **kwargs):
+    if created:
+        # Add the posts of the followed user to the follower's timeline, once
+        # a worker can read the follow
+        transaction.on_commit(lambda: backfill_timeline.delay(instance.user_id, instance.following_id))
+    feed_cache.expire(instance.user_id)
+
+
+@receiver(post_delete, sender=Follow)
+def follow_deleted(sender, instance, **kwargs):
+    # Remove the posts of the unfollowed user from the timeline
+    prune_timeline.delay(instance.user_id, instance.following_id)
+    feed_cache.expire(instance.user_id)
+
+
+@receiver([post_save, post_delete], sender=Like)
+def like_changed(sender, instance, **kwargs):
+    # The like counts are refreshed on every cache hit, only the feed
+    # of the user who liked needs to be expired
+    feed_cache.expire(instance.user_id)
@@ -0,0 +1,116 @@
+from celery import shared_task
+
+FAN_OUT_BATCH_SIZE = 1000 # Followers written per Redis pipeline
+RECONCILE_CHUNK_SIZE = 10000 # Posts checked per UPDATE when reconciling counters
+
+def _follower_batches(author_id):
+    """Ids of the followers of an author, in lists of FAN_OUT_BATCH_SIZE."""
+    from apps.follows.models import Follow
+
+    follower_ids = Follow.objects.filter(following_id=author_id).values_list('user_id', flat=True)
+    batch = []
+    for follower_id in follower_ids.iterator(chunk_size=FAN_OUT_BATCH_SIZE):
+        batch.append(follower_id)
+        if len(batch) == FAN_OUT_BATCH_SIZE:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+@shared_task
+def fan_out_post(post_id):
+    """Push a new post into the timelines of the author's followers."""
+    from . import feed_cache, timeline
+    from .models import Post
+
+    post = Post.objects.select_related('author').filter(pk=post_id).first()
+    if post is None:
+        return
+    if timeline.is_celebrity(post.author_id, post.author.follower_count):
+        # Too many followers: the post is pulled at read time instead
+        feed_cache.expire_celebrity_feeds(post.author_id)
+        return
+    for batch in _follower_batches(post.author_id):
+        timeline.fan_out(post, batch)
+        # Expire the cached feeds only once the timelines are written
+        feed_cache.expire_many(batch)
+
+@shared_task
+def process_post_image(post_id):
+    """Write the resized variants and the placeholder of the image of a post."""
+    from . import images
+    from .models import Post
+
+    post = Post.objects.filter(pk=post_id).first()
+    if post is None:
+        return
+    previous = post.image_variants
+    images.process(post) # Long, the image may be replaced or the post deleted meanwhile
+    fields = ['image_width', 'image_height', 'image_placeholder', 'image_variants']
+    # Recorded only if the post still has the image processed
+    recorded = Post.objects.filter(pk=post_id, image=post.image.name or '').update(
+        **{field: getattr(post, field) for field in fields}
+    )
+    if recorded:
+        images.delete_variants(previous, keep=post.image_variants)
+        # update() sends no post_save signal, expire the feeds that show the post
+        expire_feeds.delay(post.author_id)
+    else:
+        # The task of the new image records its own variants, the ones still
+        # recorded (the same image processed twice) are kept
+        current = Post.objects.filter(pk=post_id).values_list('image_variants', flat=True).first()
+        images.delete_variants(post.image_variants, keep=current)
+
+@shared_task
+def delete_post_variants(variants):
+    """Delete the files of the image variants of a deleted post."""
+    from . import images
+
+    images.delete_variants(variants)
+
+@shared_task
+def expire_feeds(author_id):
+    """Invalidate the cached feeds that show the posts of an author."""
+    from django.contrib.auth import get_user_model
+    from . import feed_cache, timeline
+    User = get_user_model()
+
+    author = User.objects.filter(pk=author_id).first()
+    follower_count = author.follower_count if author else 0
+    if timeline.is_celebrity(author_id, follower_count):
+        feed_cache.expire_celebrity_feeds(author_id)
+        return
+    for batch in _follower_batches(author_id):
+        feed_cache.expire_many(batch)
+
+@shared_task
+def reconcile_like_counts():
+    """
+    Fix the drift between Post.like_count and the Like table.
+    Posts are checked in id ranges so that no UPDATE locks the whole table.
+    """
+    from django.db.models import Count, Max, OuterRef, Subquery
+    from django.db.models.functions import Coalesce
+    from apps.likes.models import Like
+    from .models import Post
+
+    actual = Coalesce(Subquery(
+        Like.objects.filter(post=OuterRef('pk'))
+        .order_by().values('post')
+        .annotate(count=Count('id')).values('count')
+    ), 0)
+    last_id = Post.objects.aggregate(last_id=Max('id'))['last_id'] or 0
+    fixed = 0
+    for start in range(0, last_id + 1, RECONCILE_CHUNK_SIZE):
+        fixed += (
+            Post.objects.filter(id__gte=start, id__lt=start + RECONCILE_CHUNK_SIZE)
+            .exclude(like_count=actual)
+            .update(like_count=actual)
+        )
+    return fixed
+
+@shared_task
+def refresh_trending_tags():
+    """Recompute the top trending tags."""
+    from . import trending
+    return trending.refresh()
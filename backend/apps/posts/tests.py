@@ -1,15 +1,43 @@
-from django.urls import reverse
+import base64
+import json
+from io import BytesIO, StringIO
+from tempfile import TemporaryDirectory
+from PIL import Image
+from asgiref.sync import iscoroutinefunction
+from django.urls import resolve, reverse
 from rest_framework import status
 from rest_framework.test import APITestCase
 from django.contrib.auth import get_user_model
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from django_redis import get_redis_connection
+from taggit.models import Tag
+from unittest import mock
 
-from apps.posts.models import Post
+from config import async_views, db_router, metrics
+from config.middleware import QueryBudgetExceeded
+
+from apps.posts import feed_cache, images, timeline, trending
+from apps.users.authentication import local_users
+from apps.posts.models import Post, TaggedPost
+from apps.posts.views import PostViewSet
+from apps.posts.tasks import process_post_image, refresh_trending_tags
 from apps.follows.models import Follow
+from apps.likes.models import Like
 
 User = get_user_model()
 
 class PostTests(APITestCase):
     def setUp(self):
+        # Start every test with empty timelines
+        cache.clear()
+
         # Ceate two users
         self.u1 = User.objects.create_user(email='u1@ex.com', username='u1', password='pass1234')
         self.u2 = User.objects.create_user(email='u2@ex.com', username='u2', password='pass1234')
@@ -45,19 +73,32 @@ class PostTests(APITestCase):
         # if u1 is not following u2, the post should not appear in the feed
         resp = self.client.get(self.list_url, **self.auth(self.token1))
         self.assertEqual(resp.status_code, status.HTTP_200_OK)
-        self.assertEqual(len(resp.data['results']), 0)
+        self.assertEqual(len(resp.json()['results']), 0)
 
         # u1 follows u2
-        Follow.objects.create(user=self.u1, following=self.u2)
+        with self.captureOnCommitCallbacks(execute=True):
+            Follow.objects.create(user=self.u1, following=self.u2)
         resp = self.client.get(self.list_url, **self.auth(self.token1))
-        self.assertEqual(len(resp.data['results']), 1)
-        self.assertEqual(resp.data['results'][0]['text'], 'Post of u2')
+        self.assertEqual(len(resp.json()['results']), 1)
+        self.assertEqual(resp.json()['results'][0]['text'], 'Post of u2')
+
+    def test_feed_filtered_by_tag(self):
+        """Tags are stored in TaggedPost and the feed can be filtered by tag."""
+        Follow.objects.create(user=self.u1, following=self.u2)
+        tagged = Post.objects.create(text='Tagged', author=self.u2)
+        tagged.tags.set(['django', 'python'])
+        Post.objects.create(text='Not tagged', author=self.u2)
+        self.assertEqual(TaggedPost.objects.filter(content_object=tagged).count(), 2)
+
+        resp = self.client.get(self.list_url, {'tags__name': 'django'}, **self.auth(self.token1))
+        self.assertEqual([p['id'] for p in resp.json()['results']], [tagged.id])
+        self.assertEqual(sorted(resp.json()['results'][0]['tag_list']), ['django', 'python'])
 
     def test_update_and_delete_permissions(self):
         """Only the author of the post should be able to update or delete it."""
         # u1 create a post
         resp = self.client.post(self.list_url, {'text':'Original'}, **self.auth(self.token1), format='json')
-        post_id = resp.data['id']
+        post_id = resp.json()['id']
         detail = reverse('post-detail', args=[post_id])
 
         # u2 try update a post → 403
@@ -67,7 +108,7 @@ class PostTests(APITestCase):
         # u1 update → 200
         resp = self.client.patch(detail, {'text':'Updated'}, **self.auth(self.token1), format='json')
         self.assertEqual(resp.status_code, status.HTTP_200_OK)
-        self.assertEqual(resp.data['text'], 'Updated')
+        self.assertEqual(resp.json()['text'], 'Updated')
 
         # u2 try deleting → 403
         resp = self.client.delete(detail, **self.auth(self.token2))
@@ -77,3 +118,451 @@ class PostTests(APITestCase):
         resp = self.client.delete(detail, **self.auth(self.token1))
         self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
         self.assertFalse(Post.objects.filter(id=post_id).exists())
+
+    def timeline_ids(self, user):
+        conn = get_redis_connection('default')
+        return [
+            int(pid) for pid in conn.zrevrange(timeline.timeline_key(user.id), 0, -1)
+            if int(pid) != timeline.SENTINEL
+        ]
+
+    def test_create_post_fans_out_to_followers(self):
+        """A new post should be pushed into the timelines of the author's followers."""
+        Follow.objects.create(user=self.u1, following=self.u2)
+        old = Post.objects.create(text='Old post', author=self.u2)
+        # the first read builds the timeline of u1
+        self.client.get(self.list_url, **self.auth(self.token1))
+        self.assertEqual(self.timeline_ids(self.u1), [old.id])
+
+        # u2 creates a post, it should be pushed to u1's timeline
+        with self.captureOnCommitCallbacks() as callbacks:
+            resp = self.client.post(self.list_url, {'text': 'New post'}, format='json', **self.auth(self.token2))
+        # Not before the post is committed, a worker would not find it
+        self.assertEqual(self.timeline_ids(self.u1), [old.id])
+        for callback in callbacks:
+            callback()
+        self.assertEqual(self.timeline_ids(self.u1), [resp.json()['id'], old.id])
+
+        resp = self.client.get(self.list_url, **self.auth(self.token1))
+        self.assertEqual([p['text'] for p in resp.json()['results']], ['New post', 'Old post'])
+
+    def test_empty_timeline_cached(self):
+        """An empty timeline is stored with the sentinel for a while, and filled by later follows."""
+        post = Post.objects.create(text='Post', author=self.u2)
+        with self.assertNumQueries(1):
+            self.assertEqual(timeline.get_post_ids(self.u1.id), [])
+        with self.assertNumQueries(0):
+            self.assertEqual(timeline.get_post_ids(self.u1.id), [])
+        ttl = get_redis_connection('default').ttl(timeline.timeline_key(self.u1.id))
+        self.assertTrue(0 < ttl <= settings.TIMELINE_EMPTY_TTL)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('follow', args=[self.u2.id]), **self.auth(self.token1))
+        self.assertEqual(timeline.get_post_ids(self.u1.id), [post.id])
+
+    def test_follow_backfills_and_unfollow_prunes_timeline(self):
+        """Following adds the user's posts to the timeline and unfollowing removes them."""
+        u3 = User.objects.create_user(email='u3@ex.com', username='u3', password='pass1234')
+        Follow.objects.create(user=self.u1, following=u3)
+        p3 = Post.objects.create(text='Post of u3', author=u3)
+        p2 = Post.objects.create(text='Post of u2', author=self.u2)
+        self.client.get(self.list_url, **self.auth(self.token1))
+        self.assertEqual(self.timeline_ids(self.u1), [p3.id])
+
+        # u1 follows u2 → u2's posts are backfilled
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('follow', args=[self.u2.id]), **self.auth(self.token1))
+        self.assertEqual(self.timeline_ids(self.u1), [p2.id, p3.id])
+
+        # u1 unfollows u2 → u2's posts are pruned
+        self.client.delete(reverse('unfollow', args=[self.u2.id]), **self.auth(self.token1))
+        self.assertEqual(self.timeline_ids(self.u1), [p3.id])
+
+    def test_rebuild_timelines_command(self):
+        """The rebuild command should restore timelines from the database."""
+        Follow.objects.create(user=self.u1, following=self.u2)
+        p = Post.objects.create(text='Post of u2', author=self.u2)
+        self.assertEqual(self.timeline_ids(self.u1), [])
+
+        call_command('rebuild_timelines', stdout=StringIO())
+        self.assertEqual(self.timeline_ids(self.u1), [p.id])
+
+    @override_settings(TIMELINE_CELEBRITY_THRESHOLD=1)
+    def test_celebrity_posts_are_pulled(self):
+        """Posts of authors above the follower threshold are merged at read time."""
+        u3 = User.objects.create_user(email='u3@ex.com', username='u3', password='pass1234')
+        Follow.objects.create(user=self.u1, following=u3)
+        p3 = Post.objects.create(text='Post of u3', author=u3)
+        self.client.get(self.list_url, **self.auth(self.token1))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('follow', args=[self.u2.id]), **self.auth(self.token1))
+
+        # u2 has one follower, so the new post is not pushed...
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(self.list_url, {'text': 'Celebrity post'}, format='json', **self.auth(self.token2))
+        self.assertEqual(self.timeline_ids(self.u1), [p3.id])
+
+        # ...but it is pulled into the feed
+        resp = self.client.get(self.list_url, **self.auth(self.token1))
+        self.assertEqual([p['text'] for p in resp.json()['results']], ['Celebrity post', 'Post of u3'])
+
+    @override_settings(TIMELINE_CELEBRITY_THRESHOLD=1)
+    def test_celebrity_post_expires_only_follower_feeds(self):
+        """A celebrity post invalidates the cached feeds of their followers, not the others."""
+        u3 = User.objects.create_user(email='u3@ex.com', username='u3', password='pass1234')
+        token3 = self.client.post(
+            reverse('token-obtain-pair'), {'email': u3.email, 'password': 'pass1234'}, format='json',
+        ).data['access']
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('follow', args=[self.u2.id]), **self.auth(self.token1))
+            self.client.post(self.list_url, {'text': 'First'}, format='json', **self.auth(self.token2))
+        for token in (self.token1, token3):
+            self.client.get(self.list_url, **self.auth(token))
+        feed_cache.reset_stats()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(self.list_url, {'text': 'Second'}, format='json', **self.auth(self.token2))
+        resp = self.client.get(self.list_url, **self.auth(self.token1))
+        self.assertEqual([p['text'] for p in resp.json()['results']], ['Second', 'First'])
+        self.client.get(self.list_url, **self.auth(token3))
+        self.assertEqual(feed_cache.stats()['hits'], 1) # The feed of u3 only
+
+    def test_feed_cursor_pagination(self):
+        """The feed is paginated with an opaque cursor, limit/offset still works."""
+        Follow.objects.create(user=self.u1, following=self.u2)
+        for i in range(3):
+            Post.objects.create(text=f'Post {i}', author=self.u2)
+
+        resp = self.client.get(self.list_url, {'limit': 2}, **self.auth(self.token1))
+        self.assertEqual([p['text'] for p in resp.json()['results']], ['Post 2', 'Post 1'])
+        self.assertIsNotNone(resp.json()['next'])
+
+        # the next page starts after the last post of the previous one
+        resp = self.client.get(resp.json()['next'], **self.auth(self.token1))
+        self.assertEqual([p['text'] for p in resp.json()['results']], ['Post 0'])
+        self.assertIsNone(resp.json()['next'])
+
+        # limit/offset fallback
+        resp = self.client.get(self.list_url, {'limit': 2, 'offset': 2}, **self.auth(self.token1))
+        self.assertEqual(resp.json()['count'], 3)
+        self.assertEqual([p['text'] for p in resp.json()['results']], ['Post 0'])
+
+        # an invalid cursor returns 404, so does one with values of the wrong type
+        resp = self.client.get(self.list_url, {'cursor': 'nope'}, **self.auth(self.token1))
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        for values in (['abc', 1], ['2020-01-01T00:00:00+00:00', 'x'], [{}, 1], [None, 1]):
+            cursor = base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+            for async_views in (True, False):
+                with override_settings(ASYNC_READ_VIEWS=async_views):
+                    resp = self.client.get(self.list_url, {'cursor': cursor}, **self.auth(self.token1))
+                self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND, values)
+            resp = self.client.get(reverse('post-search'), {'q': 'post', 'cursor': cursor}, **self.auth(self.token1))
+            self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND, values)
+
+    def test_feed_cache_invalidation(self):
+        """Cached feeds are invalidated when the posts or follows change."""
+        Follow.objects.create(user=self.u1, following=self.u2)
+        p = Post.objects.create(text='First', author=self.u2)
+        self.client.get(self.list_url, **self.auth(self.token1))
+        resp = self.client.get(self.list_url, **self.auth(self.token1))
+        self.assertEqual(len(resp.json()['results']), 1)
+        self.assertEqual(feed_cache.stats()['hits'], 1)
+
+        # a new post of u2 expires u1's feed
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(self.list_url, {'text': 'Second'}, format='json', **self.auth(self.token2))
+        resp = self.client.get(self.list_url, **self.auth(self.token1))
+        self.assertEqual([p['text'] for p in resp.json()['results']], ['Second', 'First'])
+
+        # so does an update of the post
+        self.client.patch(reverse('post-detail', args=[p.id]), {'text': 'Edited'}, format='json', **self.auth(self.token2))
+        resp = self.client.get(self.list_url, **self.auth(self.token1))
+        self.assertEqual([p['text'] for p in resp.json()['results']], ['Second', 'Edited'])
+
+        # like counts are fresh even on a cache hit
+        self.client.get(self.list_url, **self.auth(self.token1))
+        self.client.post(reverse('post-like', args=[p.id]), **self.auth(self.token2))
+        resp = self.client.get(self.list_url, **self.auth(self.token1))
+        self.assertEqual(resp.json()['results'][1]['like_count'], 1)
+
+        # unfollowing empties the feed
+        self.client.delete(reverse('unfollow', args=[self.u2.id]), **self.auth(self.token1))
+        resp = self.client.get(self.list_url, **self.auth(self.token1))
+        self.assertEqual(resp.json()['results'], [])
+
+    def test_feed_viewer_state(self):
+        """Feed items tell if the user liked the post and follows the author."""
+        Follow.objects.create(user=self.u1, following=self.u2)
+        p1 = Post.objects.create(text='Liked', author=self.u2)
+        Post.objects.create(text='Not liked', author=self.u2)
+        self.client.post(reverse('post-like', args=[p1.id]), **self.auth(self.token1))
+
+        resp = self.client.get(self.list_url, **self.auth(self.token1))
+        state = {p['text']: (p['liked_by_me'], p['author_followed_by_me']) for p in resp.json()['results']}
+        self.assertEqual(state, {'Liked': (True, True), 'Not liked': (False, True)})
+
+        # on a single post, for another user
+        resp = self.client.get(reverse('post-detail', args=[p1.id]), **self.auth(self.token2))
+        self.assertEqual((resp.json()['liked_by_me'], resp.json()['author_followed_by_me']), (False, False))
+
+    def test_feed_query_count_does_not_depend_on_page_size(self):
+        """The viewer state, likes and tags are loaded in bulk for the whole page."""
+        Follow.objects.create(user=self.u1, following=self.u2)
+        for i in range(6):
+            post = Post.objects.create(text=f'Post {i}', author=self.u2)
+            post.tags.set(['django'])
+
+        def count_queries(limit):
+            cache.clear()
+            local_users.clear()
+            with CaptureQueriesContext(connection) as ctx:
+                resp = self.client.get(self.list_url, {'limit': limit}, **self.auth(self.token1))
+            self.assertEqual(len(resp.json()['results']), limit)
+            return len(ctx)
+
+        self.assertEqual(count_queries(2), count_queries(6))
+
+    def test_search_ranked_with_cursor(self):
+        """The search endpoint returns the matching posts, best matches first."""
+        Post.objects.create(text='Django and Postgres full text search with Django', author=self.u2)
+        Post.objects.create(text='Learning Django', author=self.u1)
+        Post.objects.create(text='Nothing to see here', author=self.u2)
+        search_url = reverse('post-search')
+
+        resp = self.client.get(search_url, {'q': 'django', 'limit': 1})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.json()['results'][0]['text'], 'Django and Postgres full text search with Django')
+
+        resp = self.client.get(resp.json()['next'])
+        self.assertEqual([p['text'] for p in resp.json()['results']], ['Learning Django'])
+        self.assertIsNone(resp.json()['next'])
+
+        # q is required
+        resp = self.client.get(search_url)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_backfill_search_vectors_command(self):
+        """The backfill command fills the vectors of rows created before the trigger."""
+        p = Post.objects.create(text='Old django post', author=self.u2)
+        Post.objects.filter(pk=p.pk).update(search_vector=None)
+
+        call_command('backfill_search_vectors', stdout=StringIO())
+        resp = self.client.get(reverse('post-search'), {'q': 'django'})
+        self.assertEqual([p['text'] for p in resp.json()['results']], ['Old django post'])
+
+    def test_tags_numbered_slugs(self):
+        """Tags whose slug is taken, or empty, get the next numbered slug."""
+        Tag.objects.create(name='djangonaut', slug='djangonaut')
+        for tags in (['Django', '!!'], ['django', '??', 'DJANGO']):
+            resp = self.client.post(self.list_url, {'text': 'Tagged', 'tags': tags}, format='json', **self.auth(self.token1))
+            self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(
+            dict(Tag.objects.values_list('name', 'slug')),
+            {'djangonaut': 'djangonaut', 'Django': 'django', '!!': '', 'django': 'django_1',
+             '??': '_1', 'DJANGO': 'django_2'},
+        )
+
+    def test_trending_tags(self):
+        """Tags used in new posts are ranked once the top is refreshed."""
+        trending_url = reverse('post-trending')
+        for tags in (['Django', 'python'], ['django'], ['redis']):
+            self.client.post(self.list_url, {'text': 'Tagged', 'tags': tags}, format='json', **self.auth(self.token1))
+        # 'django' got a numbered slug, 'Django' has the plain one
+        self.assertEqual(
+            dict(Tag.objects.values_list('name', 'slug')),
+            {'Django': 'django', 'django': 'django_1', 'python': 'python', 'redis': 'redis'},
+        )
+        # served from the precomputed top only
+        self.assertEqual(self.client.get(trending_url).data['results'], [])
+
+        refresh_trending_tags()
+        resp = self.client.get(trending_url)
+        self.assertEqual([t['tag'] for t in resp.json()['results']], ['django', 'python', 'redis'])
+
+    def test_trending_tags_decay(self):
+        """Older uses weigh less than recent ones."""
+        now = 1_000_000_000
+        half_life = settings.TRENDING_HALF_LIFE_SECONDS
+        for _ in range(3):
+            trending.record_tags(['old'], timestamp=now - 2 * half_life)
+        trending.record_tags(['new'], timestamp=now)
+        trending.record_tags(['new'], timestamp=now)
+        top = trending.refresh(now=now)
+        self.assertEqual(top, [{'tag': 'new', 'score': 2.0}, {'tag': 'old', 'score': 0.75}])
+
+    def test_request_metrics(self):
+        """Queries and cache hits are sent in Server-Timing and exported by /metrics."""
+        metrics.reset()
+        Follow.objects.create(user=self.u1, following=self.u2)
+        Post.objects.create(text='Post of u2', author=self.u2)
+        self.client.get(self.list_url, **self.auth(self.token1))
+        resp = self.client.get(self.list_url, **self.auth(self.token1))
+        self.assertIn('db;desc="', resp['Server-Timing'])
+        self.assertIn('cache;desc="1 hits, 0 misses"', resp['Server-Timing'])
+
+        # Only served to staff users and to the bearer of METRICS_TOKEN
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, status.HTTP_403_FORBIDDEN)
+        with override_settings(METRICS_TOKEN='secret'):
+            resp = self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer wrong')
+            self.assertEqual(resp.status_code, status.HTTP_403_FORBIDDEN)
+            resp = self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        User.objects.filter(pk=self.u1.pk).update(is_staff=True)
+        self.client.force_login(self.u1)
+        body = self.client.get(reverse('metrics')).content.decode()
+        self.assertIn('http_requests_total{view="PostViewSet.list",method="GET",status="200"} 2', body)
+        self.assertIn('cache_hits_total{view="PostViewSet.list",method="GET"} 1', body)
+        self.assertIn('cache_misses_total{view="PostViewSet.list",method="GET"} 1', body)
+
+    def test_query_budget_exceeded(self):
+        """A view over its query budget fails the tests."""
+        with mock.patch.object(PostViewSet, 'query_budget', {'list': 1}):
+            with self.assertRaises(QueryBudgetExceeded):
+                self.client.get(self.list_url, **self.auth(self.token1))
+
+    @override_settings(ASYNC_READ_VIEWS=True)
+    def test_async_feed(self):
+        """The plain feed is served by the async view, with the response of the DRF view."""
+        Follow.objects.create(user=self.u1, following=self.u2)
+        for i in range(3):
+            Post.objects.create(text=f'Post {i}', author=self.u2).tags.set(['django'])
+        Like.objects.create(user=self.u1, post=Post.objects.first())
+
+        with mock.patch.object(PostViewSet, 'list', side_effect=AssertionError('sync view used')):
+            async_resp = self.client.get(self.list_url, {'limit': 2}, **self.auth(self.token1))
+            # Filters are not supported by the async view
+            with self.assertRaises(AssertionError):
+                self.client.get(self.list_url, {'tags__name': 'django'}, **self.auth(self.token1))
+        cache.clear()
+        self.assertTrue(iscoroutinefunction(resolve(self.list_url).func))
+        with override_settings(ASYNC_READ_VIEWS=False):
+            # Turned off, the route is the DRF view, without an async wrapper
+            self.assertFalse(iscoroutinefunction(resolve(self.list_url).func))
+            sync_resp = self.client.get(self.list_url, {'limit': 2}, **self.auth(self.token1))
+        self.assertEqual(async_resp.json(), sync_resp.json())
+        self.assertTrue(async_resp.json()['results'][0]['liked_by_me'])
+
+        resp = self.client.get(self.list_url, **self.auth('invalid'))
+        self.assertEqual(resp.status_code, status.HTTP_401_UNAUTHORIZED)
+        # The test client is a WSGI client: the Redis client of the request loop was closed
+        self.assertEqual(len(async_views._clients), 0)
+
+    def image_file(self, size, mode='RGB', exif=None):
+        image = Image.new(mode, size, 'red')
+        buffer = BytesIO()
+        image.save(buffer, 'PNG' if mode == 'RGBA' else 'JPEG', **({'exif': exif} if exif else {}))
+        return SimpleUploadedFile('photo.png' if mode == 'RGBA' else 'photo.jpg', buffer.getvalue())
+
+    def test_image_variants(self):
+        """An uploaded image gets resized WebP/JPEG variants without metadata, and a placeholder."""
+        exif = Image.Exif()
+        exif[0x0112] = 6 # Orientation: rotated 90°
+        exif[0x010F] = 'Camera maker'
+        with TemporaryDirectory() as media_root, override_settings(
+            MEDIA_ROOT=media_root, POST_IMAGE_SIZES={'thumb': 320, 'medium': 720, 'large': 1280},
+        ):
+            resp = self.client.post(
+                self.list_url, {'text': 'Photo', 'tags': ['photo'], 'image': self.image_file((1000, 600), exif=exif.tobytes())},
+                format='multipart', **self.auth(self.token1),
+            )
+            self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+            post = Post.objects.get()
+            # Rotated by the EXIF orientation, the large size would upscale the image
+            self.assertEqual((post.image_width, post.image_height), (600, 1000))
+            self.assertEqual(list(post.image_variants), ['thumb', 'medium'])
+            self.assertEqual(post.image_variants['thumb']['width'], 320)
+            self.assertEqual(post.image_variants['medium']['width'], 600)
+            self.assertTrue(post.image_placeholder.startswith('data:image/jpeg;base64,'))
+            for variant in post.image_variants.values():
+                with Image.open(default_storage.path(variant['webp'])) as webp:
+                    self.assertEqual(webp.format, 'WEBP')
+                with Image.open(default_storage.path(variant['jpeg'])) as jpeg:
+                    self.assertEqual(jpeg.format, 'JPEG')
+                    self.assertEqual(len(jpeg.getexif()), 0)
+
+            resp = self.client.get(reverse('post-detail', args=[post.id]), **self.auth(self.token1))
+            variants = resp.json()['image_variants']
+            self.assertTrue(variants['thumb']['webp'].startswith('http://testserver/media/posts/variants/'))
+            self.assertEqual(resp.json()['image_height'], 1000)
+
+    def test_image_variants_replaced(self):
+        """Changing or removing the image of a post replaces its variants."""
+        with TemporaryDirectory() as media_root, override_settings(MEDIA_ROOT=media_root):
+            resp = self.client.post(
+                self.list_url, {'text': 'Photo', 'image': self.image_file((400, 400), mode='RGBA')},
+                format='multipart', **self.auth(self.token1),
+            )
+            detail = reverse('post-detail', args=[resp.json()['id']])
+            post = Post.objects.get()
+            old_path = post.image_variants['thumb']['jpeg']
+            self.assertEqual(post.image_variants['medium']['width'], 400)
+
+            resp = self.client.patch(
+                detail, {'image': self.image_file((200, 100))}, format='multipart', **self.auth(self.token1),
+            )
+            post.refresh_from_db()
+            self.assertEqual(list(post.image_variants), ['thumb'])
+            self.assertEqual(post.image_variants['thumb']['height'], 100)
+            self.assertTrue(default_storage.exists(post.image_variants['thumb']['jpeg']))
+            self.assertFalse(default_storage.exists(old_path)) # Variants of the previous image
+            old_path = post.image_variants['thumb']['jpeg']
+
+            resp = self.client.patch(detail, {'image': ''}, format='multipart', **self.auth(self.token1))
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            post.refresh_from_db()
+            self.assertEqual((post.image_variants, post.image_width, post.image_placeholder), ({}, None, ''))
+            self.assertFalse(default_storage.exists(old_path))
+
+    def test_image_variants_stale_task(self):
+        """A task whose image was replaced or deleted meanwhile records nothing, deleted posts lose their variants."""
+        with TemporaryDirectory() as media_root, override_settings(MEDIA_ROOT=media_root):
+            resp = self.client.post(
+                self.list_url, {'text': 'Photo', 'image': self.image_file((400, 400))},
+                format='multipart', **self.auth(self.token1),
+            )
+            post = Post.objects.get()
+            variants = post.image_variants
+            old_image = post.image.name
+
+            # The image is replaced while a task of the old image runs
+            process = images.process
+            def replaced_meanwhile(stale):
+                process(stale)
+                Post.objects.filter(pk=post.pk).update(image='posts/other.png')
+            with mock.patch('apps.posts.images.process', side_effect=replaced_meanwhile):
+                process_post_image(post.id)
+            post.refresh_from_db()
+            self.assertEqual(post.image_variants, variants) # Left to the task of the new image
+            self.assertTrue(default_storage.exists(variants['thumb']['jpeg']))
+
+            Post.objects.filter(pk=post.pk).update(image=old_image)
+            with self.captureOnCommitCallbacks(execute=True):
+                resp = self.client.delete(reverse('post-detail', args=[post.id]), **self.auth(self.token1))
+            self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+            self.assertFalse(default_storage.exists(variants['thumb']['jpeg']))
+
+    @override_settings(DATABASE_REPLICAS=['default'], ASYNC_READ_VIEWS=True)
+    def test_read_replica_routing(self):
+        """The feed reads from a replica, except for a user who just wrote."""
+        with mock.patch('config.db_router.random.choice', return_value='default') as choice:
+            resp = self.client.get(self.list_url, **self.auth(self.token1))
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            self.assertEqual(choice.call_count, 1)
+            with override_settings(ASYNC_READ_VIEWS=False):
+                self.client.get(self.list_url, **self.auth(self.token1))
+            self.assertEqual(choice.call_count, 2)
+
+            self.client.post(self.list_url, {'text': 'Hello'}, format='json', **self.auth(self.token1))
+            self.client.get(self.list_url, **self.auth(self.token1))
+            self.assertEqual(choice.call_count, 2) # Pinned to the primary
+            self.client.get(self.list_url, **self.auth(self.token2))
+            self.assertEqual(choice.call_count, 3)
+
+        router = db_router.ReplicaRouter()
+        with mock.patch('config.db_router.random.choice', return_value='replica1'):
+            token = db_router.start()
+            db_router.use_replica(self.u2)
+            self.assertEqual(router.db_for_read(Post), 'replica1')
+            self.assertEqual(router.db_for_write(Post), 'default')
+            db_router.end(token)
+        self.assertIsNone(router.db_for_read(Post))
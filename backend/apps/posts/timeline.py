@@ -0,0 +1,225 @@
+"""
+Materialized home timelines.
+
+Each user has a Redis sorted set with the ids of the newest posts of the
+users they follow, scored by the post creation timestamp. The sets are
+written when a post is created (fan-out on write) and when the user follows
+or unfollows someone, and are rebuilt from the database on a miss. An empty
+timeline is stored as the SENTINEL member alone, so that the feed of a user
+who follows nobody (or only silent users) is not rebuilt on every read; it
+expires after TIMELINE_EMPTY_TTL.
+
+Authors with many followers ("celebrities", see TIMELINE_CELEBRITY_THRESHOLD)
+are not fanned out: their posts are pulled from the database and merged into
+the timeline when it is read.
+"""
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django_redis import get_redis_connection
+
+from apps.follows import graph
+from apps.follows.models import Follow
+from config.async_views import get_redis
+from .models import Post
+
+
+CELEBRITIES_KEY = 'timeline:celebrities' # Set of authors whose posts are pulled
+
+SENTINEL = 0 # Member of an empty timeline, post 0 never exists. Its score of 0 is trimmed first
+
+
+def timeline_key(user_id):
+    """Redis key of the timeline of a user."""
+    return f'timeline:{user_id}'
+
+
+def _score(created_at):
+    return created_at.timestamp()
+
+
+def _trim(pipe, key):
+    # Keep only the newest TIMELINE_MAX_LENGTH entries
+    pipe.zremrangebyrank(key, 0, -settings.TIMELINE_MAX_LENGTH - 1)
+
+
+def is_celebrity(author_id, follower_count):
+    """
+    Tell if the posts of an author are pulled instead of pushed.
+    Once an author is marked as a celebrity it stays one, so that the posts
+    that were never pushed keep being pulled.
+    """
+    threshold = settings.TIMELINE_CELEBRITY_THRESHOLD
+    if threshold is None:
+        return False
+    conn = get_redis_connection('default')
+    if follower_count >= threshold:
+        conn.sadd(CELEBRITIES_KEY, author_id)
+        return True
+    return bool(conn.sismember(CELEBRITIES_KEY, author_id))
+
+
+def get_post_ids(user_id):
+    """
+    Return the post ids in the timeline of a user, newest first.
+    The timeline is rebuilt from the database if it is not in Redis, and
+    the posts of the followed celebrities are merged into it.
+    """
+    conn = get_redis_connection('default')
+    entries = _entries(conn.zrevrange(timeline_key(user_id), 0, -1, withscores=True))
+    if entries is None:
+        entries = rebuild(user_id)
+    return _merge(entries, _pull_celebrity_posts(user_id))
+
+
+async def aget_post_ids(user_id):
+    """get_post_ids() with the async Redis client and ORM."""
+    conn = get_redis()
+    entries = _entries(await conn.zrevrange(timeline_key(user_id), 0, -1, withscores=True))
+    if entries is None:
+        entries = await sync_to_async(rebuild)(user_id)
+    pulled = await _apull_celebrity_posts(user_id)
+    return _merge(entries, pulled)
+
+
+def _entries(members):
+    """(id, score) pairs of a timeline read from Redis, None if it is not stored."""
+    if not members:
+        return None
+    return [(int(post_id), score) for post_id, score in members if int(post_id) != SENTINEL]
+
+
+def _merge(entries, pulled):
+    if pulled:
+        merged = dict(entries)
+        merged.update(pulled)
+        entries = sorted(merged.items(), key=lambda entry: entry[1], reverse=True)
+        entries = entries[:settings.TIMELINE_MAX_LENGTH]
+    return [post_id for post_id, _ in entries]
+
+
+def _celebrity_posts(following_ids):
+    return (
+        Post.objects.filter(author_id__in=following_ids)
+        .order_by('-created_at')
+        .values_list('id', 'created_at')[:settings.TIMELINE_MAX_LENGTH]
+    )
+
+
+def followed_celebrities(user_id):
+    """Ids of the celebrities followed by a user."""
+    if settings.TIMELINE_CELEBRITY_THRESHOLD is None:
+        return set()
+    conn = get_redis_connection('default')
+    celebrity_ids = [int(author_id) for author_id in conn.smembers(CELEBRITIES_KEY)]
+    return graph.followed_among(user_id, celebrity_ids)
+
+
+async def afollowed_celebrities(user_id):
+    if settings.TIMELINE_CELEBRITY_THRESHOLD is None:
+        return set()
+    celebrity_ids = [int(author_id) for author_id in await get_redis().smembers(CELEBRITIES_KEY)]
+    return await graph.afollowed_among(user_id, celebrity_ids)
+
+
+async def _apull_celebrity_posts(user_id):
+    following_ids = await afollowed_celebrities(user_id)
+    if not following_ids:
+        return []
+    return [
+        (post_id, _score(created_at))
+        async for post_id, created_at in _celebrity_posts(following_ids)
+    ]
+
+
+def _pull_celebrity_posts(user_id):
+    """Newest posts of the celebrities followed by a user, as (id, score) pairs."""
+    following_ids = followed_celebrities(user_id)
+    if not following_ids:
+        return []
+    return [
+        (post_id, _score(created_at))
+        for post_id, created_at in _celebrity_posts(following_ids)
+    ]
+
+
+def rebuild(user_id):
+    """
+    Rebuild the timeline of a user from the database.
+    Return the stored entries as (id, score) pairs, newest first.
+    """
+    following_ids = Follow.objects.filter(user_id=user_id).values('following_id')
+    posts = (
+        Post.objects.filter(author_id__in=following_ids)
+        .order_by('-created_at')
+        .values_list('id', 'created_at')[:settings.TIMELINE_MAX_LENGTH]
+    )
+    entries = [(post_id, _score(created_at)) for post_id, created_at in posts]
+    key = timeline_key(user_id)
+    conn = get_redis_connection('default')
+    pipe = conn.pipeline()
+    pipe.delete(key)
+    if entries:
+        pipe.zadd(key, dict(entries))
+    else:
+        pipe.zadd(key, {SENTINEL: 0})
+        pipe.expire(key, settings.TIMELINE_EMPTY_TTL)
+    pipe.execute()
+    return entries
+
+
+def fan_out(post, follower_ids):
+    """
+    Push a post into the timelines of the given followers.
+    Timelines that are not in Redis are skipped, they will be rebuilt
+    (with this post) on the next read.
+    """
+    conn = get_redis_connection('default')
+    keys = [timeline_key(follower_id) for follower_id in follower_ids]
+    if not keys:
+        return
+    pipe = conn.pipeline(transaction=False)
+    for key in keys:
+        pipe.exists(key)
+    existing = [key for key, exists in zip(keys, pipe.execute()) if exists]
+
+    pipe = conn.pipeline(transaction=False)
+    for key in existing:
+        pipe.zadd(key, {post.id: _score(post.created_at)})
+        _trim(pipe, key)
+    pipe.execute()
+
+
+def backfill(user_id, author_id):
+    """Add the newest posts of an author to the timeline of a user."""
+    key = timeline_key(user_id)
+    conn = get_redis_connection('default')
+    if not conn.exists(key):
+        return
+    entries = (
+        Post.objects.filter(author_id=author_id)
+        .order_by('-created_at')
+        .values_list('id', 'created_at')[:settings.TIMELINE_MAX_LENGTH]
+    )
+    mapping = {post_id: _score(created_at) for post_id, created_at in entries}
+    if not mapping:
+        return
+    pipe = conn.pipeline()
+    pipe.zadd(key, mapping)
+    _trim(pipe, key)
+    pipe.execute()
+
+
+def prune(user_id, author_id):
+    """Remove the posts of an author from the timeline of a user."""
+    key = timeline_key(user_id)
+    conn = get_redis_connection('default')
+    if not conn.exists(key):
+        return
+    # Only the newest posts of the author can be in the timeline
+    post_ids = list(
+        Post.objects.filter(author_id=author_id)
+        .order_by('-created_at')
+        .values_list('id', flat=True)[:settings.TIMELINE_MAX_LENGTH]
+    )
+    if post_ids:
+        conn.zrem(key, *post_ids)
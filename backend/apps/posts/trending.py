@@ -0,0 +1,70 @@
+"""
+Trending tags.
+
+Tag uses are counted in Redis hashes, one per time bucket of
+TRENDING_BUCKET_SECONDS. The trending score of a tag is the sum of its counts
+over the last TRENDING_WINDOW_SECONDS, each bucket weighted by an exponential
+decay with a half-life of TRENDING_HALF_LIFE_SECONDS. The top tags are computed
+periodically by the refresh_trending_tags task and served as is.
+"""
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django_redis import get_redis_connection
+
+TOP_KEY = 'trending:top'
+
+
+def bucket_key(bucket):
+    """Redis key of the counters of a time bucket."""
+    return f'trending:bucket:{bucket}'
+
+
+def _bucket(timestamp):
+    return int(timestamp // settings.TRENDING_BUCKET_SECONDS)
+
+
+def record_tags(tags, timestamp=None):
+    """Count one use of each tag."""
+    tags = {tag.strip().lower() for tag in tags if tag.strip()}
+    if not tags:
+        return
+    key = bucket_key(_bucket(time.time() if timestamp is None else timestamp))
+    pipe = get_redis_connection('default').pipeline(transaction=False)
+    for tag in tags:
+        pipe.hincrby(key, tag, 1)
+    # Buckets outside the window are useless
+    pipe.expire(key, settings.TRENDING_WINDOW_SECONDS + settings.TRENDING_BUCKET_SECONDS)
+    pipe.execute()
+
+
+def refresh(now=None):
+    """Compute the top tags over the sliding window and store them."""
+    now = time.time() if now is None else now
+    current = _bucket(now)
+    buckets = range(current - settings.TRENDING_WINDOW_SECONDS // settings.TRENDING_BUCKET_SECONDS + 1, current + 1)
+    pipe = get_redis_connection('default').pipeline(transaction=False)
+    for bucket in buckets:
+        pipe.hgetall(bucket_key(bucket))
+
+    scores = {}
+    for bucket, counts in zip(buckets, pipe.execute()):
+        age = (current - bucket) * settings.TRENDING_BUCKET_SECONDS
+        weight = 0.5 ** (age / settings.TRENDING_HALF_LIFE_SECONDS)
+        for tag, count in counts.items():
+            tag = tag.decode()
+            scores[tag] = scores.get(tag, 0.0) + int(count) * weight
+
+    ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+    top = [
+        {'tag': tag, 'score': round(score, 3)}
+        for tag, score in ranked[:settings.TRENDING_TOP_K]
+    ]
+    cache.set(TOP_KEY, top, timeout=None)
+    return top
+
+
+def top():
+    """The precomputed top tags."""
+    return cache.get(TOP_KEY, [])
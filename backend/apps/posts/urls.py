@@ -1,7 +1,13 @@
+from django.urls import path
 from rest_framework.routers import DefaultRouter
-from .views import PostViewSet
+
+from config.async_views import async_read_view
+from .views import PostViewSet, feed
 
 router = DefaultRouter()
 router.register('', PostViewSet, basename='post')
 
-urlpatterns = router.urls
+urlpatterns = [
+    # Feed served by the async view, before the route of the router
+    path('', async_read_view(feed, PostViewSet.as_view({'get': 'list', 'post': 'create'})), name='post-list'),
+] + router.urls
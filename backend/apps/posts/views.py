@@ -1,14 +1,25 @@
-import sys
-from django.utils.decorators import method_decorator
-from django.views.decorators.cache import cache_page
-from rest_framework import viewsets, permissions
+from rest_framework import viewsets, permissions, status
+from rest_framework.decorators import action
 from rest_framework.filters import SearchFilter, OrderingFilter
+from rest_framework.response import Response
 from django_filters.rest_framework import DjangoFilterBackend
-from django.db.models import Count
 from django.conf import settings
+from django.contrib.postgres.search import SearchQuery, SearchRank
+from django.core.cache import cache
+from django.db.models import F, FloatField
+from django.db.models.functions import Cast
+from django.http import JsonResponse
+from rest_framework.request import Request
 
+from apps.likes import likers
+from apps.likes.engine import get_like_engine
+from config.async_views import authenticate
+from config.db_router import ReplicaReadMixin, ause_replica
+from config.pagination import KeysetPagination
+from . import feed_cache, timeline, trending
 from .models import Post
-from .serializers import PostSerializer
+from .serializers import PostSerializer, aviewer_state
+from .tasks import process_post_image
 
 
 class IsAuthorOrReadOnly(permissions.BasePermission):
@@ -23,12 +34,24 @@ class IsAuthorOrReadOnly(permissions.BasePermission):
         return obj.author == request.user
 
 
-class PostViewSet(viewsets.ModelViewSet):
+class SearchPagination(KeysetPagination):
+    """Cursor pagination of the search results, best matches first."""
+    ordering = ('-rank', '-id')
+
+
+class PostViewSet(ReplicaReadMixin, viewsets.ModelViewSet):
     """
     ViewSet for model Post, with search, filter and ordering capabilities.
     """
     serializer_class   = PostSerializer
     permission_classes = [permissions.IsAuthenticatedOrReadOnly, IsAuthorOrReadOnly]
+    pagination_class   = KeysetPagination # ?cursor= by default, ?limit=&offset= as fallback
+    # Maximum SQL queries per action, whatever the page size (see config/middleware.py),
+    # create and update include the image task, run eagerly in the tests
+    query_budget = {
+        'list': 7, 'retrieve': 6, 'create': 16, 'update': 12, 'partial_update': 12,
+        'destroy': 8, 'search': 3, 'trending_tags': 1,
+    }
 
     # Filters, search and ordering
     filter_backends    = [
@@ -40,32 +63,122 @@ class PostViewSet(viewsets.ModelViewSet):
     search_fields      = ['text']
     ordering_fields    = ['created_at', 'like_count']
     ordering           = ['-created_at']
+    replica_actions    = ('list', 'retrieve', 'search') # Read from a replica (see config/db_router.py)
 
     def get_queryset(self):
-        # queryset with annotation for like count
-        qs = Post.objects.annotate(like_count=Count('likes'))
+        # like_count is a denormalized column, no need to count the likes
+        qs = Post.objects.all()
         if self.action == 'list':
-            # Feed: only posts from users that the authenticated user follows
+            # Feed: posts in the materialized timeline of the authenticated user
             if self.request.user.is_authenticated:
-                following_ids = self.request.user.following.values_list('following_id', flat=True)
-                return qs.filter(author_id__in=following_ids).select_related('author').prefetch_related('tags')
+                post_ids = timeline.get_post_ids(self.request.user.id)
+                return qs.filter(id__in=post_ids).select_related('author').prefetch_related('tags')
             return qs.none()
         # Retrieve, update, destroy: all posts for permissions check
         return qs.select_related('author').prefetch_related('tags')
 
     def list(self, request, *args, **kwargs):
         """
-        List all posts with caching.
+        List the feed with caching.
 
-        - In test mode, no cache is applied.
-        - In production, cache is applied to the list view.
-        - The cache duration is set in settings.CACHE_TTL.
+        - Pages are cached per user and per query string (cursor, limit, filters).
+        - The cache keys are versioned, the versions are bumped when the feed
+          changes (see feed_cache), so the TTL can be long.
+        - The TTL is set in settings.FEED_CACHE_TTL.
         """
-        if 'test' in sys.argv:
+        if not request.user.is_authenticated:
             return super().list(request, *args, **kwargs)
-        # Apply caching for the list view
-        cached_list = cache_page(settings.CACHE_TTL)(super(PostViewSet, self).list)
-        return cached_list(request, *args, **kwargs)
+        key = feed_cache.cache_key(request.user.id, request.query_params)
+        data = cache.get(key)
+        feed_cache.record(hit=data is not None)
+        if data is None:
+            data = super().list(request, *args, **kwargs).data
+            cache.set(key, data, settings.FEED_CACHE_TTL)
+        else:
+            feed_cache.refresh_likes(data['results'])
+        return Response(data)
+
+    @action(detail=False, methods=['get'], pagination_class=SearchPagination, filter_backends=[])
+    def search(self, request):
+        """
+        Full-text search over all posts: ?q=<words>.
+
+        Uses the search_vector column and its GIN index, results are ranked
+        with SearchRank and paginated with a cursor on (rank, id).
+        """
+        terms = request.query_params.get('q', '').strip()
+        if not terms:
+            return Response(
+                {'detail': 'The q parameter is required.'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        query = SearchQuery(terms, config=settings.POST_SEARCH_CONFIG, search_type='websearch')
+        qs = (
+            Post.objects.filter(search_vector=query)
+            # double precision, so that the rank round-trips exactly through the cursor
+            .annotate(rank=Cast(SearchRank(F('search_vector'), query), FloatField()))
+            .select_related('author')
+            .prefetch_related('tags')
+        )
+        page = self.paginate_queryset(qs)
+        serializer = self.get_serializer(page, many=True)
+        return self.get_paginated_response(serializer.data)
+
+    @action(
+        detail=False, methods=['get'], url_path='trending', url_name='trending',
+        pagination_class=None, filter_backends=[]
+    )
+    def trending_tags(self, request):
+        """Trending tags, precomputed by the refresh_trending_tags task."""
+        return Response({'results': trending.top()})
 
     def perform_create(self, serializer):
-        serializer.save(author=self.request.user)
+        # The post is fanned out to the followers by the post_save signal
+        post = serializer.save(author=self.request.user)
+        if post.image:
+            # Resizing is left to a worker, the variants are listed once written
+            process_post_image.delay(post.id)
+
+    def perform_update(self, serializer):
+        post = serializer.save()
+        if 'image' in serializer.validated_data:
+            # New or removed image: replace the variants
+            process_post_image.delay(post.id)
+
+
+FEED_ASYNC_PARAMS = {'cursor', 'limit'} # Filters, ordering and offset need the DRF view
+
+async def feed(request):
+    """
+    Async version of PostViewSet.list for the plain feed (?cursor=&limit=),
+    with the same cache and the same response. See config/async_views.py.
+    """
+    if not set(request.GET) <= FEED_ASYNC_PARAMS:
+        return None
+    user = await authenticate(request)
+    if user is None:
+        return None
+    await ause_replica(user)
+    request = Request(request) # query_params and build_absolute_uri for the pagination
+    request.user = user
+
+    key = await feed_cache.acache_key(user.id, request.query_params)
+    data = await feed_cache.aget_page(key)
+    await feed_cache.arecord(hit=data is not None)
+    if data is not None:
+        await feed_cache.arefresh_likes(data['results'])
+        return JsonResponse(data)
+
+    post_ids = await timeline.aget_post_ids(user.id)
+    posts = Post.objects.filter(id__in=post_ids).select_related('author').prefetch_related('tags')
+    paginator = KeysetPagination()
+    page = await paginator.apaginate_queryset(posts, request)
+    # Everything the serializer needs is loaded here, it does not run any query
+    context = {'request': request, 'viewer_state': await aviewer_state(user, page)}
+    engine = get_like_engine()
+    if engine.live_counts:
+        context['like_counts'] = await engine.alike_counts([post.id for post in page])
+    context['likers_previews'] = await likers.apreviews([post.id for post in page])
+    data = paginator.get_paginated_data(PostSerializer(page, many=True, context=context).data)
+    await feed_cache.aset_page(key, data)
+    return JsonResponse(data)
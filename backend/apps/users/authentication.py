@@ -0,0 +1,160 @@
+"""
+JWT authentication with cached users.
+
+simplejwt's JWTAuthentication loads the user of the token from the database
+on every request. CachedJWTAuthentication looks them up in two layers first:
+
+- an LRU of AUTH_USER_LOCAL_CACHE_SIZE users per process, each kept
+  AUTH_USER_LOCAL_TTL seconds: no network round trip at all;
+- the Django cache (Redis), shared by the processes, for AUTH_USER_CACHE_TTL.
+
+A saved or deleted user is removed from Redis and from the LRU of the process
+(signals.py). The LRUs of the other processes expire it within
+AUTH_USER_LOCAL_TTL, which bounds how long a deactivated user is still
+authenticated. Writes that bypass the signals (``QuerySet.update()``, like
+the follower counters) are not seen before the entries expire.
+
+With JWT_STATELESS_READS, the read-only requests are authenticated with the
+claims of the token alone (a simplejwt TokenUser, whose ``id`` is the id of
+the user): no lookup at all, but a deactivated user can read until their
+access token expires.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.utils.translation import gettext_lazy as _
+from rest_framework.permissions import SAFE_METHODS
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+
+
+def cache_key(user_id):
+    """Cache key of the user authenticated by the tokens of ``user_id``."""
+    return f'auth:user:{user_id}'
+
+
+class LocalUserCache:
+    """Thread-safe LRU of users, with a TTL per entry."""
+
+    def __init__(self):
+        self._users = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        with self._lock:
+            entry = self._users.get(user_id)
+            if entry is None:
+                return None
+            user, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._users[user_id]
+                return None
+            self._users.move_to_end(user_id)
+            return user
+
+    def set(self, user_id, user):
+        with self._lock:
+            self._users[user_id] = (user, time.monotonic() + settings.AUTH_USER_LOCAL_TTL)
+            self._users.move_to_end(user_id)
+            while len(self._users) > settings.AUTH_USER_LOCAL_CACHE_SIZE:
+                self._users.popitem(last=False)
+
+    def delete(self, user_id):
+        with self._lock:
+            self._users.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._users.clear()
+
+
+local_users = LocalUserCache()
+
+
+def _load(user_id):
+    """Load a user from the database and cache it, None if there is none."""
+    # The password hash stays out of the cache, nothing authenticated by a token needs it
+    user = get_user_model().objects.defer('password').filter(**{api_settings.USER_ID_FIELD: user_id}).first()
+    if user is not None:
+        cache.set(cache_key(user_id), user, settings.AUTH_USER_CACHE_TTL)
+        local_users.set(user_id, user)
+    return user
+
+
+def get_user(user_id):
+    """User of the tokens of ``user_id``, from the caches or the database."""
+    user = local_users.get(user_id)
+    if user is None:
+        user = cache.get(cache_key(user_id))
+        if user is None:
+            return _load(user_id)
+        local_users.set(user_id, user)
+    return user
+
+
+async def aget_user(user_id):
+    user = local_users.get(user_id)
+    if user is None:
+        user = await cache.aget(cache_key(user_id))
+        if user is None:
+            return await sync_to_async(_load)(user_id)
+        local_users.set(user_id, user)
+    return user
+
+
+def invalidate(user_id):
+    """Drop a user from the caches, after a change."""
+    local_users.delete(user_id)
+    cache.delete(cache_key(user_id))
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    """JWTAuthentication with the users cached, see the module docstring."""
+
+    def authenticate(self, request):
+        header = self.get_header(request)
+        if header is None:
+            return None
+        raw_token = self.get_raw_token(header)
+        if raw_token is None:
+            return None
+        validated_token = self.get_validated_token(raw_token)
+        if settings.JWT_STATELESS_READS and request.method in SAFE_METHODS:
+            return self.get_token_user(validated_token), validated_token
+        return self.get_user(validated_token), validated_token
+
+    def get_token_user(self, validated_token):
+        """Stateless user backed by the claims of the token."""
+        if api_settings.USER_ID_CLAIM not in validated_token:
+            raise InvalidToken(_('Token contained no recognizable user identification'))
+        return api_settings.TOKEN_USER_CLASS(validated_token)
+
+    def _user_id(self, validated_token):
+        try:
+            return validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise InvalidToken(_('Token contained no recognizable user identification'))
+
+    def _check(self, user):
+        if user is None:
+            raise AuthenticationFailed(_('User not found'), code='user_not_found')
+        if api_settings.CHECK_USER_IS_ACTIVE and not user.is_active:
+            raise AuthenticationFailed(_('User is inactive'), code='user_inactive')
+        return user
+
+    def get_user(self, validated_token):
+        if api_settings.CHECK_REVOKE_TOKEN:
+            # Needs the password hash, which is not cached
+            return super().get_user(validated_token)
+        return self._check(get_user(self._user_id(validated_token)))
+
+    async def aget_user(self, validated_token):
+        if api_settings.CHECK_REVOKE_TOKEN:
+            return await sync_to_async(super().get_user)(validated_token)
+        return self._check(await aget_user(self._user_id(validated_token)))
@@ -0,0 +1,28 @@
+"""
+Password hashers tuned for the login throughput.
+
+Django's defaults cost about 250ms of CPU per login (PBKDF2 with 1,000,000
+iterations, or Argon2 with 100MB of memory and 8 lanes). The hashers below
+use the OWASP minimums instead, at a fraction of the CPU per login. The
+PASSWORD_HASHER_PROFILE setting picks the one that hashes new passwords, the
+older hashes are upgraded when their user logs in (Django rehashes a
+password whose algorithm or parameters differ from the preferred hasher).
+
+Measure them with ``python -m benchmarks.login``.
+"""
+from django.contrib.auth.hashers import Argon2PasswordHasher, ScryptPasswordHasher
+
+
+class TunedArgon2PasswordHasher(Argon2PasswordHasher):
+    """Argon2id, 19 MiB of memory, 2 iterations, 1 lane."""
+    time_cost = 2
+    memory_cost = 19 * 1024 # KiB
+    parallelism = 1
+
+
+class TunedScryptPasswordHasher(ScryptPasswordHasher):
+    """scrypt, N=2^15, r=8, p=1: 32 MiB of memory."""
+    work_factor = 2 ** 15
+    block_size = 8
+    parallelism = 1
+    maxmem = 64 * 1024 * 1024 # OpenSSL refuses more than 32 MiB by default
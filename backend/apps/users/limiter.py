@@ -0,0 +1,57 @@
+"""
+Login attempt limiter.
+
+Failed logins are counted in Redis per (email, client IP) pair and per
+client IP, in fixed windows of LOGIN_ATTEMPT_WINDOW seconds. Once a pair
+reached LOGIN_MAX_FAILURES_PER_EMAIL, or an IP LOGIN_MAX_FAILURES_PER_IP, its
+login requests are refused with a 429 until the window ends, before any
+password is hashed: a brute force or credential stuffing run costs no CPU. A
+successful login resets the counter of the pair.
+
+The email counter is per IP so that bad attempts from one IP do not lock
+the owner of the email out. The trade-off: a brute force of one email spread
+over many IPs gets LOGIN_MAX_FAILURES_PER_EMAIL attempts per IP and window.
+"""
+from django.conf import settings
+from django_redis import get_redis_connection
+
+
+def email_key(email, ip):
+    """Redis key of the failed logins of an email from an IP."""
+    return f'login:failures:email:{ip}:{email}'
+
+
+def ip_key(ip):
+    """Redis key of the failed logins from an IP."""
+    return f'login:failures:ip:{ip}'
+
+
+def _limits(email, ip):
+    return ((email_key(email, ip), settings.LOGIN_MAX_FAILURES_PER_EMAIL), (ip_key(ip), settings.LOGIN_MAX_FAILURES_PER_IP))
+
+
+def retry_after(email, ip):
+    """Seconds until the email and the IP may log in again, 0 when they may now."""
+    pipe = get_redis_connection('default').pipeline(transaction=False)
+    for key, _ in _limits(email, ip):
+        pipe.get(key)
+        pipe.ttl(key)
+    results = pipe.execute()
+    wait = 0
+    for (_, limit), failures, ttl in zip(_limits(email, ip), results[::2], results[1::2]):
+        if failures is not None and int(failures) >= limit:
+            wait = max(wait, ttl, 1)
+    return wait
+
+
+def record_failure(email, ip):
+    pipe = get_redis_connection('default').pipeline(transaction=False)
+    for key, _ in _limits(email, ip):
+        # The window starts with the first failure, INCR keeps the expiry
+        pipe.set(key, 0, ex=settings.LOGIN_ATTEMPT_WINDOW, nx=True)
+        pipe.incr(key)
+    pipe.execute()
+
+
+def reset(email, ip):
+    get_redis_connection('default').delete(email_key(email, ip))
@@ -0,0 +1,31 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db.models import Count
+from django.db.models.functions import Lower
+
+class Command(BaseCommand):
+    help = (
+        'List the users whose emails only differ by their case. The migration that '
+        'lowercased the emails left them as is: logins look up the lowercase email, '
+        'so the accounts without it cannot log in until their email is changed.'
+    )
+
+    def handle(self, *args, **options):
+        User = get_user_model()
+        duplicates = (
+            User.objects.annotate(lower_email=Lower('email')).values('lower_email')
+            .annotate(count=Count('id')).filter(count__gt=1).values_list('lower_email', flat=True)
+        )
+        users = (
+            User.objects.annotate(lower_email=Lower('email')).filter(lower_email__in=duplicates)
+            .order_by('lower_email', 'id')
+        )
+        count = 0
+        for user in users:
+            login = 'can log in' if user.email == user.lower_email else 'cannot log in'
+            self.stdout.write(f'{user.lower_email}\tid={user.id}\temail={user.email}\t{login}')
+            count += 1
+        if count:
+            self.stdout.write(self.style.WARNING(f'{count} users share an email with another user.'))
+        else:
+            self.stdout.write(self.style.SUCCESS('No duplicate emails.'))
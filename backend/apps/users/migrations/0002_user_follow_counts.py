@@ -0,0 +1,44 @@
+# Generated by Django 5.2 on 2026-10-18 19:34
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def backfill_follow_counts(apps, schema_editor):
+    User = apps.get_model('users', 'User')
+    Follow = apps.get_model('follows', 'Follow')
+
+    def count(field):
+        return Coalesce(Subquery(
+            Follow.objects.filter(**{field: OuterRef('pk')})
+            .order_by().values(field)
+            .annotate(count=Count('id')).values('count')
+        ), 0)
+
+    User.objects.update(
+        follower_count=count('following'),
+        following_count=count('user'),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0001_initial'),
+        ('follows', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='follower_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='following_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_follow_counts, migrations.RunPython.noop),
+    ]
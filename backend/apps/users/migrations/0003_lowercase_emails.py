@@ -0,0 +1,34 @@
+# Generated by Django 5.2 on 2026-10-18 20:56
+
+import apps.users.models
+from django.db import migrations
+from django.db.models import Exists, OuterRef
+from django.db.models.functions import Lower
+
+
+def lowercase_emails(apps, schema_editor):
+    User = apps.get_model('users', 'User')
+    # An email that differs from another one only by its case is left as is,
+    # lowercasing it would break the unique constraint. These users are listed
+    # by `manage.py duplicate_emails`, to be fixed by hand
+    duplicate = User.objects.annotate(lower_email=Lower('email')).filter(
+        lower_email=Lower(OuterRef('email')),
+    ).exclude(pk=OuterRef('pk'))
+    User.objects.exclude(email=Lower('email')).exclude(Exists(duplicate)).update(email=Lower('email'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0002_user_follow_counts'),
+    ]
+
+    operations = [
+        migrations.AlterModelManagers(
+            name='user',
+            managers=[
+                ('objects', apps.users.models.UserManager()),
+            ],
+        ),
+        migrations.RunPython(lowercase_emails, migrations.RunPython.noop),
+    ]
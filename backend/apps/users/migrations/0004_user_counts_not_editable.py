@@ -0,0 +1,23 @@
+# Generated by Django 5.2 on 2026-10-18 21:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0003_lowercase_emails'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='user',
+            name='follower_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AlterField(
+            model_name='user',
+            name='following_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+    ]
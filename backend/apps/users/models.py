@@ -1,8 +1,27 @@
-from django.contrib.auth.models import AbstractUser
+from django.contrib.auth.models import AbstractUser, UserManager as DjangoUserManager
 from django.db import models
 
-class User(AbstractUser):
+from config.models import CounterFieldsMixin
+
+class UserManager(DjangoUserManager):
+    """Users with lowercase emails, looked up with a lowercase email at login."""
+
+    @classmethod
+    def normalize_email(cls, email):
+        return (email or '').strip().lower()
+
+    def get_by_natural_key(self, email):
+        # Plain equality, served by the unique index on email
+        return self.get(email=self.normalize_email(email))
+
+class User(CounterFieldsMixin, AbstractUser):
     email = models.EmailField('e-mail', unique=True)
+    follower_count = models.PositiveIntegerField(default=0, editable=False) # Denormalized number of followers
+    following_count = models.PositiveIntegerField(default=0, editable=False) # Denormalized number of users followed
+
+    objects = UserManager()
+
+    counter_fields = ('follower_count', 'following_count')
 
     USERNAME_FIELD = 'email'
     REQUIRED_FIELDS = ['username']
@@ -0,0 +1,163 @@
+"""
+Profile summaries cache.
+
+The summary of a user (username, follower/following counts, number of posts
+and of likes given, id of the latest post) is kept in a Redis hash per user,
+loaded from the database on a miss and expired after PROFILE_CACHE_TTL.
+``summaries()`` reads any number of them with one pipelined round trip, and
+loads the missing ones with one query. The ids of users that do not exist are
+cached too, as a hash holding the MISSING field only, dropped when the user
+is created. Any client can request any id, so these expire after the short
+PROFILE_MISSING_TTL: the number of them in Redis is bounded by the request rate.
+
+The hashes are written through on post, follow and like changes (signals.py,
+and the bulk follow and like code paths since bulk_create sends no signal).
+Like graph.py, the write only updates the hashes that are loaded: a missing
+hash is left to the next load. A change the hash cannot follow (a username
+change, the deletion of the latest post, likes written behind by the redis
+likes engine) deletes it instead.
+
+The counters of a loaded hash can drift when a write races with its load, or
+when the counter columns are fixed by the reconcile tasks: the TTL bounds it.
+"""
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db.models import Count, IntegerField, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django_redis import get_redis_connection
+
+from apps.likes.models import Like
+from apps.posts.models import Post
+
+MISSING = 'missing'
+
+FIELDS = ('username', 'follower_count', 'following_count', 'post_count', 'like_count', 'latest_post_id')
+
+# Add ARGV[2i] to the field ARGV[2i - 1] of the profile KEYS[i], for the
+# profiles that are loaded.
+INCREMENT_SCRIPT = """
+for i = 1, #KEYS do
+    if redis.call('EXISTS', KEYS[i]) == 1 then
+        redis.call('HINCRBY', KEYS[i], ARGV[2 * i - 1], ARGV[2 * i])
+    end
+end
+"""
+
+# Count the post ARGV[2] created (ARGV[1] = 1) or deleted (ARGV[1] = -1) in
+# the profile KEYS[1], if it is loaded. The latest post cannot be replaced
+# by the previous one without a query: its deletion drops the profile.
+POST_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return
+end
+local latest = tonumber(redis.call('HGET', KEYS[1], 'latest_post_id')) or 0
+local post_id = tonumber(ARGV[2])
+if ARGV[1] == '1' then
+    redis.call('HINCRBY', KEYS[1], 'post_count', 1)
+    if post_id > latest then
+        redis.call('HSET', KEYS[1], 'latest_post_id', post_id)
+    end
+elseif post_id == latest then
+    redis.call('DEL', KEYS[1])
+else
+    redis.call('HINCRBY', KEYS[1], 'post_count', -1)
+end
+"""
+
+
+def profile_key(user_id):
+    """Redis key of the profile summary of a user."""
+    return f'profile:{user_id}'
+
+
+def _load(user_ids):
+    """
+    Load the profiles of the users from the database with one query, return
+    the ones that exist by id.
+    """
+    def count(model, field):
+        rows = model.objects.filter(**{field: OuterRef('pk')}).order_by().values(field)
+        return Coalesce(Subquery(rows.annotate(count=Count('*')).values('count'), output_field=IntegerField()), 0)
+
+    rows = get_user_model().objects.filter(id__in=user_ids).annotate(
+        post_count=count(Post, 'author'),
+        like_count=count(Like, 'user'),
+        latest_post_id=Coalesce(
+            Subquery(Post.objects.filter(author=OuterRef('pk')).order_by('-created_at', '-id').values('id')[:1]),
+            0,
+        ),
+    ).values('id', *FIELDS)
+    profiles = {row.pop('id'): row for row in rows}
+    pipe = get_redis_connection('default').pipeline()
+    for user_id in user_ids:
+        if user_id in profiles:
+            pipe.hset(profile_key(user_id), mapping=profiles[user_id])
+            pipe.expire(profile_key(user_id), settings.PROFILE_CACHE_TTL)
+        else:
+            pipe.hset(profile_key(user_id), mapping={MISSING: 1})
+            pipe.expire(profile_key(user_id), settings.PROFILE_MISSING_TTL)
+    pipe.execute()
+    return profiles
+
+
+def _summary(user_id, profile):
+    summary = {'id': user_id, 'username': profile['username']}
+    for field in FIELDS[1:]:
+        summary[field] = max(int(profile[field]), 0) # A drifted counter never shows negative
+    summary['latest_post_id'] = summary['latest_post_id'] or None
+    return summary
+
+
+def summaries(user_ids):
+    """
+    Profile summaries of the users, in the order of ``user_ids``. The users
+    that do not exist are left out.
+    """
+    user_ids = list(dict.fromkeys(user_ids))
+    if not user_ids:
+        return []
+    pipe = get_redis_connection('default').pipeline(transaction=False)
+    for user_id in user_ids:
+        pipe.hgetall(profile_key(user_id))
+    cached = dict(zip(user_ids, pipe.execute()))
+    missing = [user_id for user_id, values in cached.items() if not values]
+    loaded = _load(missing) if missing else {}
+    result = []
+    for user_id in user_ids:
+        if cached[user_id]:
+            if MISSING.encode() in cached[user_id]:
+                continue
+            profile = {field.decode(): value.decode() for field, value in cached[user_id].items()}
+            result.append(_summary(user_id, profile))
+        elif user_id in loaded:
+            result.append(_summary(user_id, loaded[user_id]))
+    return result
+
+
+def increment(changes):
+    """Write through counter changes, an iterable of (user_id, field, amount)."""
+    changes = list(changes)
+    if not changes:
+        return
+    update = get_redis_connection('default').register_script(INCREMENT_SCRIPT)
+    update(
+        keys=[profile_key(user_id) for user_id, _, _ in changes],
+        args=[arg for _, field, amount in changes for arg in (field, amount)],
+    )
+
+
+def post_added(user_id, post_id):
+    """Write through a new post of a user."""
+    get_redis_connection('default').register_script(POST_SCRIPT)(keys=[profile_key(user_id)], args=[1, post_id])
+
+
+def post_removed(user_id, post_id):
+    """Write through the deletion of a post of a user."""
+    get_redis_connection('default').register_script(POST_SCRIPT)(keys=[profile_key(user_id)], args=[-1, post_id])
+
+
+def expire(user_ids):
+    """Drop the profiles of the users, they are reloaded by the next read."""
+    user_ids = list(user_ids)
+    if user_ids:
+        get_redis_connection('default').delete(*(profile_key(user_id) for user_id in user_ids))
@@ -1,10 +1,19 @@
 from rest_framework import serializers
+from rest_framework.validators import UniqueValidator
 from django.contrib.auth import get_user_model
+from config.metrics import TimedSerializerMixin
 
 User = get_user_model()
 
-class RegisterSerializer(serializers.ModelSerializer):
+class LowercaseEmailField(serializers.EmailField):
+    """Email normalized like User.email, before the unique validator runs."""
+
+    def to_internal_value(self, data):
+        return User.objects.normalize_email(super().to_internal_value(data))
+
+class RegisterSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     password = serializers.CharField(write_only=True, min_length=8)
+    email = LowercaseEmailField(max_length=254, validators=[UniqueValidator(queryset=User.objects.all())])
 
     class Meta:
         model = User
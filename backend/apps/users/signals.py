@@ -0,0 +1,60 @@
+"""
+Keep the users cached by CachedJWTAuthentication and the profile summaries in
+sync with the users, posts, follows and likes, whatever code path (API,
+admin, shell) saves them. bulk_create sends no signal, its callers update the
+profiles themselves.
+"""
+from django.contrib.auth import get_user_model
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from apps.follows.models import Follow
+from apps.likes.models import Like
+from apps.posts.models import Post
+from . import authentication, profiles
+
+
+@receiver([post_save, post_delete], sender=get_user_model())
+def user_changed(sender, instance, **kwargs):
+    # Deactivations, password and profile changes are seen by the next request
+    authentication.invalidate(instance.pk)
+    profiles.expire([instance.pk])
+
+
+@receiver(post_save, sender=Post)
+def post_saved(sender, instance, created, **kwargs):
+    if created:
+        profiles.post_added(instance.author_id, instance.id)
+
+
+@receiver(post_delete, sender=Post)
+def post_deleted(sender, instance, **kwargs):
+    profiles.post_removed(instance.author_id, instance.id)
+
+
+@receiver(post_save, sender=Follow)
+def follow_saved(sender, instance, created, **kwargs):
+    if created:
+        profiles.increment([
+            (instance.user_id, 'following_count', 1),
+            (instance.following_id, 'follower_count', 1),
+        ])
+
+
+@receiver(post_delete, sender=Follow)
+def follow_deleted(sender, instance, **kwargs):
+    profiles.increment([
+        (instance.user_id, 'following_count', -1),
+        (instance.following_id, 'follower_count', -1),
+    ])
+
+
+@receiver(post_save, sender=Like)
+def like_saved(sender, instance, created, **kwargs):
+    if created:
+        profiles.increment([(instance.user_id, 'like_count', 1)])
+
+
+@receiver(post_delete, sender=Like)
+def like_deleted(sender, instance, **kwargs):
+    profiles.increment([(instance.user_id, 'like_count', -1)])
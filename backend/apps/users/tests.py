@@ -1,12 +1,28 @@
+from io import StringIO
+
+from django.conf import settings
 from django.urls import reverse
 from rest_framework import status
 from rest_framework.test import APITestCase
 from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from django_redis import get_redis_connection
+
+from apps.follows.models import Follow
+from apps.likes.models import Like
+from apps.posts.models import Post
+from apps.users import authentication, profiles
 
 User = get_user_model()
 
 class UserAuthTests(APITestCase):
     def setUp(self):
+        cache.clear()
         self.register_url = reverse('user-register')
         self.login_url    = reverse('token-obtain-pair')
         self.refresh_url  = reverse('token-refresh')
@@ -69,3 +85,209 @@ class UserAuthTests(APITestCase):
         }, format='json')
         self.assertEqual(refresh_resp.status_code, status.HTTP_200_OK)
         self.assertIn('access', refresh_resp.data)
+
+    def auth_headers(self, user):
+        resp = self.client.post(self.login_url, {
+            'email': user.email, 'password': self.user_data['password'],
+        }, format='json')
+        return {'HTTP_AUTHORIZATION': f"Bearer {resp.data['access']}"}
+
+    def test_authenticated_user_cached(self):
+        """The user of a token is loaded once, then served by the caches until it changes."""
+        cache.clear()
+        user = User.objects.create_user(**self.user_data)
+        headers = self.auth_headers(user)
+        url = reverse('followers-list')
+
+        def count_queries():
+            with CaptureQueriesContext(connection) as ctx:
+                resp = self.client.get(url, **headers)
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            return len(ctx)
+
+        self.assertEqual(count_queries(), 2) # The user and the list
+        self.assertEqual(count_queries(), 1) # The user from the local LRU
+        authentication.local_users.clear()
+        self.assertEqual(count_queries(), 1) # The user from Redis
+        self.assertNotIn('password', cache.get(authentication.cache_key(user.id)).__dict__)
+
+        # Saving the user drops it from the caches, a deactivation is seen right away
+        user.is_active = False
+        user.save()
+        resp = self.client.get(url, **headers)
+        self.assertEqual(resp.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    @override_settings(JWT_STATELESS_READS=True)
+    def test_stateless_reads(self):
+        """Read-only requests are authenticated by the claims of the token alone."""
+        user = User.objects.create_user(**self.user_data)
+        headers = self.auth_headers(user)
+        User.objects.filter(pk=user.pk).update(is_active=False) # Not seen by the claims
+        with CaptureQueriesContext(connection) as ctx:
+            resp = self.client.get(reverse('followers-list'), **headers)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(ctx), 1) # The list only
+        # Writes still load the user
+        resp = self.client.post(reverse('follow-bulk'), {'user_ids': [user.id]}, format='json', **headers)
+        self.assertEqual(resp.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_duplicate_emails_command(self):
+        """The users whose emails only differ by their case are listed."""
+        User.objects.create_user(**self.user_data)
+        User.objects.create_user(email='other@example.com', username='other', password='strongpass123')
+        twin = User.objects.create_user(email='x@example.com', username='twin', password='strongpass123')
+        User.objects.filter(pk=twin.pk).update(email='Test@Example.com') # Left by 0003_lowercase_emails
+        out = StringIO()
+        call_command('duplicate_emails', stdout=out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual([line.split('\t')[2:] for line in lines[:2]], [
+            ['email=test@example.com', 'can log in'], ['email=Test@Example.com', 'cannot log in'],
+        ])
+        self.assertIn('2 users share an email', lines[2])
+
+    def test_full_save_keeps_follow_counts(self):
+        """Saving a user loaded before a follow does not write back their old counters."""
+        user = User.objects.create_user(**self.user_data)
+        other = User.objects.create_user(email='other@example.com', username='other', password='strongpass123')
+        stale = User.objects.get(pk=user.pk)
+        resp = self.client.post(reverse('follow', args=[user.id]), **self.auth_headers(other))
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        stale.first_name = 'Test'
+        stale.save()
+        user.refresh_from_db()
+        self.assertEqual((user.first_name, user.follower_count), ('Test', 1))
+
+    def test_login_email_case_insensitive(self):
+        """Emails are stored lowercase and matched whatever their case."""
+        resp = self.client.post(self.register_url, {**self.user_data, 'email': 'Test@Example.com'}, format='json')
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(User.objects.get().email, 'test@example.com')
+        resp = self.client.post(self.register_url, {**self.user_data, 'email': 'TEST@example.com'}, format='json')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+        resp = self.client.post(self.login_url, {
+            'email': ' TEST@example.COM', 'password': self.user_data['password'],
+        }, format='json')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+
+    def test_login_upgrades_password_hash(self):
+        """A password hashed by another hasher is rehashed with the preferred one on login."""
+        user = User.objects.create_user(**self.user_data)
+        User.objects.filter(pk=user.pk).update(
+            password=make_password(self.user_data['password'], hasher='pbkdf2_sha256'),
+        )
+        resp = self.client.post(self.login_url, {
+            'email': self.user_data['email'], 'password': self.user_data['password'],
+        }, format='json')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        user.refresh_from_db()
+        self.assertTrue(user.password.startswith('argon2$argon2id$v=19$m=19456,t=2,p=1$'))
+
+    @override_settings(LOGIN_MAX_FAILURES_PER_EMAIL=3)
+    def test_login_failures_limited(self):
+        """Logins are refused once an email failed too many times, until the window ends."""
+        User.objects.create_user(**self.user_data)
+        credentials = {'email': self.user_data['email'], 'password': 'wrongpass'}
+        for _ in range(3):
+            resp = self.client.post(self.login_url, credentials, format='json')
+            self.assertEqual(resp.status_code, status.HTTP_401_UNAUTHORIZED)
+
+        # Refused before the password is checked, even the right one
+        credentials['password'] = self.user_data['password']
+        resp = self.client.post(self.login_url, {**credentials, 'email': 'TEST@example.com'}, format='json')
+        self.assertEqual(resp.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertGreater(int(resp['Retry-After']), 0)
+
+        # The owner of the email is not locked out from another IP
+        resp = self.client.post(self.login_url, credentials, format='json', REMOTE_ADDR='10.0.0.2')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+
+        cache.clear() # The window ended
+        resp = self.client.post(self.login_url, credentials, format='json')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+
+    @override_settings(LOGIN_MAX_FAILURES_PER_EMAIL=3)
+    def test_login_failures_limited_forwarded_for(self):
+        """A client cannot escape the limits by rotating X-Forwarded-For, unless behind NUM_PROXIES proxies."""
+        User.objects.create_user(**self.user_data)
+        credentials = {'email': self.user_data['email'], 'password': 'wrongpass'}
+        for i in range(3):
+            resp = self.client.post(self.login_url, credentials, format='json', HTTP_X_FORWARDED_FOR=f'10.1.0.{i}')
+            self.assertEqual(resp.status_code, status.HTTP_401_UNAUTHORIZED)
+        resp = self.client.post(self.login_url, credentials, format='json', HTTP_X_FORWARDED_FOR='10.1.0.9')
+        self.assertEqual(resp.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+
+        # Behind one proxy, the client IP is the last address it appended
+        with override_settings(REST_FRAMEWORK={**settings.REST_FRAMEWORK, 'NUM_PROXIES': 1}):
+            resp = self.client.post(
+                self.login_url, credentials, format='json', HTTP_X_FORWARDED_FOR='1.2.3.4, 10.1.0.9',
+            )
+        self.assertEqual(resp.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_profile_summary(self):
+        """The profile summary is loaded once, then written through on posts, follows and likes."""
+        user = User.objects.create_user(**self.user_data)
+        other = User.objects.create_user(email='other@example.com', username='other', password='strongpass123')
+        first = Post.objects.create(author=user, text='first')
+        url = reverse('user-profile', args=[user.id])
+
+        resp = self.client.get(url)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.data, {
+            'id': user.id, 'username': 'testuser', 'follower_count': 0, 'following_count': 0,
+            'post_count': 1, 'like_count': 0, 'latest_post_id': first.id,
+        })
+
+        second = Post.objects.create(author=user, text='second')
+        Follow.objects.create(user=other, following=user)
+        Like.objects.create(user=user, post=first)
+        with CaptureQueriesContext(connection) as ctx:
+            resp = self.client.get(url)
+        self.assertEqual(len(ctx), 0) # Served by the Redis hash
+        self.assertEqual(resp.data['post_count'], 2)
+        self.assertEqual(resp.data['latest_post_id'], second.id)
+        self.assertEqual(resp.data['follower_count'], 1)
+        self.assertEqual(resp.data['like_count'], 1)
+
+        # Deleting the latest post reloads the profile
+        second.delete()
+        resp = self.client.get(url)
+        self.assertEqual(resp.data['post_count'], 1)
+        self.assertEqual(resp.data['latest_post_id'], first.id)
+
+        # An unknown id is cached too, until the user is created
+        missing_url = reverse('user-profile', args=[other.id + 1])
+        self.assertEqual(self.client.get(missing_url).status_code, status.HTTP_404_NOT_FOUND)
+        with CaptureQueriesContext(connection) as ctx:
+            resp = self.client.get(missing_url)
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(len(ctx), 0)
+        # Briefly: anyone can request any id
+        ttl = get_redis_connection('default').ttl(profiles.profile_key(other.id + 1))
+        self.assertTrue(0 < ttl <= settings.PROFILE_MISSING_TTL)
+        User.objects.create_user(email='new@example.com', username='new', password='strongpass123')
+        self.assertEqual(self.client.get(missing_url).data['username'], 'new')
+
+    def test_profile_summaries_batch(self):
+        """A page of authors is hydrated with one Redis round trip and no query once cached."""
+        users = [
+            User.objects.create_user(email=f'user{i}@example.com', username=f'user{i}', password='strongpass123')
+            for i in range(50)
+        ]
+        ids = [user.id for user in reversed(users)] + [users[-1].id + 1] # An unknown id is left out
+        url = reverse('user-profiles') + '?ids=' + ','.join(map(str, ids))
+
+        with CaptureQueriesContext(connection) as ctx:
+            resp = self.client.get(url)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(ctx), 1) # The 50 profiles with one query
+        self.assertEqual([profile['id'] for profile in resp.data['results']], ids[:-1])
+
+        with CaptureQueriesContext(connection) as ctx:
+            resp = self.client.get(url)
+        self.assertEqual(len(ctx), 0)
+        self.assertEqual(len(resp.data['results']), 50)
+
+        for query in ('', '?ids=1,a', '?ids=' + ','.join(['1'] * 101)):
+            resp = self.client.get(reverse('user-profiles') + query)
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
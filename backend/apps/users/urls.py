@@ -1,12 +1,11 @@
 from django.urls import path
-from .views import RegisterView
-from rest_framework_simplejwt.views import (
-    TokenObtainPairView,
-    TokenRefreshView,
-)
+from .views import LoginView, ProfileListView, ProfileView, RegisterView
+from rest_framework_simplejwt.views import TokenRefreshView
 
 urlpatterns = [
+    path('', ProfileListView.as_view(), name='user-profiles'),
+    path('<int:user_id>/', ProfileView.as_view(), name='user-profile'),
     path('register/', RegisterView.as_view(), name='user-register'),
-    path('login/',    TokenObtainPairView.as_view(), name='token-obtain-pair'),
+    path('login/',    LoginView.as_view(), name='token-obtain-pair'),
     path('refresh/',  TokenRefreshView.as_view(), name='token-refresh'),
 ]
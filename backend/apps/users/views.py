@@ -1,7 +1,70 @@
+from django.conf import settings
+from django.contrib.auth import get_user_model
 from rest_framework import generics, permissions
+from rest_framework.exceptions import AuthenticationFailed, NotFound, Throttled, ValidationError
+from rest_framework.response import Response
+from rest_framework.throttling import BaseThrottle
+from rest_framework.views import APIView
+from rest_framework_simplejwt.views import TokenObtainPairView
+
+from . import limiter, profiles
 from .serializers import RegisterSerializer
 
+User = get_user_model()
+
 class RegisterView(generics.CreateAPIView):
     """View for user registration"""
     serializer_class = RegisterSerializer
     permission_classes = (permissions.AllowAny,)
+    query_budget = 3
+
+class LoginView(TokenObtainPairView):
+    """
+    Obtain a token pair, with the failed attempts limited per email and IP
+    and per IP (see apps/users/limiter.py).
+    """
+    query_budget = 2 # The user, and the upgrade of an outdated password hash
+
+    def post(self, request, *args, **kwargs):
+        email = User.objects.normalize_email(str(request.data.get(User.USERNAME_FIELD, '')))
+        ip = BaseThrottle().get_ident(request) # REMOTE_ADDR, unless behind NUM_PROXIES proxies
+        wait = limiter.retry_after(email, ip)
+        if wait:
+            raise Throttled(wait=wait)
+        try:
+            response = super().post(request, *args, **kwargs)
+        except AuthenticationFailed:
+            limiter.record_failure(email, ip)
+            raise
+        limiter.reset(email, ip)
+        return response
+
+class ProfileView(APIView):
+    """Profile summary of a user, from the profiles cache (see apps/users/profiles.py)."""
+    permission_classes = [permissions.AllowAny]
+    query_budget = 2 # The authenticated user and the profile, on cache misses
+
+    def get(self, request, user_id):
+        summaries = profiles.summaries([user_id])
+        if not summaries:
+            raise NotFound()
+        return Response(summaries[0])
+
+class ProfileListView(APIView):
+    """
+    Profile summaries of the users of ?ids=1,2,3, in that order. The ids of
+    users that do not exist are left out.
+    """
+    permission_classes = [permissions.AllowAny]
+    query_budget = 2 # The authenticated user and the missing profiles
+
+    def get(self, request):
+        try:
+            user_ids = [int(value) for value in request.query_params.get('ids', '').split(',') if value.strip()]
+        except ValueError:
+            user_ids = []
+        if not user_ids:
+            raise ValidationError({'ids': ['A comma separated list of user ids is required.']})
+        if len(user_ids) > settings.BULK_MAX_ITEMS:
+            raise ValidationError({'ids': [f'Ensure this field has no more than {settings.BULK_MAX_ITEMS} elements.']})
+        return Response({'results': profiles.summaries(user_ids)})
@@ -0,0 +1,7 @@
+"""
+Benchmarks for the MiniTwitter backend.
+
+Run them from the ``backend/`` folder, e.g. ``python -m benchmarks.feed_fanout``.
+They create a throw-away test database and use a separate Redis database,
+so they never touch the development data.
+"""
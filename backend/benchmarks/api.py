@@ -0,0 +1,271 @@
+"""
+Throughput, latency and query count of the API hot paths.
+
+The requests go through the whole Django stack (middleware, authentication,
+views, serializers) with the test client, in-process, from ``--concurrency``
+threads: there is no HTTP server in the measure. Celery tasks run eagerly,
+so the fan-out of a new post is part of the post create latency.
+
+For every endpoint the benchmark reports requests/sec, p50/p95/p99 latency
+and the maximum number of SQL queries of a request, and checks that number
+against the ``query_budget`` its view declares, the one the tests enforce. It
+exits with status 1 when a budget is exceeded or a request fails.
+
+Usage::
+
+    python -m benchmarks.api --users 100000 --posts 2000000 --keepdb --json report.json
+    python -m benchmarks.api --keepdb --json new.json --compare report.json
+"""
+import argparse
+import datetime
+import json
+import random
+import subprocess
+import sys
+import threading
+import time
+
+from . import common, datagen
+
+ENDPOINTS = ['feed', 'post_create', 'like', 'unlike', 'follow', 'unfollow', 'login']
+
+
+class Scenario:
+    """An endpoint and the list of requests sent to it."""
+
+    def __init__(self, name, method, requests, expected_status):
+        self.name = name
+        self.method = method
+        self.requests = requests # (url, data, token) tuples
+        self.expected_status = expected_status
+
+
+def access_token(user_id):
+    from rest_framework_simplejwt.settings import api_settings
+    from rest_framework_simplejwt.tokens import AccessToken
+
+    token = AccessToken()
+    token[api_settings.USER_ID_CLAIM] = user_id
+    return str(token)
+
+
+def pairs_without(model, left, right, count, left_ids, right_ids):
+    """``count`` distinct (left, right) id pairs that are not rows of ``model``."""
+    pairs = set()
+    while len(pairs) < count:
+        candidates = {
+            (random.choice(left_ids), random.choice(right_ids)) for _ in range(count - len(pairs))
+        }
+        existing = set(
+            model.objects.filter(**{f'{left}__in': {a for a, _ in candidates}, f'{right}__in': {b for _, b in candidates}})
+            .values_list(left, right)
+        )
+        pairs |= {pair for pair in candidates - existing if pair[0] != pair[1]}
+    return list(pairs)[:count]
+
+
+def build_scenarios(count):
+    """Requests of every endpoint, in the order they run."""
+    from django.contrib.auth import get_user_model
+    from django.urls import reverse
+    from apps.follows.models import Follow
+    from apps.likes.models import Like
+    from apps.posts.models import Post
+
+    user_ids = list(get_user_model().objects.values_list('id', flat=True))
+    post_ids = list(Post.objects.order_by('-id').values_list('id', flat=True)[:100000])
+    tokens = {}
+
+    def token(user_id):
+        if user_id not in tokens:
+            tokens[user_id] = access_token(user_id)
+        return tokens[user_id]
+
+    readers = [random.choice(user_ids) for _ in range(count)]
+    likes = pairs_without(Like, 'user_id', 'post_id', count, user_ids, post_ids)
+    follows = pairs_without(Follow, 'user_id', 'following_id', count, user_ids, user_ids)
+    emails = dict(get_user_model().objects.filter(id__in=readers).values_list('id', 'email'))
+
+    return [
+        Scenario('feed', 'get', [
+            (reverse('post-list'), None, token(user_id)) for user_id in readers
+        ], 200),
+        Scenario('post_create', 'post', [
+            (reverse('post-list'), {'text': f'Benchmark {i}', 'tags': [f'tag{i % 50}']}, token(user_id))
+            for i, user_id in enumerate(readers)
+        ], 201),
+        Scenario('like', 'post', [
+            (reverse('post-like', args=[post_id]), None, token(user_id)) for user_id, post_id in likes
+        ], 201),
+        Scenario('unlike', 'delete', [
+            (reverse('post-unlike', args=[post_id]), None, token(user_id)) for user_id, post_id in likes
+        ], 204),
+        Scenario('follow', 'post', [
+            (reverse('follow', args=[following_id]), None, token(user_id)) for user_id, following_id in follows
+        ], 201),
+        Scenario('unfollow', 'delete', [
+            (reverse('unfollow', args=[following_id]), None, token(user_id)) for user_id, following_id in follows
+        ], 204),
+        Scenario('login', 'post', [
+            (reverse('token-obtain-pair'), {'email': emails[user_id], 'password': datagen.PASSWORD}, None)
+            for user_id in readers
+        ], 200),
+    ]
+
+
+def query_budget(scenario):
+    """Query budget declared by the view of a scenario (savepoints included)."""
+    from django.urls import resolve
+    from config.middleware import get_query_budget
+
+    url = scenario.requests[0][0] if scenario.requests else None
+    return get_query_budget(resolve(url).func, scenario.method) if url else None
+
+
+def run_scenario(scenario, concurrency):
+    """Send the requests of a scenario from ``concurrency`` threads."""
+    from django.db import connection
+    from django.test import Client
+    from django.test.utils import CaptureQueriesContext
+
+    latencies, queries, errors = [], [], []
+    lock = threading.Lock()
+
+    def worker(requests):
+        client = Client()
+        local_latencies, local_queries, local_errors = [], [], []
+        try:
+            for url, data, token in requests:
+                headers = {'HTTP_AUTHORIZATION': f'Bearer {token}'} if token else {}
+                if data is not None:
+                    headers['content_type'] = 'application/json'
+                    args = (url, data)
+                else:
+                    args = (url,)
+                with CaptureQueriesContext(connection) as ctx, common.timer(local_latencies):
+                    response = getattr(client, scenario.method)(*args, **headers)
+                local_queries.append(len(ctx))
+                if response.status_code != scenario.expected_status:
+                    local_errors.append(response.status_code)
+        finally:
+            # Every thread has its own connection, close it before the database is dropped
+            connection.close()
+        with lock:
+            latencies.extend(local_latencies)
+            queries.extend(local_queries)
+            errors.extend(local_errors)
+
+    threads = [
+        threading.Thread(target=worker, args=(scenario.requests[index::concurrency],))
+        for index in range(concurrency)
+    ]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    budget = query_budget(scenario)
+    max_queries = max(queries, default=0)
+    return {
+        'endpoint': scenario.name,
+        'requests': len(latencies),
+        'concurrency': concurrency,
+        'rps': round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        'latency_ms': common.summarize(latencies),
+        'queries': max_queries,
+        'query_budget': budget,
+        'over_budget': budget is not None and max_queries > budget,
+        'errors': len(errors),
+    }
+
+
+def git_commit():
+    """Commit of the working tree, so that reports can be compared across commits."""
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline_path):
+    """Print the change of throughput and p99 against a previous report."""
+    with open(baseline_path) as f:
+        baseline = {r['endpoint']: r for r in json.load(f)['results']}
+    rows = []
+    for result in results:
+        old = baseline.get(result['endpoint'])
+        if old is None:
+            continue
+        rows.append((
+            result['endpoint'],
+            old['rps'], result['rps'], f"{percent_change(old['rps'], result['rps']):+.1f}%",
+            old['latency_ms']['p99'], result['latency_ms']['p99'],
+            f"{percent_change(old['latency_ms']['p99'], result['latency_ms']['p99']):+.1f}%",
+            old['queries'], result['queries'],
+        ))
+    print()
+    common.print_table(
+        ['endpoint', 'rps before', 'rps after', 'rps', 'p99 before', 'p99 after', 'p99', 'queries before', 'queries after'],
+        rows,
+    )
+
+
+def percent_change(old, new):
+    return (new - old) / old * 100 if old else 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    datagen.add_arguments(parser)
+    parser.add_argument('--requests', type=int, default=500, help='Requests per endpoint')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--endpoints', nargs='+', choices=ENDPOINTS, default=ENDPOINTS)
+    parser.add_argument('--json', help='Write the report to this file')
+    parser.add_argument('--compare', help='Previous report to compare against')
+    args = parser.parse_args()
+
+    common.setup()
+    from django.conf import settings
+
+    with common.bench_database(keepdb=args.keepdb):
+        dataset = datagen.ensure_dataset(args)
+        random.seed(args.seed)
+        results = [
+            run_scenario(scenario, args.concurrency)
+            for scenario in build_scenarios(args.requests)
+            if scenario.name in args.endpoints
+        ]
+
+    report = {
+        'commit': git_commit(),
+        'date': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'dataset': dataset,
+        'settings': {'LIKES_ENGINE': settings.LIKES_ENGINE},
+        'results': results,
+    }
+    common.print_table(
+        ['endpoint', 'requests', 'rps', 'p50', 'p95', 'p99', 'queries', 'budget', 'errors'],
+        [
+            (r['endpoint'], r['requests'], r['rps'], r['latency_ms']['p50'], r['latency_ms']['p95'],
+             r['latency_ms']['p99'], r['queries'], r['query_budget'], r['errors'])
+            for r in results
+        ],
+    )
+    if args.compare:
+        compare(results, args.compare)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    failed = [r['endpoint'] for r in results if r['over_budget'] or r['errors']]
+    if failed:
+        print(f"\nOver the query budget or failing: {', '.join(failed)}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
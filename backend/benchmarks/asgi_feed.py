@@ -0,0 +1,156 @@
+"""
+Concurrency of one ASGI process on the feed, async view versus DRF view.
+
+The ASGI application (config.asgi) is called in-process, as uvicorn would
+call it, by ``concurrency`` clients sending feed requests in a loop. With the
+async view (ASYNC_READ_VIEWS) a request waiting on Postgres or Redis frees the
+event loop, with the DRF view every request holds a thread of the pool.
+
+The feed cache is expired before every run, so that every request reads the
+timeline, the posts and the viewer state, unless ``--warm`` is given: then
+every page is cached by a first pass and the runs measure the cache hits.
+
+Besides requests/sec and latency, the benchmark reports the peak number of
+threads of the process. Django runs the queries of the async ORM in
+sync_to_async threads, only the Redis calls of the async views are truly
+asynchronous.
+
+Usage::
+
+    python -m benchmarks.asgi_feed --keepdb --concurrency 1 8 32 --requests 400
+"""
+import argparse
+import asyncio
+import json
+import random
+import threading
+import time
+
+from . import common, datagen
+from .api import access_token
+
+
+def scope(path, query, token):
+    return {
+        'type': 'http',
+        'asgi': {'version': '3.0'},
+        'http_version': '1.1',
+        'method': 'GET',
+        'scheme': 'http',
+        'path': path,
+        'raw_path': path.encode(),
+        'query_string': query.encode(),
+        'root_path': '',
+        'headers': [(b'host', b'testserver'), (b'authorization', f'Bearer {token}'.encode())],
+        'client': ('127.0.0.1', 50000),
+        'server': ('testserver', 80),
+    }
+
+
+async def send_request(app, path, query, token):
+    """Send a GET request to the ASGI application, return the status code."""
+    body_sent = False
+    status = None
+
+    async def receive():
+        nonlocal body_sent
+        if not body_sent:
+            body_sent = True
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+        # The client never disconnects, Django cancels this wait when the response is sent
+        await asyncio.Future()
+
+    async def send(message):
+        nonlocal status
+        if message['type'] == 'http.response.start':
+            status = message['status']
+
+    await app(scope(path, query, token), receive, send)
+    return status
+
+
+async def run(app, path, tokens, concurrency):
+    """Send a request per token from ``concurrency`` clients."""
+    queue = list(tokens)
+    latencies, errors = [], []
+
+    async def client():
+        while queue:
+            token = queue.pop()
+            start = time.perf_counter()
+            status = await send_request(app, path, 'limit=20', token)
+            latencies.append((time.perf_counter() - start) * 1000)
+            if status != 200:
+                errors.append(status)
+
+    peak_threads = threading.active_count()
+
+    async def sample_threads():
+        nonlocal peak_threads
+        while True:
+            peak_threads = max(peak_threads, threading.active_count())
+            await asyncio.sleep(0.005)
+
+    sampler = asyncio.create_task(sample_threads())
+    start = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    sampler.cancel()
+    return {
+        'requests': len(latencies),
+        'rps': round(len(latencies) / elapsed, 1),
+        'latency_ms': common.summarize(latencies),
+        'peak_threads': peak_threads,
+        'errors': len(errors),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    datagen.add_arguments(parser)
+    parser.add_argument('--requests', type=int, default=400, help='Requests per run')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 32])
+    parser.add_argument('--warm', action='store_true', help='Measure cached pages')
+    parser.add_argument('--json', help='Also write the results to this file')
+    args = parser.parse_args()
+
+    common.setup()
+    from django.contrib.auth import get_user_model
+    from django.test import override_settings
+    from django.urls import reverse
+    from config.asgi import application
+    from apps.posts import feed_cache
+
+    results = []
+    with common.bench_database(keepdb=args.keepdb):
+        datagen.ensure_dataset(args)
+        random.seed(args.seed)
+        user_ids = list(get_user_model().objects.values_list('id', flat=True))
+        readers = random.sample(user_ids, min(args.requests, len(user_ids)))
+        tokens = [access_token(user_id) for user_id in readers]
+        path = reverse('post-list')
+
+        for concurrency in args.concurrency:
+            for mode, enabled in (('drf', False), ('async', True)):
+                feed_cache.expire_many(readers)
+                with override_settings(ASYNC_READ_VIEWS=enabled):
+                    if args.warm:
+                        asyncio.run(run(application, path, tokens, concurrency))
+                    result = asyncio.run(run(application, path, tokens, concurrency))
+                results.append({'mode': mode, 'concurrency': concurrency, **result})
+
+    common.print_table(
+        ['concurrency', 'mode', 'requests', 'rps', 'p50', 'p95', 'p99', 'peak threads', 'errors'],
+        [
+            (r['concurrency'], r['mode'], r['requests'], r['rps'], r['latency_ms']['p50'],
+             r['latency_ms']['p95'], r['latency_ms']['p99'], r['peak_threads'], r['errors'])
+            for r in results
+        ],
+    )
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+import os
+import time
+from contextlib import contextmanager
+
+import django
+
+BENCH_REDIS_DB = int(os.environ.get('BENCH_REDIS_DB', 15))
+
+
+def setup():
+    """Configure Django for a benchmark run."""
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+    django.setup()
+    from django.conf import settings
+    # Keep the benchmark keys away from the development cache
+    settings.CACHES['default']['LOCATION'] = f'redis://{settings.REDIS_HOST}:6379/{BENCH_REDIS_DB}'
+    # Separate from the database of the test runner, so a kept dataset survives `manage.py test`
+    database = settings.DATABASES['default']
+    database.setdefault('TEST', {})['NAME'] = f"bench_{database['NAME']}"
+    settings.CELERY_TASK_ALWAYS_EAGER = True
+
+
+@contextmanager
+def bench_database(keepdb=False):
+    """Create a test database for the duration of the benchmark."""
+    from django.core.cache import cache
+    from django.db import connection
+    from django.test.utils import setup_test_environment, teardown_test_environment
+
+    setup_test_environment()
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0, autoclobber=True, keepdb=keepdb)
+    cache.clear()
+    try:
+        yield
+    finally:
+        cache.clear()
+        connection.creation.destroy_test_db(old_name, verbosity=0, keepdb=keepdb)
+        teardown_test_environment()
+
+
+@contextmanager
+def timer(samples):
+    """Append the elapsed time of the block, in milliseconds, to ``samples``."""
+    start = time.perf_counter()
+    yield
+    samples.append((time.perf_counter() - start) * 1000)
+
+
+def percentile(samples, pct):
+    """Nearest-rank percentile of a list of samples."""
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    rank = max(0, min(len(ordered) - 1, round(pct / 100 * len(ordered)) - 1))
+    return ordered[rank]
+
+
+def summarize(samples):
+    """p50/p95/p99/max of a list of samples in milliseconds."""
+    return {
+        'count': len(samples),
+        'p50': round(percentile(samples, 50), 3),
+        'p95': round(percentile(samples, 95), 3),
+        'p99': round(percentile(samples, 99), 3),
+        'max': round(max(samples, default=0.0), 3),
+    }
+
+
+def print_table(headers, rows):
+    """Print rows as an aligned text table."""
+    widths = [max(len(str(cell)) for cell in column) for column in zip(headers, *rows)]
+    line = '  '.join(f'{{:<{width}}}' for width in widths)
+    print(line.format(*headers))
+    print(line.format(*('-' * width for width in widths)))
+    for row in rows:
+        print(line.format(*row))
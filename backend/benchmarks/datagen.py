@@ -0,0 +1,169 @@
+"""
+Synthetic social graph for the benchmarks.
+
+Users follow accounts picked with a power-law (Zipf) popularity: the account
+of rank r is followed with a weight of 1 / r ** alpha, so a few accounts have
+a large share of the followers like on a real network. Posts and likes are
+written with ``bulk_create`` in batches, which skips the signals (no fan-out,
+timelines are rebuilt on the first read), and the denormalized counters are
+reconciled at the end.
+
+Usage::
+
+    python -m benchmarks.datagen --users 100000 --posts 2000000 --keepdb
+
+With ``--keepdb`` the test database is kept, and reused by the other
+benchmarks run with ``--keepdb``.
+"""
+import argparse
+import itertools
+import random
+
+from . import common
+
+BATCH_SIZE = 10000
+PASSWORD = 'benchmark-password' # Password of every generated user
+
+
+def popularity_weights(count, alpha):
+    """Cumulative Zipf weights of ``count`` accounts, for random.choices."""
+    return list(itertools.accumulate(1 / rank ** alpha for rank in range(1, count + 1)))
+
+
+def batched(iterable, size=BATCH_SIZE):
+    iterator = iter(iterable)
+    while batch := list(itertools.islice(iterator, size)):
+        yield batch
+
+
+def create_users(count):
+    from django.contrib.auth import get_user_model
+    from django.contrib.auth.hashers import make_password
+
+    User = get_user_model()
+    password = make_password(PASSWORD) # Hashing once, the hasher is slow on purpose
+    users = (
+        User(username=f'user{i}', email=f'user{i}@bench.local', password=password)
+        for i in range(count)
+    )
+    for batch in batched(users):
+        User.objects.bulk_create(batch)
+    return list(User.objects.order_by('id').values_list('id', flat=True))
+
+
+def create_follows(user_ids, follows_per_user, alpha):
+    """Every user follows about ``follows_per_user`` accounts, return the count."""
+    from apps.follows.models import Follow
+
+    # The rank of an account is independent of its id
+    ranked = random.sample(user_ids, len(user_ids))
+    weights = popularity_weights(len(ranked), alpha)
+
+    def follows():
+        for user_id in user_ids:
+            picked = set(random.choices(ranked, cum_weights=weights, k=follows_per_user))
+            picked.discard(user_id)
+            for following_id in picked:
+                yield Follow(user_id=user_id, following_id=following_id)
+
+    total = 0
+    for batch in batched(follows()):
+        Follow.objects.bulk_create(batch, ignore_conflicts=True)
+        total += len(batch)
+    return total
+
+
+def create_posts(user_ids, count):
+    from apps.posts.models import Post
+
+    posts = (
+        Post(author_id=random.choice(user_ids), text=f'Benchmark post {i} #{i % 100}')
+        for i in range(count)
+    )
+    for batch in batched(posts):
+        Post.objects.bulk_create(batch)
+    return count
+
+
+def create_likes(user_ids, count, alpha):
+    """Likes on posts picked with a power-law, the newest posts being the most liked."""
+    from apps.likes.models import Like
+    from apps.posts.models import Post
+
+    post_ids = list(Post.objects.order_by('-id').values_list('id', flat=True))
+    if not post_ids:
+        return 0
+    weights = popularity_weights(len(post_ids), alpha)
+    likes = (
+        Like(user_id=random.choice(user_ids), post_id=post_id)
+        for post_id in random.choices(post_ids, cum_weights=weights, k=count)
+    )
+    for batch in batched(likes):
+        Like.objects.bulk_create(batch, ignore_conflicts=True)
+    return count
+
+
+def generate(users, posts, follows_per_user=50, likes=0, alpha=1.0, seed=42):
+    """Fill the current database with a synthetic graph, return its size."""
+    from apps.follows.tasks import reconcile_follow_counts
+    from apps.posts.tasks import reconcile_like_counts
+
+    random.seed(seed)
+    user_ids = create_users(users)
+    follows = create_follows(user_ids, follows_per_user, alpha)
+    create_posts(user_ids, posts)
+    create_likes(user_ids, likes, alpha)
+    # bulk_create does not maintain the denormalized counters
+    reconcile_follow_counts()
+    reconcile_like_counts()
+    return dataset_size()
+
+
+def dataset_size():
+    """Number of rows of each table of the graph."""
+    from django.contrib.auth import get_user_model
+    from apps.follows.models import Follow
+    from apps.likes.models import Like
+    from apps.posts.models import Post
+
+    return {
+        'users': get_user_model().objects.count(),
+        'follows': Follow.objects.count(),
+        'posts': Post.objects.count(),
+        'likes': Like.objects.count(),
+    }
+
+
+def add_arguments(parser):
+    """Dataset options, shared by the benchmarks that generate a graph."""
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--posts', type=int, default=100000)
+    parser.add_argument('--follows-per-user', type=int, default=50)
+    parser.add_argument('--likes', type=int, default=200000)
+    parser.add_argument('--alpha', type=float, default=1.0, help='Exponent of the power-law popularity')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--keepdb', action='store_true', help='Keep and reuse the test database')
+
+
+def ensure_dataset(args):
+    """Generate the graph, unless a kept database already has one."""
+    from django.contrib.auth import get_user_model
+
+    if args.keepdb and get_user_model().objects.exists():
+        return dataset_size()
+    return generate(args.users, args.posts, args.follows_per_user, args.likes, args.alpha, args.seed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    common.setup()
+    with common.bench_database(keepdb=args.keepdb):
+        size = ensure_dataset(args)
+    common.print_table(list(size), [list(size.values())])
+
+
+if __name__ == '__main__':
+    main()
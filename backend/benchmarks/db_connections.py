@@ -0,0 +1,148 @@
+"""
+Cost of the database connection setup in the request latency.
+
+The likers of a post (one indexed query) are requested with the test client,
+in-process, from ``--concurrency`` threads, under three connection modes:
+
+- ``new``: CONN_MAX_AGE = 0, every request opens a Postgres connection
+- ``persistent``: CONN_MAX_AGE + CONN_HEALTH_CHECKS, the connection of a
+  thread is kept and checked before being reused by the next request
+- ``pool``: the psycopg pool of Django (POSTGRES_POOL_SIZE), of
+  ``--concurrency`` connections
+
+The test client does not close the connections at the end of a request,
+like the request_finished signal of a real server does: the benchmark does
+it, so that a request pays the connection setup whenever a server would.
+Besides requests/sec and latency it reports the number of Postgres
+connections opened by the run.
+
+Usage::
+
+    python -m benchmarks.db_connections --keepdb --concurrency 4 --requests 2000
+"""
+import argparse
+import json
+import random
+import threading
+import time
+
+from . import common, datagen
+
+MODES = ('new', 'persistent', 'pool')
+
+
+def configure(mode, pool_size):
+    """Switch the connections of the default database to ``mode``."""
+    from django.db import connection
+
+    connection.close()
+    connection.close_pool()
+    settings_dict = connection.settings_dict # Shared by the connections of every thread
+    settings_dict['OPTIONS'].pop('pool', None)
+    settings_dict['CONN_HEALTH_CHECKS'] = mode != 'new'
+    if mode == 'pool':
+        settings_dict['CONN_MAX_AGE'] = 0
+        settings_dict['OPTIONS']['pool'] = {'min_size': pool_size, 'max_size': pool_size}
+    else:
+        settings_dict['CONN_MAX_AGE'] = 0 if mode == 'new' else 600
+
+
+def run(urls, concurrency):
+    """Send the requests from ``concurrency`` threads."""
+    from django.db import close_old_connections, connection
+    from django.db.backends.signals import connection_created
+    from django.test import Client
+
+    latencies, errors, connects = [], [], []
+    lock = threading.Lock()
+
+    def count_connect(**kwargs):
+        connects.append(1)
+
+    def worker(urls):
+        client = Client()
+        local_latencies, local_errors = [], []
+        try:
+            for url in urls:
+                with common.timer(local_latencies):
+                    response = client.get(url)
+                    close_old_connections() # What request_finished does
+                if response.status_code != 200:
+                    local_errors.append(response.status_code)
+        finally:
+            connection.close()
+        with lock:
+            latencies.extend(local_latencies)
+            errors.extend(local_errors)
+
+    pool = connection.pool
+    if pool is not None:
+        pool.pop_stats() # Reset the counters
+    else:
+        connection_created.connect(count_connect)
+    threads = [threading.Thread(target=worker, args=(urls[index::concurrency],)) for index in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    if pool is not None:
+        # connection_created is sent for every connection taken from the pool, not opened
+        opened = pool.get_stats().get('connections_num', 0)
+    else:
+        connection_created.disconnect(count_connect)
+        opened = len(connects)
+    return {
+        'requests': len(latencies),
+        'rps': round(len(latencies) / elapsed, 1),
+        'latency_ms': common.summarize(latencies),
+        'connects': opened,
+        'errors': len(errors),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    datagen.add_arguments(parser)
+    parser.add_argument('--requests', type=int, default=2000, help='Requests per mode')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--modes', nargs='+', choices=MODES, default=list(MODES))
+    parser.add_argument('--json', help='Also write the results to this file')
+    args = parser.parse_args()
+
+    common.setup()
+    from django.conf import settings
+    from django.urls import reverse
+    from apps.posts.models import Post
+
+    # The test client runs the sync view, the async one would hide the per-thread connections
+    settings.ASYNC_READ_VIEWS = False
+    results = []
+    with common.bench_database(keepdb=args.keepdb):
+        datagen.ensure_dataset(args)
+        random.seed(args.seed)
+        post_ids = list(Post.objects.order_by('-like_count').values_list('id', flat=True)[:1000])
+        urls = [reverse('post-likers', args=[random.choice(post_ids)]) for _ in range(args.requests)]
+
+        for mode in args.modes:
+            configure(mode, args.concurrency)
+            run(urls[:args.concurrency * 10], args.concurrency) # Warm up
+            results.append({'mode': mode, 'concurrency': args.concurrency, **run(urls, args.concurrency)})
+        configure('new', args.concurrency)
+
+    common.print_table(
+        ['mode', 'requests', 'rps', 'p50', 'p95', 'p99', 'connects', 'errors'],
+        [
+            (r['mode'], r['requests'], r['rps'], r['latency_ms']['p50'], r['latency_ms']['p95'],
+             r['latency_ms']['p99'], r['connects'], r['errors'])
+            for r in results
+        ],
+    )
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
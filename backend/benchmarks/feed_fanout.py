@@ -0,0 +1,143 @@
+"""
+Write and read cost of the home timelines, pure fan-out on write ("push")
+versus the hybrid mode where celebrity posts are pulled at read time.
+
+For every follower-count distribution the benchmark measures:
+
+- write: time of the ``fan_out_post`` task for one new post
+- read:  time of ``timeline.get_post_ids`` for a follower
+
+Usage::
+
+    python -m benchmarks.feed_fanout --users 20000 --authors 100 --threshold 2000
+"""
+import argparse
+import json
+import random
+
+from . import common
+
+
+def follower_counts(distribution, authors, users):
+    """Number of followers of each author for a distribution."""
+    if distribution == 'uniform':
+        return [users // 20] * authors
+    if distribution == 'power-law':
+        # Zipf-like: the author of rank r has users / r followers
+        return [max(1, users // rank) for rank in range(1, authors + 1)]
+    if distribution == 'celebrity':
+        # One author followed by everybody, the others by a few users
+        return [users] + [users // 100] * (authors - 1)
+    raise ValueError(f'Unknown distribution: {distribution}')
+
+
+def load_graph(user_ids, author_ids, counts):
+    from apps.follows.models import Follow
+    from apps.follows.tasks import reconcile_follow_counts
+
+    Follow.objects.all().delete()
+    follows = []
+    for author_id, count in zip(author_ids, counts):
+        for user_id in random.sample(user_ids, min(count, len(user_ids))):
+            if user_id != author_id:
+                follows.append(Follow(user_id=user_id, following_id=author_id))
+    Follow.objects.bulk_create(follows, batch_size=5000)
+    # bulk_create does not maintain the follower counters
+    reconcile_follow_counts()
+    return len(follows)
+
+
+def warm_timelines(user_ids):
+    """Create every timeline, so that the fan-out writes to all followers."""
+    from django_redis import get_redis_connection
+    from apps.posts import timeline
+
+    pipe = get_redis_connection('default').pipeline(transaction=False)
+    for user_id in user_ids:
+        # Placeholder entry: post 0 never exists
+        pipe.zadd(timeline.timeline_key(user_id), {0: 0})
+    pipe.execute()
+
+
+def run_mode(threshold, user_ids, author_ids, posts_per_author, reads):
+    from django.core.cache import cache
+    from django.test import override_settings
+    from apps.follows.models import Follow
+    from apps.posts import timeline
+    from apps.posts.models import Post
+    from apps.posts.tasks import fan_out_post
+
+    Post.objects.all().delete()
+    cache.clear()
+    warm_timelines(user_ids)
+    writes, reads_ms = [], []
+    with override_settings(TIMELINE_CELEBRITY_THRESHOLD=threshold):
+        for _ in range(posts_per_author):
+            for author_id in author_ids:
+                # bulk_create skips the post_save signal, the fan-out is timed below
+                post, = Post.objects.bulk_create([Post(author_id=author_id, text='benchmark post')])
+                with common.timer(writes):
+                    fan_out_post(post.id)
+
+        readers = list(Follow.objects.values_list('user_id', flat=True).distinct())
+        for user_id in random.sample(readers, min(reads, len(readers))):
+            with common.timer(reads_ms):
+                timeline.get_post_ids(user_id)
+    return common.summarize(writes), common.summarize(reads_ms)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=20000)
+    parser.add_argument('--authors', type=int, default=100)
+    parser.add_argument('--posts-per-author', type=int, default=3)
+    parser.add_argument('--reads', type=int, default=500)
+    parser.add_argument('--threshold', type=int, default=2000, help='Celebrity threshold of the hybrid mode')
+    parser.add_argument('--distributions', nargs='+', default=['uniform', 'power-law', 'celebrity'])
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--json', help='Also write the results to this file')
+    args = parser.parse_args()
+
+    common.setup()
+    from django.contrib.auth import get_user_model
+    User = get_user_model()
+
+    random.seed(args.seed)
+    results = []
+    with common.bench_database():
+        User.objects.bulk_create(
+            [User(username=f'user{i}', email=f'user{i}@bench.local') for i in range(args.users)],
+            batch_size=5000,
+        )
+        user_ids = list(User.objects.values_list('id', flat=True))
+        author_ids = user_ids[:args.authors]
+
+        for distribution in args.distributions:
+            counts = follower_counts(distribution, args.authors, args.users)
+            edges = load_graph(user_ids, author_ids, counts)
+            for mode, threshold in (('push', None), ('hybrid', args.threshold)):
+                write, read = run_mode(threshold, user_ids, author_ids, args.posts_per_author, args.reads)
+                results.append({
+                    'distribution': distribution,
+                    'follows': edges,
+                    'max_followers': max(counts),
+                    'mode': mode,
+                    'write_ms': write,
+                    'read_ms': read,
+                })
+
+    common.print_table(
+        ['distribution', 'mode', 'max followers', 'write p50', 'write p99', 'read p50', 'read p99'],
+        [
+            (r['distribution'], r['mode'], r['max_followers'],
+             r['write_ms']['p50'], r['write_ms']['p99'], r['read_ms']['p50'], r['read_ms']['p99'])
+            for r in results
+        ],
+    )
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
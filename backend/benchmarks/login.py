@@ -0,0 +1,100 @@
+"""
+Logins per second and per core, for every password hasher profile.
+
+The login requests (POST /api/users/login/) are sent with the test client
+from a single thread: the password hash is CPU bound and holds the GIL, so
+one thread measures what one core of a web worker can do. Before every
+profile, the passwords of the users are hashed with its hasher, so that no
+login rehashes.
+
+Besides logins/sec and latency, the benchmark reports the time of a single
+password check of each hasher.
+
+Usage::
+
+    python -m benchmarks.login --keepdb --requests 200
+"""
+import argparse
+import json
+import random
+import time
+
+from . import common, datagen
+
+
+def run(client, url, credentials):
+    """Send the login requests one after the other."""
+    latencies, errors = [], 0
+    start = time.perf_counter()
+    for data in credentials:
+        with common.timer(latencies):
+            response = client.post(url, data, content_type='application/json')
+        if response.status_code != 200:
+            errors += 1
+    elapsed = time.perf_counter() - start
+    return {
+        'requests': len(latencies),
+        'logins_per_sec': round(len(latencies) / elapsed, 1),
+        'latency_ms': common.summarize(latencies),
+        'errors': errors,
+    }
+
+
+def check_time(hasher):
+    """Milliseconds of a password check with ``hasher``."""
+    encoded = hasher.encode(datagen.PASSWORD, hasher.salt())
+    samples = []
+    for _ in range(5):
+        with common.timer(samples):
+            hasher.verify(datagen.PASSWORD, encoded)
+    return round(min(samples), 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    datagen.add_arguments(parser)
+    parser.add_argument('--requests', type=int, default=200, help='Logins per profile')
+    parser.add_argument('--json', help='Also write the results to this file')
+    args = parser.parse_args()
+
+    common.setup()
+    from django.conf import settings
+    from django.contrib.auth import get_user_model
+    from django.contrib.auth.hashers import get_hasher, make_password
+    from django.test import Client, override_settings
+    from django.urls import reverse
+
+    User = get_user_model()
+    profiles = settings.PASSWORD_HASHER_PROFILES
+    results = []
+    with common.bench_database(keepdb=args.keepdb):
+        datagen.ensure_dataset(args)
+        random.seed(args.seed)
+        emails = list(User.objects.order_by('?').values_list('email', flat=True)[:args.requests])
+        credentials = [{'email': random.choice(emails), 'password': datagen.PASSWORD} for _ in range(args.requests)]
+        url = reverse('token-obtain-pair')
+
+        for profile, hasher_path in profiles.items():
+            hashers = [hasher_path] + [path for path in profiles.values() if path != hasher_path]
+            with override_settings(PASSWORD_HASHERS=hashers):
+                User.objects.filter(email__in=emails).update(password=make_password(datagen.PASSWORD))
+                client = Client()
+                run(client, url, credentials[:5]) # Warm up
+                result = run(client, url, credentials)
+                results.append({'profile': profile, 'check_ms': check_time(get_hasher('default')), **result})
+
+    common.print_table(
+        ['profile', 'check ms', 'requests', 'logins/s', 'p50', 'p95', 'p99', 'errors'],
+        [
+            (r['profile'], r['check_ms'], r['requests'], r['logins_per_sec'], r['latency_ms']['p50'],
+             r['latency_ms']['p95'], r['latency_ms']['p99'], r['errors'])
+            for r in results
+        ],
+    )
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+"""
+Helpers of the async read views.
+
+DRF views are sync only: under ASGI each request holds a thread while it waits
+on Postgres and Redis. The hot read endpoints (feed, likes of a post,
+followers/following) have an async version, a plain Django async view using
+the async ORM and ``redis.asyncio``, that serves the plain GET requests. Every
+other request (writes, filters, anonymous users...) goes to the DRF view.
+
+The async views are turned on with settings.ASYNC_READ_VIEWS, for the ASGI
+deployment. The setting is read when the URLconf is built: turned off, the
+routes are the DRF views themselves, with no async wrapper to go through.
+Under WSGI, Django runs an async view in a new event loop per request: the
+Redis client of that loop is closed at the end of the request.
+"""
+import asyncio
+import importlib
+import sys
+import weakref
+
+import redis.asyncio as aioredis
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.http import JsonResponse
+from django.urls import clear_url_caches
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework.exceptions import APIException
+from rest_framework_simplejwt.authentication import JWTAuthentication
+
+from apps.users.authentication import CachedJWTAuthentication
+
+_clients = weakref.WeakKeyDictionary()
+
+
+def get_redis():
+    """
+    Async Redis client on the database of the cache.
+    Connections are bound to an event loop, there is one client per loop.
+    """
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None:
+        client = _clients[loop] = aioredis.from_url(settings.CACHES['default']['LOCATION'])
+    return client
+
+
+async def close_redis():
+    """Close the async Redis client of the running event loop, if any."""
+    client = _clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
+
+
+async def authenticate(request):
+    """
+    User of the JWT of a request, or None without an Authorization header.
+    Raise the DRF authentication errors, see error_response().
+    """
+    authentication = CachedJWTAuthentication()
+    header = authentication.get_header(request)
+    if header is None:
+        return None
+    raw_token = authentication.get_raw_token(header)
+    if raw_token is None:
+        return None
+    validated_token = authentication.get_validated_token(raw_token)
+    if settings.JWT_STATELESS_READS: # The async views only serve GET requests
+        return authentication.get_token_user(validated_token)
+    return await authentication.aget_user(validated_token)
+
+
+def error_response(request, exc):
+    """JSON response of a DRF exception, like the DRF exception handler."""
+    data = exc.detail if isinstance(exc.detail, (dict, list)) else {'detail': exc.detail}
+    response = JsonResponse(data, status=exc.status_code, safe=False)
+    if exc.status_code == 401:
+        response['WWW-Authenticate'] = JWTAuthentication().authenticate_header(request)
+    return response
+
+
+def async_read_view(handler, sync_view):
+    """
+    View serving the GET requests with the async ``handler`` and the other
+    ones with the DRF ``sync_view``. The handler returns None to hand a GET
+    request over to the DRF view as well. ``sync_view`` itself when the async
+    views are turned off.
+    """
+    if not settings.ASYNC_READ_VIEWS:
+        return sync_view
+    sync_handler = sync_to_async(sync_view)
+
+    async def view(request, *args, **kwargs):
+        if request.method == 'GET':
+            try:
+                response = await handler(request, *args, **kwargs)
+            except APIException as exc:
+                return error_response(request, exc)
+            finally:
+                if not isinstance(request, ASGIRequest):
+                    # The loop of the request ends with it, so does its client
+                    await close_redis()
+            if response is not None:
+                return response
+        return await sync_handler(request, *args, **kwargs)
+
+    # Used by the request metrics and the schema generation, like a DRF view
+    view.cls = sync_view.cls
+    view.initkwargs = sync_view.initkwargs
+    if hasattr(sync_view, 'actions'):
+        view.actions = sync_view.actions
+    return csrf_exempt(view)
+
+
+@receiver(setting_changed)
+def rebuild_urlconf(setting, **kwargs):
+    """Build the URLconf again when the tests turn the async views on or off."""
+    if setting != 'ASYNC_READ_VIEWS':
+        return
+    for name in [name for name in sys.modules if name.startswith('apps.') and name.endswith('.urls')]:
+        importlib.reload(sys.modules[name])
+    if settings.ROOT_URLCONF in sys.modules:
+        # Its include() resolvers hold the url patterns of the previous modules
+        importlib.reload(sys.modules[settings.ROOT_URLCONF])
+    clear_url_caches()
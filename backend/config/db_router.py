@@ -0,0 +1,98 @@
+"""
+Read replicas.
+
+The read-only endpoints (feed, post detail and search, likes and likers of a
+post, followers/following) run their queries on one of the
+settings.DATABASE_REPLICAS, picked at random for the whole request. Every
+other query, and every query out of those endpoints (Celery tasks, admin,
+shell), goes to the primary.
+
+Replicas lag behind the primary, so a user who just wrote (a post, a like, a
+follow...) would not see it. ReplicaMiddleware (config/middleware.py) marks
+the users of the successful write requests in the cache for
+READ_YOUR_WRITES_SECONDS, and the reads of a marked user stay on the primary.
+
+The DRF views opt in with ReplicaReadMixin, the async read views call
+ause_replica() once they know the user.
+"""
+import random
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core.cache import cache
+
+_replica = ContextVar('read_replica', default=None)
+
+
+def recent_write_key(user_id):
+    """Cache key marking a user who wrote recently."""
+    return f'db:recent-write:{user_id}'
+
+
+def record_write(user_id):
+    """Pin the reads of a user to the primary for READ_YOUR_WRITES_SECONDS."""
+    if settings.DATABASE_REPLICAS:
+        cache.set(recent_write_key(user_id), 1, settings.READ_YOUR_WRITES_SECONDS)
+
+
+def _user_id(user):
+    return user.id if user is not None and user.is_authenticated else None
+
+
+def use_replica(user):
+    """Run the reads of the current request on a replica, unless ``user`` (may be anonymous) wrote recently."""
+    if not settings.DATABASE_REPLICAS:
+        return
+    user_id = _user_id(user)
+    if user_id is not None and cache.get(recent_write_key(user_id)):
+        return
+    _replica.set(random.choice(settings.DATABASE_REPLICAS))
+
+
+async def ause_replica(user):
+    if not settings.DATABASE_REPLICAS:
+        return
+    user_id = _user_id(user)
+    if user_id is not None and await cache.aget(recent_write_key(user_id)):
+        return
+    _replica.set(random.choice(settings.DATABASE_REPLICAS))
+
+
+def start():
+    """Route the reads of a new request to the primary, return a reset token."""
+    return _replica.set(None)
+
+
+def end(token):
+    _replica.reset(token)
+
+
+class ReplicaRouter:
+    """Database router sending the reads of the replica requests to their replica."""
+
+    def db_for_read(self, model, **hints):
+        return _replica.get()
+
+    def db_for_write(self, model, **hints):
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True # Every database holds the same data
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == 'default' # The replicas follow the primary
+
+
+class ReplicaReadMixin:
+    """
+    Serve the ``replica_actions`` of a DRF view (the HTTP methods of a plain
+    view) from a replica. Chosen after the authentication, which runs on the
+    primary.
+    """
+    replica_actions = ('get',)
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        action = getattr(self, 'action', None) or request.method.lower()
+        if action in self.replica_actions:
+            use_replica(request.user)
@@ -0,0 +1,23 @@
+"""
+Gunicorn settings of the ASGI deployment (uvicorn workers), see the ``asgi``
+profile of docker-compose.yml:
+
+    gunicorn -c config/gunicorn.conf.py config.asgi:application
+
+Every worker is one process with one event loop: the async views serve many
+requests at once, the DRF views run in its thread pool.
+"""
+import multiprocessing
+import os
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:8000')
+worker_class = 'uvicorn_worker.UvicornWorker'
+# One worker per core is enough, the concurrency comes from the event loop
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+# Restart the workers now and then, to bound the memory growth
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 10000))
+max_requests_jitter = max_requests // 10
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+graceful_timeout = 30
+keepalive = 5
+accesslog = '-'
@@ -0,0 +1,187 @@
+"""
+Request metrics.
+
+RequestMetricsMiddleware (config/middleware.py) collects, for every request,
+the number and the time of the SQL queries, the cache hits and misses and the
+time spent in the serializers. They are sent back in the ``Server-Timing``
+header and added to counters in Redis, shared by every worker process, that
+are exported in the Prometheus text format by ``GET /metrics``, to staff users
+and to the scrapers sending ``Authorization: Bearer <METRICS_TOKEN>``.
+
+The metrics of the current request live in a context variable, so they are
+also updated by the queries that the async views run in sync_to_async threads.
+"""
+import hmac
+import time
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.http import HttpResponse, HttpResponseForbidden
+from django_redis import get_redis_connection
+
+COUNTERS_KEY = 'metrics:counters'
+
+_current = ContextVar('request_metrics', default=None)
+
+# Prometheus name, type and help of the counters, by field of RequestMetrics
+COUNTERS = {
+    'requests': ('http_requests_total', 'Number of requests.'),
+    'duration': ('http_request_duration_seconds_total', 'Time spent handling requests.'),
+    'queries': ('db_queries_total', 'Number of SQL queries.'),
+    'db_time': ('db_query_duration_seconds_total', 'Time spent in SQL queries.'),
+    'serializer_time': ('serializer_duration_seconds_total', 'Time spent in the serializers.'),
+    'cache_hits': ('cache_hits_total', 'Number of cache hits.'),
+    'cache_misses': ('cache_misses_total', 'Number of cache misses.'),
+    'over_budget': ('query_budget_exceeded_total', 'Number of requests over their query budget.'),
+}
+
+
+class RequestMetrics:
+    """Metrics of the current request, also used as a database execute wrapper."""
+
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+        self.serializer_time = 0.0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.serializing = False
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries += 1
+            self.db_time += time.perf_counter() - start
+
+    def server_timing(self, duration):
+        """Value of the Server-Timing header, durations in milliseconds."""
+        return ', '.join([
+            f'db;desc="{self.queries} queries";dur={self.db_time * 1000:.1f}',
+            f'serializer;dur={self.serializer_time * 1000:.1f}',
+            f'cache;desc="{self.cache_hits} hits, {self.cache_misses} misses"',
+            f'total;dur={duration * 1000:.1f}',
+        ])
+
+
+def current():
+    """Metrics of the request being handled, or None outside of a request."""
+    return _current.get()
+
+
+def _execute(execute, sql, params, many, context):
+    metrics = current()
+    if metrics is None:
+        return execute(sql, params, many, context)
+    return metrics(execute, sql, params, many, context)
+
+
+def install_execute_wrapper(connection, **kwargs):
+    """Count the queries of a database connection in the current request metrics."""
+    if _execute not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_execute)
+
+
+# Connections are per thread, every new one gets the wrapper
+connection_created.connect(install_execute_wrapper)
+
+
+def activate(metrics):
+    """Make ``metrics`` the metrics of the current request, return a reset token."""
+    return _current.set(metrics)
+
+
+def deactivate(token):
+    _current.reset(token)
+
+
+def record_cache(hit):
+    """Count a cache hit or miss in the current request."""
+    metrics = current()
+    if metrics is None:
+        return
+    if hit:
+        metrics.cache_hits += 1
+    else:
+        metrics.cache_misses += 1
+
+
+class TimedSerializerMixin:
+    """
+    Add the time spent in ``to_representation`` to the current request.
+
+    Only the outermost serializer is timed, so nested serializers and the items
+    of a list are not counted twice.
+    """
+
+    def to_representation(self, instance):
+        metrics = current()
+        if metrics is None or metrics.serializing:
+            return super().to_representation(instance)
+        metrics.serializing = True
+        start = time.perf_counter()
+        try:
+            return super().to_representation(instance)
+        finally:
+            metrics.serializing = False
+            metrics.serializer_time += time.perf_counter() - start
+
+
+def record(view, method, status, metrics, duration, over_budget):
+    """Add the metrics of a request to the shared counters."""
+    labels = f'view="{view}",method="{method}"'
+    values = {
+        'duration': duration,
+        'queries': metrics.queries,
+        'db_time': metrics.db_time,
+        'serializer_time': metrics.serializer_time,
+        'cache_hits': metrics.cache_hits,
+        'cache_misses': metrics.cache_misses,
+        'over_budget': int(over_budget),
+    }
+    pipe = get_redis_connection('default').pipeline(transaction=False)
+    pipe.hincrby(COUNTERS_KEY, f'requests|{labels},status="{status}"', 1)
+    for name, value in values.items():
+        if isinstance(value, float):
+            pipe.hincrbyfloat(COUNTERS_KEY, f'{name}|{labels}', value)
+        elif value:
+            pipe.hincrby(COUNTERS_KEY, f'{name}|{labels}', value)
+    pipe.execute()
+
+
+def render():
+    """The counters in the Prometheus text exposition format."""
+    series = {}
+    for field, value in get_redis_connection('default').hgetall(COUNTERS_KEY).items():
+        name, labels = field.decode().split('|', 1)
+        series.setdefault(name, []).append((labels, value.decode()))
+    lines = []
+    for name, (metric, help_text) in COUNTERS.items():
+        lines.append(f'# HELP {metric} {help_text}')
+        lines.append(f'# TYPE {metric} counter')
+        for labels, value in sorted(series.get(name, [])):
+            lines.append(f'{metric}{{{labels}}} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+def reset():
+    """Reset every counter."""
+    get_redis_connection('default').delete(COUNTERS_KEY)
+
+
+def is_allowed(request):
+    """Tell if a request may read the metrics: a staff user, or the METRICS_TOKEN bearer."""
+    if request.user.is_authenticated and request.user.is_staff:
+        return True
+    scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+    return bool(settings.METRICS_TOKEN) and scheme == 'Bearer' \
+        and hmac.compare_digest(token.encode(), settings.METRICS_TOKEN.encode())
+
+
+def metrics_view(request):
+    """Prometheus scrape endpoint."""
+    if not is_allowed(request):
+        return HttpResponseForbidden()
+    return HttpResponse(render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,164 @@
+import logging
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.db import connection
+
+from . import db_router, metrics
+
+logger = logging.getLogger(__name__)
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+
+class QueryBudgetExceeded(Exception):
+    """A request ran more SQL queries than the budget of its view."""
+
+
+def get_query_budget(view_func, method):
+    """
+    Query budget of a view, from its ``query_budget`` attribute.
+
+    The attribute is either a number, or a dict by viewset action (or by HTTP
+    method for plain views), e.g. ``query_budget = {'list': 6, 'create': 20}``.
+    """
+    view_class = getattr(view_func, 'cls', None)
+    budget = getattr(view_class, 'query_budget', None)
+    if not isinstance(budget, dict):
+        return budget
+    actions = getattr(view_func, 'actions', None) or {}
+    return budget.get(actions.get(method.lower(), method.lower()))
+
+
+def get_view_name(view_func, method):
+    """Label of a view in the metrics, e.g. ``PostViewSet.list``."""
+    view_class = getattr(view_func, 'cls', None)
+    if view_class is None:
+        return getattr(view_func, '__name__', 'unknown')
+    actions = getattr(view_func, 'actions', None) or {}
+    action = actions.get(method.lower())
+    return f'{view_class.__name__}.{action}' if action else view_class.__name__
+
+
+class RequestMetricsMiddleware:
+    """
+    Measure the SQL queries, cache hits/misses and serializer time of every
+    request, return them in the ``Server-Timing`` header and add them to the
+    metrics exported by ``/metrics`` (see config/metrics.py).
+
+    Views may declare a ``query_budget``. A request over the budget is logged,
+    or raises QueryBudgetExceeded when settings.QUERY_BUDGET_STRICT is set
+    (in the tests).
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        # The connection of this thread may predate the connection_created receiver
+        metrics.install_execute_wrapper(connection)
+        token, start = self.start(request)
+        try:
+            response = self.get_response(request)
+        finally:
+            metrics.deactivate(token)
+        return self.finish(request, response, time.perf_counter() - start)
+
+    async def __acall__(self, request):
+        token, start = self.start(request)
+        try:
+            response = await self.get_response(request)
+        finally:
+            metrics.deactivate(token)
+        # Only Redis is used, no need to run in the thread of the database connection
+        return await sync_to_async(self.finish, thread_sensitive=False)(
+            request, response, time.perf_counter() - start
+        )
+
+    def start(self, request):
+        request.metrics = metrics.RequestMetrics()
+        request.metrics_view = None
+        request.query_budget = None
+        return metrics.activate(request.metrics), time.perf_counter()
+
+    def finish(self, request, response, duration):
+        if request.metrics_view is None:
+            return response # Not resolved to a view (404, /metrics itself...)
+
+        if settings.SERVER_TIMING:
+            response['Server-Timing'] = request.metrics.server_timing(duration)
+        over_budget = request.query_budget is not None and request.metrics.queries > request.query_budget
+        if settings.REQUEST_METRICS:
+            metrics.record(
+                request.metrics_view, request.method, response.status_code,
+                request.metrics, duration, over_budget,
+            )
+        if over_budget:
+            message = (
+                f'{request.method} {request.path} ({request.metrics_view}) ran '
+                f'{request.metrics.queries} queries, over its budget of {request.query_budget}'
+            )
+            if settings.QUERY_BUDGET_STRICT:
+                raise QueryBudgetExceeded(message)
+            logger.warning(message)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if view_func is metrics.metrics_view:
+            return None
+        request.metrics_view = get_view_name(view_func, request.method)
+        request.query_budget = get_query_budget(view_func, request.method)
+        return None
+
+
+class ReplicaMiddleware:
+    """
+    Reset the read replica routing of every request (see config/db_router.py),
+    and pin the user of a successful write request to the primary.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        token = db_router.start()
+        try:
+            response = self.get_response(request)
+        finally:
+            db_router.end(token)
+        self.record_write(request, response)
+        return response
+
+    async def __acall__(self, request):
+        token = db_router.start()
+        try:
+            response = await self.get_response(request)
+        finally:
+            db_router.end(token)
+        # The async read views only serve GET requests, writes go to the sync views
+        if settings.DATABASE_REPLICAS and request.method not in SAFE_METHODS:
+            await sync_to_async(self.record_write)(request, response)
+        return response
+
+    def record_write(self, request, response):
+        if not settings.DATABASE_REPLICAS or request.method in SAFE_METHODS or response.status_code >= 400:
+            return
+        # DRF sets request.user once it has authenticated the JWT
+        user = getattr(request, 'user', None)
+        if user is not None and user.is_authenticated:
+            db_router.record_write(user.id)
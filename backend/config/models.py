@@ -0,0 +1,42 @@
+"""
+Model helpers shared by the apps.
+"""
+from django.db.models.constants import OnConflict
+
+
+def insert_ignore_conflicts(model, objs, returning):
+    """
+    ``bulk_create(objs, ignore_conflicts=True)`` that tells which rows were
+    inserted: return the ``returning`` field values of the inserted rows, the
+    rows skipped on a conflict (e.g. inserted by a concurrent request) are not
+    returned. Sends no signal, like bulk_create.
+    """
+    if not objs:
+        return []
+    fields = [field for field in model._meta.concrete_fields if not field.primary_key]
+    rows = model._base_manager._insert(
+        objs, fields=fields, returning_fields=[model._meta.get_field(returning)], on_conflict=OnConflict.IGNORE,
+    )
+    return [row[0] for row in rows if row] # A single skipped row comes back as None
+
+
+class CounterFieldsMixin:
+    """
+    Model with denormalized counters, only written by ``F()`` updates.
+
+    A full ``save()`` of a loaded instance leaves the ``counter_fields`` out:
+    it would write back the values read when the instance was loaded, and undo
+    the updates made since. ``save(update_fields=...)`` is left as is.
+    """
+    counter_fields = ()
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding and not args and kwargs.get('update_fields') is None \
+                and not kwargs.get('force_insert'):
+            deferred = self.get_deferred_fields()
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in self.counter_fields
+                and field.attname not in deferred
+            ]
+        super().save(*args, **kwargs)
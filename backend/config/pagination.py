@@ -0,0 +1,171 @@
+import base64
+import binascii
+import json
+from datetime import datetime
+
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, LimitOffsetPagination
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    """
+    Cursor pagination keyed on the values of the ordering fields.
+
+    The cursor is an opaque token with the ordering values of the last item of
+    the page, the next page is fetched with a range condition on an index
+    (e.g. ``created_at < x OR (created_at = x AND id < y)``) instead of an
+    ``OFFSET`` scan, and new rows do not shift the pages.
+
+    Requests with ``?offset=`` or a custom ``?ordering=`` fall back to
+    ``LimitOffsetPagination``.
+    """
+    ordering = ('-created_at', '-id') # Must be unique, the last field is a tie breaker
+    page_size = api_settings.PAGE_SIZE
+    max_page_size = 100
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'limit'
+    invalid_cursor_message = 'Invalid cursor'
+
+    def __init__(self):
+        self.fallback = None
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if self.use_fallback(request):
+            self.fallback = LimitOffsetPagination()
+            return self.fallback.paginate_queryset(queryset, request, view)
+
+        queryset = self.page_queryset(queryset, request)
+        return self.set_page(list(queryset))
+
+    async def apaginate_queryset(self, queryset, request):
+        """paginate_queryset() with the async ORM, without the offset fallback."""
+        queryset = self.page_queryset(queryset, request)
+        return self.set_page([item async for item in queryset])
+
+    def page_queryset(self, queryset, request):
+        """Rows of the requested page, plus one to know if there is a next page."""
+        self.request = request
+        self.limit = self.get_page_size(request)
+        queryset = queryset.order_by(*self.ordering)
+        cursor = self.decode_cursor(request, queryset)
+        if cursor is not None:
+            queryset = queryset.filter(self.keyset_filter(cursor))
+        return queryset[:self.limit + 1]
+
+    def set_page(self, results):
+        self.has_next = len(results) > self.limit
+        self.page = results[:self.limit]
+        return self.page
+
+    def get_paginated_data(self, data):
+        return {
+            'next': self.get_next_link(),
+            'results': data,
+        }
+
+    def use_fallback(self, request):
+        if 'offset' in request.query_params:
+            return True
+        ordering = request.query_params.get(api_settings.ORDERING_PARAM)
+        return bool(ordering) and ordering != self.ordering[0]
+
+    def get_page_size(self, request):
+        try:
+            size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        if size <= 0:
+            return self.page_size
+        return min(size, self.max_page_size)
+
+    def keyset_filter(self, values):
+        """Rows strictly after the given ordering values."""
+        condition = Q()
+        equal = {}
+        for field, value in zip(self.ordering, values):
+            name = field.lstrip('-')
+            lookup = 'lt' if field.startswith('-') else 'gt'
+            condition |= Q(**equal, **{f'{name}__{lookup}': value})
+            equal[name] = value
+        return condition
+
+    def encode_cursor(self, item):
+        values = []
+        for field in self.ordering:
+            value = getattr(item, field.lstrip('-'))
+            values.append(value.isoformat() if isinstance(value, datetime) else value)
+        token = json.dumps(values, separators=(',', ':')).encode()
+        return base64.urlsafe_b64encode(token).decode()
+
+    def decode_cursor(self, request, queryset):
+        """
+        Ordering values of the cursor of the request, parsed by the fields of
+        ``queryset`` (model fields or annotations), None without a cursor.
+        """
+        token = request.query_params.get(self.cursor_query_param)
+        if not token:
+            return None
+        try:
+            values = json.loads(base64.urlsafe_b64decode(token.encode()))
+        except (binascii.Error, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+        if not isinstance(values, list) or len(values) != len(self.ordering):
+            raise NotFound(self.invalid_cursor_message)
+        parsed = []
+        for field, value in zip(self.ordering, values):
+            name = field.lstrip('-')
+            annotation = queryset.query.annotations.get(name)
+            model_field = annotation.output_field if annotation is not None else queryset.model._meta.get_field(name)
+            try:
+                value = model_field.to_python(value)
+            except (ValidationError, TypeError, ValueError):
+                raise NotFound(self.invalid_cursor_message)
+            if value is None:
+                raise NotFound(self.invalid_cursor_message)
+            parsed.append(value)
+        return parsed
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        url = self.request.build_absolute_uri()
+        url = replace_query_param(url, self.page_size_query_param, self.limit)
+        return replace_query_param(url, self.cursor_query_param, self.encode_cursor(self.page[-1]))
+
+    def get_paginated_response(self, data):
+        if self.fallback is not None:
+            return self.fallback.get_paginated_response(data)
+        return Response(self.get_paginated_data(data))
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'required': ['results'],
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema,
+            },
+        }
+
+    def get_schema_operation_parameters(self, view):
+        return [
+            {
+                'name': self.cursor_query_param,
+                'required': False,
+                'in': 'query',
+                'description': 'The pagination cursor value.',
+                'schema': {'type': 'string'},
+            },
+            {
+                'name': self.page_size_query_param,
+                'required': False,
+                'in': 'query',
+                'description': 'Number of results to return per page.',
+                'schema': {'type': 'integer'},
+            },
+        ]
@@ -23,6 +23,7 @@ INSTALLED_APPS = [
     "django.contrib.sessions",
     "django.contrib.messages",
     "django.contrib.staticfiles",
+    "django.contrib.postgres",
 
     # third-party apps
     "rest_framework",
@@ -40,6 +41,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'config.middleware.RequestMetricsMiddleware', # First, to see the queries of the other middlewares
+    'config.middleware.ReplicaMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
@@ -79,22 +82,146 @@ DATABASES = {
         'PASSWORD': os.environ.get('POSTGRES_PASSWORD', 'minitwitter_password'),
         'HOST': os.environ.get('POSTGRES_HOST', 'db'),
         'PORT': os.environ.get('POSTGRES_PORT', '5432'),
+        # Reuse the connection of a process across requests and tasks, checked before reuse
+        'CONN_MAX_AGE': int(os.environ.get('POSTGRES_CONN_MAX_AGE', 60)),
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': {},
     }
 }
 
+# Connection pool of every process, of at most POSTGRES_POOL_SIZE connections.
+# Needed under ASGI, where every request runs in its own thread and a
+# persistent connection per thread would pile up
+POSTGRES_POOL_SIZE = int(os.environ.get('POSTGRES_POOL_SIZE', 0))
+if POSTGRES_POOL_SIZE:
+    DATABASES['default']['CONN_MAX_AGE'] = 0 # The pool keeps the connections
+    DATABASES['default']['OPTIONS']['pool'] = {
+        'min_size': 1,
+        'max_size': POSTGRES_POOL_SIZE,
+        'timeout': 10, # Seconds to wait for a free connection
+        'max_idle': 60 * 5, # Close the extra connections idle this long
+    } # CONN_HEALTH_CHECKS checks a connection before handing it out
+
+# POSTGRES_PGBOUNCER=1 when POSTGRES_HOST is a PgBouncer in transaction pooling
+# mode: a connection may change of server between transactions, so no cursor
+# or prepared statement can outlive a transaction
+if os.environ.get('POSTGRES_PGBOUNCER') == '1':
+    DATABASES['default']['DISABLE_SERVER_SIDE_CURSORS'] = True
+    DATABASES['default']['OPTIONS']['prepare_threshold'] = None
+
+# Read replicas, as comma separated host[:port], e.g. POSTGRES_REPLICA_HOSTS=db-replica.
+# The read-only endpoints use them, see config/db_router.py
+DATABASE_REPLICAS = []
+for number, replica in enumerate(filter(None, os.environ.get('POSTGRES_REPLICA_HOSTS', '').split(',')), 1):
+    host, _, port = replica.strip().partition(':')
+    DATABASES[f'replica{number}'] = {
+        **DATABASES['default'],
+        'HOST': host,
+        'PORT': port or DATABASES['default']['PORT'],
+        'TEST': {'MIRROR': 'default'}, # The tests read the test database
+    }
+    DATABASE_REPLICAS.append(f'replica{number}')
+DATABASE_ROUTERS = ['config.db_router.ReplicaRouter']
+READ_YOUR_WRITES_SECONDS = 10 # The reads of a user who wrote stay on the primary this long
+
+# Redis host, shared by the cache, the timelines and Celery
+REDIS_HOST = os.environ.get('REDIS_HOST', 'redis')
+
 CACHES = {
     'default': {
         'BACKEND': 'django_redis.cache.RedisCache',
-        'LOCATION': 'redis://redis:6379/1',
+        'LOCATION': f'redis://{REDIS_HOST}:6379/1',
         'OPTIONS': {
             'CLIENT_CLASS': 'django_redis.client.DefaultClient',
         }
     }
 }
 
-# Timeout for cache
-CACHE_TTL = 60 * 10  # 10 minutes
+# Timeout for the feed cache, the cached pages are invalidated by versioned keys
+FEED_CACHE_TTL = 60 * 60 * 24  # 24 hours
+
+# Home timelines (fan-out on write)
+TIMELINE_MAX_LENGTH = 800 # Number of post ids kept per user timeline
+TIMELINE_EMPTY_TTL = 60 * 60  # 1 hour, an empty timeline is cached this long
+# Authors with at least this many followers are not fanned out, their posts are
+# pulled and merged into the timelines at read time (None disables the hybrid mode)
+TIMELINE_CELEBRITY_THRESHOLD = 10000
+
+# Follow graph cache: following/follower id sets in Redis (see apps/follows/graph.py)
+GRAPH_CACHE_TTL = 60 * 60 * 24  # 24 hours, the sets are reloaded from the database after
+
+# Profile summaries: a Redis hash per user (see apps/users/profiles.py)
+PROFILE_CACHE_TTL = 60 * 60 * 24  # 24 hours, the hashes are reloaded from the database after
+PROFILE_MISSING_TTL = 60  # 1 minute for the ids of users that do not exist, anyone can request them
+
+
+# Text search configuration of the post search (also used by the trigger
+# created in apps/posts/migrations/0005_post_search_vector.py)
+POST_SEARCH_CONFIG = 'english'
+
+# Maximum width of the resized variants of the post images, by size name (see apps/posts/images.py)
+POST_IMAGE_SIZES = {'thumb': 320, 'medium': 720, 'large': 1280}
+
+# Trending tags (see apps/posts/trending.py)
+TRENDING_BUCKET_SECONDS = 60 * 10  # 10 minutes
+TRENDING_WINDOW_SECONDS = 60 * 60 * 24  # 24 hours
+TRENDING_HALF_LIFE_SECONDS = 60 * 60 * 2  # 2 hours
+TRENDING_TOP_K = 20
+
+# Likes: 'database' writes the Like table on every request, 'redis' records the
+# likes in Redis and writes them behind to the Like table (see apps/likes/engine.py)
+LIKES_ENGINE = os.environ.get('LIKES_ENGINE', 'database')
+LIKES_REDIS_TTL = 60 * 60 * 24 * 7  # 7 days, renewed on every like/unlike
+LIKES_FLUSH_BATCH_SIZE = 1000 # Likes written per transaction by the flush task
+LIKERS_PREVIEW_SIZE = 3 # First likers embedded in the posts (see apps/likes/likers.py)
+LIKERS_PREVIEW_TTL = 60 * 60 * 24  # 24 hours
+
+# Follow notifications are mailed as a digest once the oldest follow queued for
+# a user is this old, an unfollow within the window cancels it (see apps/follows/notifications.py)
+FOLLOW_DIGEST_WINDOW = 60 * 5  # 5 minutes
+FOLLOW_DIGEST_BATCH_SIZE = 500 # Users whose digest is built per batch of a flush
+
+# "Who to follow" suggestions, precomputed daily (see apps/follows/recommendations.py)
+RECOMMENDATIONS_COUNT = 20 # Suggestions stored per user
+RECOMMENDATIONS_ACTIVITY_DAYS = 7 # Posts of the candidates counted as recent activity
+RECOMMENDATIONS_BATCH_SIZE = 500 # Users whose suggestions are computed per batch
+RECOMMENDATIONS_TTL = 60 * 60 * 24 * 2  # 2 days, so that a failed run does not empty the suggestions
+
+# Maximum number of ids of a bulk follow/unfollow or like/unlike request
+BULK_MAX_ITEMS = 100
+
+
+# Serve the feed, likes and followers/following lists with the async views
+# (see config/async_views.py), the DRF views serve every other request. Only
+# worth it under ASGI (the web-asgi service): under WSGI an async view runs in
+# an event loop of its own per request.
+ASYNC_READ_VIEWS = os.environ.get('ASYNC_READ_VIEWS') == '1'
+
+# Request metrics (see config/middleware.py and config/metrics.py)
+REQUEST_METRICS = True # Add every request to the counters exported by /metrics
+SERVER_TIMING = True # Return the queries, cache and serializer time in the Server-Timing header
+# Bearer token of the Prometheus scrapers, /metrics is only served to them and to staff users
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+# Raise instead of logging when a view goes over its query_budget
+QUERY_BUDGET_STRICT = 'test' in sys.argv
+
+
+# Password hashing: the hasher of PASSWORD_HASHER_PROFILE hashes the new passwords,
+# the others check the older hashes, upgraded on login (see apps/users/hashers.py)
+PASSWORD_HASHER_PROFILES = {
+    'argon2': 'apps.users.hashers.TunedArgon2PasswordHasher',
+    'scrypt': 'apps.users.hashers.TunedScryptPasswordHasher',
+    'pbkdf2': 'django.contrib.auth.hashers.PBKDF2PasswordHasher', # Django's default
+}
+PASSWORD_HASHER_PROFILE = os.environ.get('PASSWORD_HASHER_PROFILE', 'argon2')
+PASSWORD_HASHERS = [PASSWORD_HASHER_PROFILES[PASSWORD_HASHER_PROFILE]] + [
+    hasher for profile, hasher in PASSWORD_HASHER_PROFILES.items() if profile != PASSWORD_HASHER_PROFILE
+] + ['django.contrib.auth.hashers.PBKDF2SHA1PasswordHasher']
 
+# Failed logins allowed per window before the login requests are refused (see apps/users/limiter.py)
+LOGIN_ATTEMPT_WINDOW = 60 * 15  # 15 minutes
+LOGIN_MAX_FAILURES_PER_EMAIL = 10 # Per email and client IP, so that nobody can lock an email out
+LOGIN_MAX_FAILURES_PER_IP = 100
 
 # Password validation
 AUTH_PASSWORD_VALIDATORS = [
@@ -137,7 +264,7 @@ DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 # configuring JWT authentication and rest framework 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'apps.users.authentication.CachedJWTAuthentication',
     ],
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.IsAuthenticated',
@@ -149,6 +276,10 @@ REST_FRAMEWORK = {
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.LimitOffsetPagination',
     'PAGE_SIZE': 20,
     'DEFAULT_SCHEMA_CLASS': 'drf_spectacular.openapi.AutoSchema',
+    # Reverse proxies in front of the app: the client IP of the throttles and of
+    # the login limiter is read from X-Forwarded-For only behind them, it is
+    # REMOTE_ADDR by default (a client sets X-Forwarded-For to anything)
+    'NUM_PROXIES': int(os.environ.get('NUM_PROXIES', 0)),
 }
 
 
@@ -161,6 +292,13 @@ SIMPLE_JWT = {
     'REFRESH_TOKEN_LIFETIME': timedelta(days=1),
 }
 
+# Users of the access tokens, cached per process and in Redis (see apps/users/authentication.py)
+AUTH_USER_LOCAL_CACHE_SIZE = 10000
+AUTH_USER_LOCAL_TTL = 5 # Seconds a deactivated user may still be authenticated by another process
+AUTH_USER_CACHE_TTL = 60 * 5  # 5 minutes
+# Authenticate the read-only requests with the claims of the token alone, without the user
+JWT_STATELESS_READS = os.environ.get('JWT_STATELESS_READS') == '1'
+
 SPECTACULAR_SETTINGS = {
     'TITLE': 'MiniTwitter API',
     'DESCRIPTION': 'A simple Twitter clone built with Django and React',
@@ -168,15 +306,41 @@ SPECTACULAR_SETTINGS = {
 }
 
 # Celery settings
-REDIS_HOST = os.environ.get('REDIS_HOST', 'redis')
-
-CELERY_BROKER_URL    = 'redis://redis:6379/0'
-CELERY_RESULT_BACKEND = 'redis://redis:6379/0'
+CELERY_BROKER_URL    = f'redis://{REDIS_HOST}:6379/0'
+CELERY_RESULT_BACKEND = f'redis://{REDIS_HOST}:6379/0'
 CELERY_ACCEPT_CONTENT = ['json']
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 
 
+# Periodic tasks run by the beat service
+CELERY_BEAT_SCHEDULE = {
+    'reconcile-like-counts': {
+        'task': 'apps.posts.tasks.reconcile_like_counts',
+        'schedule': timedelta(hours=1),
+    },
+    'reconcile-follow-counts': {
+        'task': 'apps.follows.tasks.reconcile_follow_counts',
+        'schedule': timedelta(hours=1),
+    },
+    'refresh-trending-tags': {
+        'task': 'apps.posts.tasks.refresh_trending_tags',
+        'schedule': timedelta(minutes=1),
+    },
+    'flush-follow-notifications': {
+        'task': 'apps.follows.tasks.flush_follow_notifications',
+        'schedule': timedelta(minutes=1),
+    },
+    'compute-recommendations': {
+        'task': 'apps.follows.tasks.compute_recommendations',
+        'schedule': timedelta(hours=24),
+    },
+    'flush-likes': {
+        'task': 'apps.likes.tasks.flush_likes',
+        'schedule': timedelta(seconds=5),
+    },
+}
+
 CELERY_TASK_ALWAYS_EAGER = 'test' in sys.argv
 CELERY_TASK_EAGER_PROPAGATES = True
 
@@ -8,12 +8,16 @@ from drf_spectacular.views import (
 from django.conf    import settings
 from django.conf.urls.static import static
 
+from config.metrics import metrics_view
+
 urlpatterns = [
     path("admin/", admin.site.urls),
     path('api/users/',  include('apps.users.urls')),
     path('api/posts/',  include('apps.posts.urls')),
     path('api/follows/',include('apps.follows.urls')),
     path('api/likes/',  include('apps.likes.urls')),
+    # Prometheus metrics
+    path('metrics', metrics_view, name='metrics'),
     # OpenAPI schema
     path('api/schema/', SpectacularAPIView.as_view(), name='schema'),
     # Swagger UI
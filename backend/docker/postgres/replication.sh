@@ -0,0 +1,5 @@
+#!/bin/sh
+# Let db-replica stream the WAL of the primary (see docker-compose.yml),
+# run by the postgres image when it creates the database
+set -e
+echo "host replication $POSTGRES_USER all scram-sha-256" >> "$PGDATA/pg_hba.conf"